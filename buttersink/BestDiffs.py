@@ -96,16 +96,18 @@ class BestDiffs:
 
     """
 
-    def __init__(self, volumes, delete=False, measureSize=True):
+    def __init__(self, volumes, delete=False, measureSize=True, measureWorkers=1):
         """ Initialize.
 
         volumes are the required snapshots.
+        measureWorkers is how many diffs each sink may measure at once.
 
         """
         self.nodes = {volume: _Node(volume, False) for volume in volumes}
         self.dest = None
         self.delete = delete
         self.measureSize = measureSize
+        self.measureWorkers = measureWorkers
 
     def analyze(self, chunkSize, *sinks):
         """  Figure out the best diffs to use to reach all our required volumes. """
@@ -137,10 +139,17 @@ class BestDiffs:
 
             # logger.info("Measuring any estimated diffs")
 
+            # {sink: [edge]}
+            estimated = collections.defaultdict(list)
+
             for node in self.nodes.values():
                 edge = node.diff
                 if edge is not None and edge.sink != self.dest and edge.sizeIsEstimated:
-                    edge.sink.measureSize(edge, chunkSize)
+                    estimated[edge.sink].append(edge)
+
+            for (sink, edges) in estimated.items():
+                for edge in sink.measureSizes(edges, chunkSize, self.measureWorkers):
+                    logger.debug("Measured %s", edge)
 
             actualSize = currentSize()
 
@@ -152,8 +161,51 @@ class BestDiffs:
             if actualSize <= 1.2 * estimatedSize:
                 return
 
+    def plan(self, chunkSize, willMeasureLater, source, dest):
+        """ Choose diffs from source and dest, without measuring them, and return them.
+
+        This runs next to dest's data, for a planner on another host.
+        """
+        self.dest = dest
+        self._chooseDiffs(chunkSize, willMeasureLater, dest, source)
+        return [node.diff for node in self.nodes.values() if node.diff is not None]
+
     def _analyzeDontMeasure(self, chunkSize, willMeasureLater, *sinks):
         """  Figure out the best diffs to use to reach all our required volumes. """
+        if not self._analyzeInDest(chunkSize, willMeasureLater, *sinks):
+            self._chooseDiffs(chunkSize, willMeasureLater, *sinks)
+
+        for node in self.nodes.values():
+            node.height = self._height(node)
+            if node.diff is None:
+                logger.error(
+                    "No source diffs for %s",
+                    node.volume.display(sinks[-1], detail="line"),
+                )
+
+    def _analyzeInDest(self, chunkSize, willMeasureLater, *sinks):
+        """ Let the destination choose the diffs next to its data, if it can.
+
+        Returns False if it can't.
+        """
+        volumes = [node.volume for node in self.nodes.values() if not node.intermediate]
+
+        diffs = self.dest.planDiffs(volumes, sinks[1:], self.delete, chunkSize, willMeasureLater)
+
+        if diffs is None:
+            return False
+
+        self.nodes = {volume: _Node(volume, False) for volume in volumes}
+
+        for diff in diffs:
+            if diff.toVol not in self.nodes:
+                self.nodes[diff.toVol] = _Node(diff.toVol, True)
+            self.nodes[diff.toVol].diff = diff
+
+        return True
+
+    def _chooseDiffs(self, chunkSize, willMeasureLater, *sinks):
+        """ Follow edges from each sink, height by height, keeping the cheapest. """
         nodes = [None]
         height = 1
 
@@ -167,6 +219,16 @@ class BestDiffs:
 
             nodes.sort(key=sortKey)
 
+            # Remote sinks can answer for the whole height in one round trip
+            fromVols = [
+                node.volume if node else None
+                for node in nodes
+                if self._height(node) < height and (node is None or node.diffSize is not None)
+            ]
+
+            for sink in sinks:
+                sink.prefetchEdges(fromVols)
+
             for fromNode in nodes:
                 if self._height(fromNode) >= height:
                     continue
@@ -261,14 +323,6 @@ class BestDiffs:
 
         self._prune()
 
-        for node in self.nodes.values():
-            node.height = self._height(node)
-            if node.diff is None:
-                logger.error(
-                    "No source diffs for %s",
-                    node.volume.display(sinks[-1], detail="line"),
-                )
-
     def _getNode(self, vol):
         return self.nodes[vol] if vol is not None else None
 
@@ -37,6 +37,13 @@ FIXUP_AFTER_RECEIVE = False
 FIXUP_DURING_SEND = True
 FIXUP_DURING_RECEIVE = True
 
+# btrfs-progs 6.0 can send and receive stream version 2 (compressed data).
+# Receive decompresses if the kernel can't do encoded writes.
+theStreamV2Version = [6, 0]
+
+# Highest send stream version the kernel can produce
+theKernelStreamVersion = "/sys/fs/btrfs/features/send_stream_version"
+
 
 def _makeNice(process):
     try:
@@ -46,15 +53,29 @@ def _makeNice(process):
         logger.debug("ionice is not available")
 
 
+def _parser(diff, fixup, maxVersion=None):
+    """ Return a send stream parser, tweaking volume information if fixup is set. """
+    if not fixup:
+        return send.StreamParser(maxVersion=maxVersion)
+
+    return send.StreamParser(
+        diff.toUUID, diff.toGen, diff.fromUUID, diff.fromGen, maxVersion=maxVersion,
+    )
+
+
 class Butter:
 
     """ Interface to local btrfs file system snapshots. """
 
     def __init__(self, dryrun):
         """ Initialize. """
-        self.btrfsVersion = self._getVersion([3, 14])
+        (self.btrfsVersion, version) = self._getVersion([3, 14])
         self.dryrun = dryrun
 
+        # Highest send stream versions btrfs can receive and send
+        self.receiveStreamVersion = 2 if version >= theStreamV2Version else 1
+        self.sendStreamVersion = min(self.receiveStreamVersion, self._getKernelStreamVersion())
+
     def _getVersion(self, minVersion):
         btrfsVersionString = subprocess.check_output(
             ["btrfs", "--version"], stderr=sys.stderr
@@ -68,18 +89,30 @@ class Butter:
         except AttributeError:
             version = None
 
-        if version < [3, 14]:
+        if version < minVersion:
             logger.error(
-                "%s is not supported.  Please upgrade your btrfs to at least 3.14",
-                btrfsVersionString
+                "%s is not supported.  Please upgrade your btrfs to at least %s",
+                btrfsVersionString, ".".join(str(num) for num in minVersion),
             )
         else:
             logger.debug("%s", btrfsVersionString)
 
-        return btrfsVersionString
+        return (btrfsVersionString, version)
 
-    def receive(self, path, diff, showProgress=True):
-        """ Return a context manager for stream that will store a diff. """
+    def _getKernelStreamVersion(self):
+        try:
+            with open(theKernelStreamVersion) as features:
+                return int(features.read())
+        except (IOError, ValueError):
+            return 1
+
+    def receive(self, path, diff, showProgress=True, passthrough=False):
+        """ Return a context manager for stream that will store a diff.
+
+        Streams newer than receiveStreamVersion are rejected.
+        A passthrough stream is passed to btrfs as is,
+        so the sender must check and fix it up.
+        """
         directory = os.path.dirname(path)
 
         cmd = ["btrfs", "receive", "-e", directory]
@@ -90,44 +123,64 @@ class Butter:
         if not os.path.exists(directory):
             os.makedirs(directory)
 
+        # Don't leak other streams' pipes into this process, or they won't see EOF
         process = subprocess.Popen(
             cmd,
             stdin=subprocess.PIPE,
             stderr=subprocess.PIPE,
             stdout=DEVNULL,
+            close_fds=True,
         )
         _makeNice(process)
 
-        return _Writer(process, process.stdin, path, diff, showProgress)
+        return _Writer(
+            process, process.stdin, path, diff, showProgress,
+            self.receiveStreamVersion, passthrough,
+        )
+
+    def send(
+        self, targetPath, parent, diff, showProgress=True, allowDryRun=True, streamVersion=1,
+        passthrough=False,
+    ):
+        """ Return context manager for stream to send a (incremental) snapshot.
+
+        Stream version 2 sends compressed extents without decompressing them.
+        A passthrough stream is passed on from btrfs as is,
+        so the receiver must check and fix it up.
+        """
+        cmd = ["btrfs", "send"]
+
+        if streamVersion >= 2:
+            cmd += ["--proto", str(streamVersion), "--compressed-data"]
 
-    def send(self, targetPath, parent, diff, showProgress=True, allowDryRun=True):
-        """ Return context manager for stream to send a (incremental) snapshot. """
         if parent is not None:
-            cmd = ["btrfs", "send", "-p", parent, targetPath]
-        else:
-            cmd = ["btrfs", "send", targetPath]
+            cmd += ["-p", parent]
+
+        cmd += [targetPath]
 
         if Store.skipDryRun(logger, self.dryrun and allowDryRun)("Command: %s", cmd):
             return None
 
         process = subprocess.Popen(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=DEVNULL)
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=DEVNULL, close_fds=True)
         _makeNice(process)
 
-        return _Reader(process, process.stdout, targetPath, diff, showProgress)
+        return _Reader(process, process.stdout, targetPath, diff, showProgress, passthrough)
 
 
 class _Writer(io.RawIOBase):
 
     """ Context Manager to write a snapshot. """
 
-    def __init__(self, process, stream, path, diff, showProgress):
+    def __init__(self, process, stream, path, diff, showProgress, maxVersion, passthrough=False):
         self.process = process
         self.stream = stream
         self.path = path
         self.diff = diff
         self.bytesWritten = None
         self.progress = DisplayProgress(diff.size) if showProgress else None
+        self.passthrough = passthrough
+        self.parser = None if passthrough else _parser(diff, FIXUP_DURING_RECEIVE, maxVersion)
 
     def __enter__(self):
         self.bytesWritten = 0
@@ -148,6 +201,9 @@ class _Writer(io.RawIOBase):
         self.process.wait()
 
         if exception is None and self.process.returncode == 0:
+            if self.parser is not None:
+                self.parser.close()
+
             # Fixup with SET_RECEIVED_SUBVOL
             if FIXUP_AFTER_RECEIVE:
                 received = btrfs.SnapShot(self.path)
@@ -179,18 +235,17 @@ class _Writer(io.RawIOBase):
                 % (self.path, self.process.returncode, )
             )
 
+    def fileno(self):
+        return self.stream.fileno()
+
     def write(self, data):
-        # If it's the first big chunk (header)
-        # Tweak the volume information to match what we expect.
-        if FIXUP_DURING_RECEIVE and self.bytesWritten == 0:
-            data = send.replaceIDs(
-                data,
-                self.diff.toUUID,
-                self.diff.toGen,
-                self.diff.fromUUID,
-                self.diff.fromGen,
-            )
-        self.stream.write(data)
+        if self.parser is None:
+            self.stream.write(data)
+        else:
+            # The parser tweaks the volume information in the stream header
+            # to match what we expect.
+            for piece in self.parser.feed(data):
+                self.stream.write(piece)
         self.bytesWritten += len(data)
         if self.progress is not None:
             self.progress.update(self.bytesWritten)
@@ -200,13 +255,15 @@ class _Reader(io.RawIOBase):
 
     """ Context Manager to read a snapshot. """
 
-    def __init__(self, process, stream, path, diff, showProgress):
+    def __init__(self, process, stream, path, diff, showProgress, passthrough=False):
         self.process = process
         self.stream = stream
         self.path = path
         self.diff = diff
         self.bytesRead = None
         self.progress = DisplayProgress() if showProgress else None
+        self.passthrough = passthrough
+        self.parser = None if passthrough else _parser(diff, FIXUP_DURING_SEND)
 
     def __enter__(self):
         self.bytesRead = 0
@@ -237,18 +294,24 @@ class _Reader(io.RawIOBase):
                 % (self.process.returncode, self.path)
             )
 
+        if exception is None and self.parser is not None:
+            self.parser.close()
+
+    def fileno(self):
+        return self.stream.fileno()
+
     def read(self, size):
-        # If it's the first big chunk (header)
-        # Tweak the volume information to match what we expect.
-        data = self.stream.read(size)
-        if FIXUP_DURING_SEND and self.bytesRead == 0:
-            data = send.replaceIDs(
-                data,
-                self.diff.toUUID,
-                self.diff.toGen,
-                self.diff.fromUUID,
-                self.diff.fromGen,
-            )
+        if self.bytesRead == 0 and self.parser is not None:
+            # Read the first big chunk (header) into a writable buffer,
+            # so the parser can tweak the volume information in place.
+            data = bytearray(size)
+            del data[self.stream.readinto(data):]
+        else:
+            data = self.stream.read(size)
+
+        if self.parser is not None:
+            data = self.parser.parse(data)
+
         self.bytesRead += len(data)
         if self.progress is not None:
             self.progress.update(self.bytesRead)
@@ -11,11 +11,14 @@ import Butter
 import progress
 import Store
 
+import contextlib
 import io
 import logging
 import math
 import os
 import os.path
+import Queue
+import threading
 import time
 
 logger = logging.getLogger(__name__)
@@ -27,11 +30,12 @@ class ButterStore(Store.Store):
 
     """ A local btrfs synchronization source or sink. """
 
-    def __init__(self, host, path, mode, dryrun):
+    def __init__(self, host, path, mode, dryrun, cache=None):
         """ Initialize.
 
         host is ignored.
         path is the file system location of the read-only subvolumes.
+        cache is a Cache shared with other stores in a long-running server.
 
         """
         # Don't lose a trailing slash -- it's significant
@@ -44,7 +48,13 @@ class ButterStore(Store.Store):
 
         self.isDiffStore = True
 
-        self.butter = Butter.Butter(dryrun)  # subprocess command-line interface
+        self.cache = cache
+        if cache is not None:
+            self.butter = cache.butter
+        else:
+            self.butter = Butter.Butter(dryrun)  # subprocess command-line interface
+        self.sendStreamVersion = self.butter.sendStreamVersion
+        self.receiveStreamVersion = self.butter.receiveStreamVersion
         self.btrfs = btrfs.FileSystem(self.userPath)     # ioctl interface
 
         # Dict of {uuid: <btrfs.Volume>}
@@ -73,8 +83,8 @@ class ButterStore(Store.Store):
 
         :arg paths: = { Store.Volume: ["linux path",]}
         """
-        with self.btrfs as mount:
-            for bv in mount.subvolumes:
+        with self._scan() as subvolumes:
+            for bv in subvolumes:
                 if not bv.readOnly:
                     continue
 
@@ -100,9 +110,7 @@ class ButterStore(Store.Store):
 
                     infoPath = self._fullPath(path + Store.theInfoExtension)
                     if os.path.exists(infoPath):
-                        logger.debug("Reading %s", infoPath)
-                        with open(infoPath) as info:
-                            Store.Volume.readInfo(info)
+                        self._readInfo(infoPath)
 
                     if not path.startswith("/"):
                         relPath = path
@@ -124,6 +132,36 @@ class ButterStore(Store.Store):
                     # vol is inside Store directory
                     self.extraVolumes[vol] = relPath
 
+    @contextlib.contextmanager
+    def _scan(self):
+        """ Context manager for the btrfs subvolumes to consider. """
+        if self.cache is not None:
+            with self.cache.scan(self) as subvolumes:
+                yield subvolumes
+        else:
+            with self.btrfs as mount:
+                yield self._subvolumes(mount)
+
+    def _readInfo(self, infoPath):
+        if self.cache is not None:
+            self.cache.readInfo(infoPath)
+            return
+
+        logger.debug("Reading %s", infoPath)
+        with open(infoPath) as info:
+            Store.Volume.readInfo(info)
+
+    def _subvolumes(self, mount):
+        """ Return the btrfs subvolumes to consider, scanning as few as possible. """
+        if self.userVolume is not None:
+            # A single snapshot only needs its siblings as candidate diff parents
+            try:
+                return mount.subvolumesNear(os.path.join(self.userPath, self.userVolume))
+            except IOError as error:
+                logger.debug("Scanning all subvolumes (%s)", error)
+
+        return mount.subvolumes
+
     def _fileSystemSync(self):
         with self.btrfs as mount:
             mount.SYNC()
@@ -174,8 +212,11 @@ class ButterStore(Store.Store):
         """ True if Store already contains this edge. """
         return diff.toUUID in self.butterVolumes
 
-    def receive(self, diff, paths):
-        """ Return Context Manager for a file-like (stream) object to store a diff. """
+    def receive(self, diff, paths, passthrough=False):
+        """ Return Context Manager for a file-like (stream) object to store a diff.
+
+        A passthrough stream isn't checked or fixed up.
+        """
         if not self.dryrun:
             self._fileSystemSync()
 
@@ -186,7 +227,7 @@ class ButterStore(Store.Store):
                 "Path %s exists, can't receive %s" % (path, diff.toUUID)
             )
 
-        return self.butter.receive(path, diff, self.showProgress is True)
+        return self.butter.receive(path, diff, self.showProgress is True, passthrough)
 
     def receiveVolumeInfo(self, paths):
         """ Return Context Manager for a file-like (stream) object to store volume info. """
@@ -208,16 +249,78 @@ class ButterStore(Store.Store):
 
         return estimatedSize
 
-    def measureSize(self, diff, chunkSize):
-        """ Spend some time to get an accurate size. """
+    def measureSize(self, diff, chunkSize, showProgress=None):
+        """ Spend some time to get an accurate size.
+
+        showProgress overrides self.showProgress for this call,
+        so a server can measure for several clients at once.
+        """
+        if showProgress is None:
+            showProgress = self.showProgress is not False
+
         self._fileSystemSync()
+        self._measureSize(diff, chunkSize, showProgress)
+
+    def measureSizes(self, diffs, chunkSize, workers=1, showProgress=None):
+        """ Spend some time to get accurate sizes, running up to workers btrfs sends at once.
+
+        Yields each diff as it's measured.
+        """
+        diffs = list(diffs)
+
+        if workers <= 1 or len(diffs) <= 1:
+            for diff in diffs:
+                self.measureSize(diff, chunkSize, showProgress)
+                yield diff
+            return
+
+        self._fileSystemSync()
+
+        pending = Queue.Queue()
+        for diff in diffs:
+            pending.put(diff)
+
+        # (diff, error) for each diff, as it's measured
+        measured = Queue.Queue()
 
+        def work():
+            while True:
+                try:
+                    diff = pending.get_nowait()
+                except Queue.Empty:
+                    return
+
+                try:
+                    # Progress lines from several sends would overwrite each other
+                    self._measureSize(diff, chunkSize, False)
+                    measured.put((diff, None))
+                except Exception as error:
+                    measured.put((diff, error))
+
+        for _ in xrange(min(workers, len(diffs))):
+            thread = threading.Thread(target=work, name="measure")
+            thread.daemon = True
+            thread.start()
+
+        for _ in diffs:
+            (diff, error) = measured.get()
+
+            if error is not None:
+                # Don't start any more
+                while not pending.empty():
+                    pending.get_nowait()
+                raise error
+
+            yield diff
+
+    def _measureSize(self, diff, chunkSize, showProgress):
         sendContext = self.butter.send(
             self.getSendPath(diff.toVol),
             self.getSendPath(diff.fromVol),
             diff,
-            showProgress=self.showProgress is not False,
+            showProgress=showProgress,
             allowDryRun=False,
+            streamVersion=self.sendStreamVersion,
         )
 
         class _Measure(io.RawIOBase):
@@ -247,7 +350,7 @@ class ButterStore(Store.Store):
 
         logger.info("Measuring %s", diff)
 
-        measure = _Measure(diff.size, self.showProgress is not False)
+        measure = _Measure(diff.size, showProgress)
         Store.transfer(sendContext, measure, chunkSize)
 
         diff.setSize(measure.totalSize, False)
@@ -288,8 +391,11 @@ class ButterStore(Store.Store):
 
         return rate
 
-    def send(self, diff):
-        """ Write the diff (toVol from fromVol) to the stream context manager. """
+    def send(self, diff, streamVersion=1, passthrough=False):
+        """ Write the diff (toVol from fromVol) to the stream context manager.
+
+        A passthrough stream isn't checked or fixed up.
+        """
         if not self.dryrun:
             self._fileSystemSync()
 
@@ -298,6 +404,8 @@ class ButterStore(Store.Store):
             self.getSendPath(diff.fromVol),
             diff,
             self.showProgress is True,
+            streamVersion=min(streamVersion, self.sendStreamVersion),
+            passthrough=passthrough,
         )
 
     def keep(self, diff):
@@ -340,3 +448,52 @@ class ButterStore(Store.Store):
             if self._skipDryRun(logger, 'INFO', dryrun=dryrun)("Delete subvolume %s", path):
                 continue
             self.butterVolumes[vol.uuid].destroy()
+
+
+class Cache(object):
+
+    """ Subvolume metadata kept between ButterStores in a long-running server.
+
+    Stores on the same btrfs file system can share one.  Each store path keeps
+    its own FileSystem, so a later full scan only rereads the subvolumes if the
+    root tree changed since the last one, and quota sizes if anything was
+    committed.  That catches snapshots received or deleted by any process,
+    wherever they are.  Scans for a single snapshot reread its candidates.
+    """
+
+    def __init__(self, butter):
+        """ Initialize. """
+        self.butter = butter
+
+        self._lock = threading.RLock()
+
+        # {(userPath, userVolume): FileSystem}, which remembers its last scan
+        self._mounts = {}
+
+        # {path: modification time} of info files already read
+        self._infoTimes = {}
+
+    @contextlib.contextmanager
+    def scan(self, store):
+        """ Context manager for store's subvolumes, reread as far as they changed. """
+        key = (store.userPath, store.userVolume)
+
+        with self._lock:
+            if key not in self._mounts:
+                self._mounts[key] = btrfs.FileSystem(store.userPath)
+
+            with self._mounts[key] as mount:
+                yield store._subvolumes(mount)
+
+    def readInfo(self, infoPath):
+        """ Read a volume info file, unless it hasn't changed since last time. """
+        modified = os.path.getmtime(infoPath)
+
+        with self._lock:
+            if self._infoTimes.get(infoPath) == modified:
+                return
+            self._infoTimes[infoPath] = modified
+
+        logger.debug("Reading %s", infoPath)
+        with open(infoPath) as info:
+            Store.Volume.readInfo(info)
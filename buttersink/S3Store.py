@@ -9,17 +9,27 @@ Copyright (c) 2014 Ames Cornish.  All rights reserved.  Licensed under GPLv3.
 if True:  # Imports and constants
     if True:  # Imports
         from util import humanize
+        import dedup
         import progress
+        import send
         import Store
         import util
 
         import boto
         import boto.s3.connection
+        import boto.s3.multipart
+        import boto.s3.prefix
+        import base64
         import collections
+        import hashlib
         import io
+        import json
         import logging
         import os.path
+        import Queue
         import re
+        import threading
+        import uuid
     if True:  # Constants
         # Maximum xumber of progress reports per chunk
         theProgressCount = 50
@@ -34,6 +44,74 @@ if True:  # Imports and constants
 
         theTrashPrefix = "trash/"
 
+        # Threads listing "directories" in the bucket at once
+        theListWorkers = 8
+
+        # Lists the diffs under a prefix, so opening a store doesn't need to list them
+        theManifestName = "buttersink-manifest.json"
+        theManifestVersion = 3
+
+        # Each writer rewrites its own key here, like changes/prefix/<session>, before it
+        # changes keys under its prefix, so manifests can tell whether they're missing changes.
+        # Writers empty their key when they close, and later writers under prefix delete it.
+        theChangesPrefix = "changes/"
+
+        # Threads copying or tagging keys for the trash at once
+        theTrashWorkers = 16
+
+        # S3 can't copy more than 5GB at once, so larger objects are copied in parts
+        theCopyPartSize = 256 * (1 << 20)
+
+        # S3 limits on multipart uploads (the last part may be smaller)
+        theMinPartSize = 5 * (1 << 20)
+        theMaxPartSize = 5 * (1 << 30)
+        theMaxParts = 10000
+
+        # Uploads this small are a single PUT, instead of a multipart upload
+        theSimplePutSize = theMinPartSize
+
+        # Diffs this small can be packed into bundles, with an index of where each one is
+        theBundledSize = 1 << 20
+        theBundleSize = 64 * (1 << 20)
+        theBundleDir = "bundles/"
+        theBundleExtension = ".bundle"
+        theIndexExtension = ".index"
+        theIndexVersion = 1
+
+        # Sharded keys are in a sub-prefix named by the hash of the rest of the key,
+        # like prefix/_3f/path/to_from, to spread requests over S3's partitions
+        theShardFormat = "_%s"
+        theShardDigits = 2
+
+        # Default upload part size, for diffs that don't need larger parts
+        thePartSize = 100 * (1 << 20)
+
+        # Estimated diffs are assumed to be up to this many times as large
+        theEstimateMargin = 2
+
+        # Objects copied at once, and parts copied at once for each object
+        theCopyWorkers = 8
+
+        # Deduplicated chunks, named by content hash, shared by the whole bucket
+        theChunkPrefix = "chunks/"
+
+        # Deduplicated diffs are stored as a recipe listing their chunks,
+        # named like path/to_from.<size>.recipe, so listing them doesn't need to read them
+        theRecipeExtension = ".recipe"
+        theRecipeVersion = 1
+
+        # Chunks uploaded or downloaded at once for each diff
+        theDedupWorkers = 8
+
+        # Bucket-wide prefixes, which aren't diffs of any store
+        theSharedPrefixes = (theTrashPrefix, theChunkPrefix, theChangesPrefix)
+
+        # Tag for trashed objects, for a lifecycle rule to expire them
+        theTrashTagging = (
+            '<Tagging><TagSet><Tag><Key>buttersink</Key><Value>trash</Value></Tag></TagSet>'
+            '</Tagging>'
+        )
+
 # logger.setLevel('DEBUG')
 
 
@@ -63,8 +141,100 @@ class S3Store(Store.Store):
         self.diffs = None
         self.extraKeys = None
 
+        # { (fromVol, toVol) }, for hasEdge
+        self.edges = None
+
+        # { diff } stored as recipes of deduplicated chunks
+        self.recipes = None
+
+        # { keyName: (bundleName, offset, size) } of diffs stored in bundles
+        self.bundled = None
+
+        # { diff: keyName } of stored diffs (or their recipes)
+        self.diffKeys = None
+
+        # { keyName: diff } of listed diffs, and { keyName } of listed keys that are stored
+        # by themselves, or in bundles (both, if a run stopped while bundling them)
+        self._keyDiffs = None
+        self._loose = None
+        self._packed = None
+
+        # Guards the above while listing in parallel
+        self._lock = threading.Lock()
+
+        # Only list keys under path, instead of the whole bucket
+        self.prefixOnly = True
+
+        # { keyName: (toUUID, size, toGen) } of diffs under path, if prefixOnly
+        self.manifest = None
+
+        # { changesName: ETag } of the writers' change keys that the manifest includes,
+        # and { changesName } of those whose writers have closed
+        self.changes = None
+        self._closedChanges = None
+
+        # This session's change key, its last ETag, and the changes it hasn't finished
+        self._changesName = theChangesPrefix + self._prefix + uuid.uuid4().hex
+        self._changesETag = None
+        self._pending = set()
+        self._changesLock = threading.Lock()
+
+        # How deleteUnused trashes keys:
+        # 'copy' -- copy them under theTrashPrefix
+        # 'tag' -- tag them for a lifecycle rule to expire, in a versioned bucket
+        self.trashMode = 'copy'
+
+        # Objects, and parts of each object, to copy at once
+        self.copyWorkers = theCopyWorkers
+
+        # [(newName, keyName, diff)] copies scheduled by keep
+        self._keeps = []
+
+        # Upload part size, unless a diff is too large, or small
+        self.partSize = thePartSize
+
+        # Store new diffs as deduplicated chunks
+        self.dedup = False
+        self.dedupWorkers = theDedupWorkers
+
+        # { chunkName } known to be in the bucket
+        self._knownChunks = set()
+
+        # Pack small diffs, and volume info, into bundles
+        self.bundling = False
+
+        # [(keyName, data, diff)] and [(keyName, info)] for the next bundle
+        self._bundleDiffs = []
+        self._bundleInfos = []
+
+        # Put new keys in hashed shards (always, once any keys are sharded)
+        self.sharded = False
+
+        # Copies between S3 stores never pass through this host, so they don't need --direct
+        self.direct = True
+
         logger.info("Listing %s contents...", self)
 
+        self.bucket = self._connect()
+        self.isRemote = True
+
+        # Streams are stored as they are sent
+        self.sendStreamVersion = send.BTRFS_SEND_STREAM_VERSION
+        self.receiveStreamVersion = send.BTRFS_SEND_STREAM_VERSION
+
+    def __unicode__(self):
+        """ Return text description. """
+        return u'S3 Bucket "%s"' % (self.bucketName)
+
+    def __str__(self):
+        """ Return text description. """
+        return unicode(self).encode('utf-8')
+
+    def _connect(self, validate=True):
+        """ Return the bucket, over a new connection.
+
+        boto connections aren't thread-safe, so each thread needs its own.
+        """
         try:
             # Orginary calling format returns a 301 without specifying a location.
             # Subdomain calling format does not require specifying the region.
@@ -78,213 +248,1234 @@ class S3Store(Store.Store):
             logger.error("Try putting S3 credentials into ~/.boto")
             raise
 
-        self.bucket = s3.get_bucket(self.bucketName)
-        self.isRemote = True
+        return s3.get_bucket(self.bucketName, validate=validate)
 
-    def __unicode__(self):
-        """ Return text description. """
-        return u'S3 Bucket "%s"' % (self.bucketName)
+    def _flushPartialUploads(self, dryrun):
+        for upload in self.bucket.list_multipart_uploads():
+            # logger.debug("Upload: %s", upload.__dict__)
+            # for part in upload:
+                # logger.debug("  Part: %s", part.__dict__)
+
+            if not upload.key_name.startswith(self.userPath.lstrip("/")):
+                continue
+
+            if self._skipDryRun(logger, 'INFO', dryrun)(
+                "Delete old partial upload: %s (%d parts)",
+                upload,
+                len([part for part in upload]),
+            ):
+                continue
+
+            upload.cancel_upload()
+
+    def _fillVolumesAndPaths(self, paths):
+        """ Fill in paths.
+
+        :arg paths: = { Store.Volume: ["linux path",]}
+        """
+        self.diffs = collections.defaultdict((lambda: []))
+        self.extraKeys = {}
+        self.edges = set()
+        self.recipes = set()
+        self.bundled = {}
+        self.diffKeys = {}
+        (self._keyDiffs, self._loose, self._packed) = ({}, set(), set())
+
+        if not self.prefixOnly:
+            self._listKeys("", lambda key: self._addKey(key, paths))
+            self._dropPacked()
+            return
+
+        # Listed before the keys, so changes made while listing show up next time
+        self.manifest = {}
+        (self.changes, self._closedChanges) = self._listChanges()
+
+        if self._readManifest(paths):
+            return
+
+        self._listKeys(self._prefix, lambda key: self._addKey(key, paths))
+        self._dropPacked()
+
+        if self.mode != 'r':
+            self._writeManifest()
+
+    @property
+    def _prefix(self):
+        """ Key prefix for this store's path. """
+        return "" if self.userPath == "/" else self.userPath.strip("/") + "/"
+
+    def _readManifest(self, paths):
+        """ Fill in paths from the manifest.  Returns False if it's missing or stale. """
+        key = self.bucket.new_key(self._prefix + theManifestName)
+
+        try:
+            manifest = json.loads(key.get_contents_as_string())
+        except boto.exception.S3ResponseError as error:
+            logger.debug("No manifest (%s: %s)", error.code, error.message)
+            return False
+        except ValueError as error:
+            logger.warn("Ignoring bad manifest %s (%s)", key.name, error)
+            return False
+
+        if manifest.get('version') != theManifestVersion:
+            logger.debug("Ignoring manifest version %s", manifest.get('version'))
+            return False
+
+        if manifest['changes'] != self.changes:
+            logger.info("Listing %s, because it changed since its manifest was written", self)
+            return False
+
+        for (toUUID, fromUUID, size) in manifest['sizes']:
+            Store.Diff.theKnownSizes[toUUID][fromUUID] = size
+
+        self.sharded = self.sharded or manifest['sharded']
+
+        bundled = {
+            keyName: (bundleName, offset, size)
+            for (keyName, bundleName, offset, size) in manifest['bundled']
+        }
+
+        for (keyName, size, toGen) in manifest['diffs']:
+            self._addDiff(keyName, size, paths, toGen, bundled.get(keyName))
+
+        logger.debug("Read %d diffs from manifest", len(self.manifest))
+        return True
+
+    def _listChanges(self):
+        """ Return the change keys of writers that share our keys.
+
+        Those are writers under our prefix, or at a prefix above it, so only those are listed.
+        Returns ({ changesName: ETag }, { changesName of closed writers }).
+        """
+        (changes, closed) = ({}, set())
+
+        parents = self._prefix.split("/")[:-1]
+        listings = [(theChangesPrefix + self._prefix, "")] + [
+            (theChangesPrefix + "".join(part + "/" for part in parents[:depth]), "/")
+            for depth in range(len(parents))
+        ]
+
+        for (prefix, delimiter) in listings:
+            for key in self.bucket.list(prefix, delimiter):
+                if isinstance(key, boto.s3.prefix.Prefix):
+                    continue
+
+                changes[key.name] = key.etag.strip('"')
+
+                if key.size == 0:
+                    closed.add(key.name)
+
+        return (changes, closed)
+
+    def _changing(self, *keyNames):
+        """ Rewrite our change key, before storing or removing keys.
+
+        Manifests written before this are then stale, and later ones don't claim our
+        changes until all of them are done.
+        Changes that fail are never done, so the next run lists the prefix again.
+        """
+        if self.dryrun or not keyNames:
+            return
+
+        with self._lock:
+            self._pending.update(keyNames)
+
+        self._putChanges(uuid.uuid4().hex)
+
+    def _changed(self, *keyNames):
+        """ Note that changes to keys are done. """
+        with self._lock:
+            self._pending.difference_update(keyNames)
+
+    def _putChanges(self, contents):
+        """ Rewrite our change key, and note its new ETag. """
+        with self._changesLock:
+            key = self.bucket.new_key(self._changesName)
+            key.set_contents_from_string(contents, encrypt_key=isEncrypted)
+            self._changesETag = key.etag.strip('"')
+
+    def _closeChanges(self):
+        """ Empty our change key, once all our changes are done, so later writers delete it.
+
+        Emptying it changes its ETag, so the manifest is written again to include that.
+        """
+        with self._lock:
+            if self._changesETag is None or self._pending:
+                return
+
+        self._putChanges("")
+        self._writeManifest()
+
+    def _pruneChanges(self):
+        """ Delete the emptied change keys of closed writers under our prefix.
+
+        Our manifest includes their changes, and our own change key was written after
+        they were listed, so manifests that don't include their changes are still stale.
+        Their writers are done, so they won't be rewritten while we delete them.
+        """
+        with self._lock:
+            changesNames = [
+                changesName for changesName in self._closedChanges
+                if changesName.startswith(theChangesPrefix + self._prefix)
+                and changesName != self._changesName
+            ]
+            self._closedChanges.difference_update(changesNames)
+
+        if not changesNames:
+            return
+
+        result = self.bucket.delete_keys(changesNames, quiet=True)
+        for error in result.errors:
+            logger.error("Can't delete %s (%s: %s)", error.key, error.code, error.message)
+
+        # Any we couldn't delete are left out of the manifest, which just makes it stale
+        with self._lock:
+            for changesName in changesNames:
+                del self.changes[changesName]
+
+    def _writeManifest(self):
+        """ Replace the manifest with our current diffs.
+
+        A single PUT replaces the whole object, so readers never see part of it.
+        """
+        if self.manifest is None or self.dryrun:
+            return
+
+        sizes = []
+        for toUUID in set(toUUID for (toUUID, size, toGen) in self.manifest.values()):
+            for (fromUUID, size) in Store.Diff.theKnownSizes[toUUID].items():
+                if size is not None and fromUUID is not None:
+                    sizes.append((toUUID, fromUUID, size))
+
+        with self._lock:
+            changesETag = self._changesETag if not self._pending else None
+
+        if changesETag is not None:
+            self._pruneChanges()
+
+        with self._lock:
+            changes = dict(self.changes)
+
+        if changesETag is not None:
+            changes[self._changesName] = changesETag
+
+        manifest = dict(
+            version=theManifestVersion,
+            changes=changes,
+            sharded=self.sharded,
+            diffs=[
+                (keyName, size, toGen)
+                for (keyName, (toUUID, size, toGen)) in sorted(self.manifest.items())
+            ],
+            sizes=sorted(sizes),
+            bundled=[
+                (keyName, bundleName, offset, size)
+                for (keyName, (bundleName, offset, size)) in sorted(self.bundled.items())
+                if keyName in self.manifest
+            ],
+        )
+
+        key = self.bucket.new_key(self._prefix + theManifestName)
+        key.set_contents_from_string(json.dumps(manifest), encrypt_key=isEncrypted)
+
+        logger.debug("Wrote %d diffs to manifest", len(self.manifest))
+
+    def _stored(self, keyName, diff=None, write=True):
+        """ Add a key we stored under our prefix to the manifest. """
+        self._changed(keyName)
+
+        if self.manifest is None or not keyName.startswith(self._prefix):
+            return
+
+        if diff is not None:
+            self.manifest[keyName] = (diff.toUUID, diff.size, diff.toGen)
+
+        if write:
+            self._writeManifest()
+
+        # logger.debug("Diffs:\n%s", pprint.pformat(self.diffs))
+        # logger.debug("Vols:\n%s", pprint.pformat(self.vols))
+        # logger.debug("Extra:\n%s", (self.extraKeys))
+
+    def _listKeys(self, prefix, addKey):
+        """ Call addKey(key) for each key under prefix, except trash, chunks and changes.
+
+        Each "directory" is listed separately, by a pool of threads.
+        """
+        # Prefixes to list
+        prefixes = Queue.Queue()
+        errors = []
+
+        def work():
+            bucket = self._connect(validate=False)
+
+            while True:
+                prefix = prefixes.get()
+                if prefix is None:
+                    return
+
+                try:
+                    for item in bucket.list(prefix, "/"):
+                        if isinstance(item, boto.s3.prefix.Prefix):
+                            if item.name not in theSharedPrefixes:
+                                prefixes.put(item.name)
+                        else:
+                            addKey(item)
+                except Exception as error:
+                    errors.append(error)
+                finally:
+                    prefixes.task_done()
+
+        prefixes.put(prefix)
+
+        workers = [threading.Thread(target=work, name="S3 lister") for _ in range(theListWorkers)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        # Sub-prefixes are queued before their parent is done
+        prefixes.join()
+
+        for worker in workers:
+            prefixes.put(None)
+        for worker in workers:
+            worker.join()
+
+        if errors:
+            raise errors[0]
+
+    def _addKey(self, key, paths):
+        """ Add a listed key to the diffs, or read its diff info. """
+        if key.name.startswith(theSharedPrefixes):
+            return
+
+        if key.name == self._prefix + theManifestName:
+            return
+
+        keyInfo = self._parseKeyName(key.name)
+
+        if keyInfo is None:
+            if key.name[-1:] != '/':
+                logger.warning("Ignoring '%s' in S3", key.name)
+            return
+
+        if keyInfo['type'] in ('info', 'diff'):
+            with self._lock:
+                self._loose.add(key.name)
+
+        if keyInfo['type'] == 'info':
+            stream = io.BytesIO()
+            key.get_contents_to_file(stream)
+            stream.seek(0)
+            with self._lock:
+                Store.Volume.readInfo(stream)
+            return
+
+        if keyInfo['type'] == 'recipe':
+            # Recipes stored before their names had sizes must be read
+            size = keyInfo['size'] if keyInfo['size'] is not None else _readRecipe(key)['size']
+            self._addDiff(key.name, size, paths)
+            return
+
+        if keyInfo['type'] == 'index':
+            self._addIndex(key, paths)
+            return
+
+        if keyInfo['type'] == 'bundle':
+            return
+
+        self._addDiff(key.name, key.size, paths)
+
+    def _addIndex(self, key, paths):
+        """ Add the diffs and volume info in a bundle. """
+        index = _readIndex(key)
+        bundleName = key.name[:-len(theIndexExtension)] + theBundleExtension
+
+        for (keyName, offset, size, toGen) in index['diffs']:
+            self._addDiff(keyName, size, paths, toGen, (bundleName, offset, size))
+
+        for (keyName, info) in index['infos']:
+            with self._lock:
+                Store.Volume.readInfo(io.BytesIO(info.encode('utf-8')))
+
+        with self._lock:
+            self._packed.update(keyName for (keyName, _, _, _) in index['diffs'])
+            self._packed.update(keyName for (keyName, _) in index['infos'])
+
+    def _dropPacked(self):
+        """ Delete keys that are also in a bundle, left by a run that stopped while bundling. """
+        keyNames = [
+            keyName for keyName in self._loose & self._packed if keyName.startswith(self._prefix)
+        ]
+
+        if not keyNames or self.mode == 'r' or self.dryrun:
+            return
+
+        logger.info("Deleting %d keys that are already in bundles", len(keyNames))
+
+        self._changing(*keyNames)
+
+        result = self.bucket.delete_keys(keyNames, quiet=True)
+        for error in result.errors:
+            logger.error("Can't delete %s (%s: %s)", error.key, error.code, error.message)
+
+        self._changed(*keyNames)
+
+    def _addDiff(self, keyName, size, paths, toGen=None, bundle=None):
+        """ Add a stored diff.
+
+        bundle is (bundleName, offset, size), if the diff is in a bundle.
+        """
+        keyInfo = self._parseKeyName(keyName)
+
+        if keyInfo is None or keyInfo['type'] not in ('diff', 'recipe'):
+            logger.warning("Ignoring '%s' in S3", keyName)
+            return
+
+        if keyInfo['from'] == 'None':
+            keyInfo['from'] = None
+
+        path = self._relativePath("/" + keyInfo['fullpath'])
+
+        if path is None:
+            return
+
+        with self._lock:
+            if keyName in self._keyDiffs:
+                # Listed by itself and in a bundle, so read it from the bundle
+                if bundle is not None:
+                    self.bundled[keyName] = bundle
+                return
+
+            diff = Store.Diff(self, keyInfo['to'], keyInfo['from'], size)
+            self._keyDiffs[keyName] = diff
+
+            if toGen is not None:
+                diff.toVol.gen = toGen
+
+            if self.manifest is not None and not path.startswith("/"):
+                self.manifest[keyName] = (diff.toUUID, size, toGen)
+
+            logger.debug("Adding %s in %s", diff, path)
+
+            self.diffs[diff.fromVol].append(diff)
+            paths[diff.toVol].append(path)
+            self.edges.add((diff.fromVol, diff.toVol))
+
+            self.extraKeys[diff] = path
+            self.diffKeys[diff] = keyName
+
+            if keyName != self._unshard(keyName):
+                self.sharded = True
+
+            if keyInfo['type'] == 'recipe':
+                self.recipes.add(diff)
+            else:
+                self.recipes.discard(diff)
+
+            if bundle is not None:
+                self.bundled[keyName] = bundle
+
+    def _diffKeyName(self, diff, path):
+        """ Return a new key for a diff stored like this one, in path. """
+        keyName = self._keyName(diff.toUUID, diff.fromUUID, path)
+        return self._shard(_recipeName(keyName, diff.size) if diff in self.recipes else keyName)
+
+    def _shard(self, keyName):
+        """ Return keyName in its shard, if new keys are sharded. """
+        if not self.sharded or not keyName.startswith(self._prefix):
+            return keyName
+
+        return _shardKey(self._prefix, keyName)
+
+    def _unshard(self, keyName):
+        """ Return keyName without its shard, if it's in one. """
+        if not keyName.startswith(self._prefix):
+            return keyName
+
+        (shard, _, rest) = keyName[len(self._prefix):].partition("/")
+
+        if rest and _shardKey(self._prefix, self._prefix + rest) == keyName:
+            return self._prefix + rest
+
+        return keyName
+
+    def _infoKeyName(self, keyName):
+        """ Return the key of the volume info stored with a diff key, in the same layout. """
+        unsharded = self._unshard(keyName)
+        infoName = os.path.dirname(unsharded) + Store.theInfoExtension
+
+        return infoName if unsharded == keyName else _shardKey(self._prefix, infoName)
+
+    def _objectSize(self, diff):
+        """ Return the size of a stored diff's object, or None for a (small) recipe. """
+        return None if diff in self.recipes else diff.size
+
+    def listContents(self):
+        """ Return list of volumes or diffs in this Store's selected directory. """
+        (count, size) = (0, 0)
+        recipes = []
+
+        for diff in self.listDiffs():
+            yield str(diff)
+            count += 1
+            size += diff.size
+
+            if diff in self.recipes:
+                recipes.append(self.diffKeys[diff])
+
+        yield "TOTAL: %d diffs %s" % (count, humanize(size))
+
+        if recipes:
+            yield self._dedupSummary(recipes)
+
+    def _dedupSummary(self, keyNames):
+        """ Return a line comparing the size of recipes' diffs and their distinct chunks. """
+        # { keyName: recipe }
+        recipes = {}
+
+        def read(bucket, keyName):
+            recipes[keyName] = _readRecipe(bucket.new_key(keyName))
+
+        errors = self._forEach(read, keyNames, self.dedupWorkers)
+
+        for (keyName, error) in errors.items():
+            logger.warn("Can't read %s (%s)", keyName, error)
+
+        chunks = {
+            name: chunkSize
+            for recipe in recipes.values()
+            for (name, chunkSize) in recipe['chunks']
+        }
+        (size, stored) = (sum(r['size'] for r in recipes.values()), sum(chunks.values()))
+
+        return "DEDUP: %d diffs %s in %d chunks %s (%.1fx)" % (
+            len(recipes), humanize(size), len(chunks), humanize(stored),
+            float(size) / stored if stored else 1.0,
+        )
+
+    def listDiffs(self):
+        """ Return the stored diffs in this Store's selected directory. """
+        items = list(self.extraKeys.items())
+        items.sort(key=lambda t: t[1])
+
+        for (diff, path) in items:
+            if path.startswith("/"):
+                continue
+            yield diff
+
+    def getEdges(self, fromVol):
+        """ Return the edges available from fromVol. """
+        return self.diffs[fromVol]
+
+    def hasEdge(self, diff):
+        """ Test whether edge is in this sink. """
+        return (diff.fromVol, diff.toVol) in self.edges
+
+    def measureSize(self, diff, chunkSize):
+        """ Spend some time to get an accurate size. """
+        logger.warn("Don't need to measure S3 diffs")
+
+    def directURL(self):
+        """ Return a URL other hosts can use to reach this Store. """
+        return "s3://%s%s/" % (self.bucketName, self.userPath.rstrip("/"))
+
+    @property
+    def endpoint(self):
+        """ Return (host, port) of this store's S3 service.
+
+        S3 copies objects between buckets in any of its regions.
+        """
+        connection = self.bucket.connection
+        return (connection.host, connection.port)
+
+    def sendDirect(self, diff, dest, paths, chunkSize, verify=False):
+        """ Copy diff to another S3 store on the same endpoint, without downloading it.
+
+        Returns False for other stores, other endpoints, if the stream must be verified,
+        or if S3 won't copy it.
+        """
+        if not isinstance(dest, S3Store) or verify:
+            return False
+
+        if dest.endpoint != self.endpoint:
+            logger.debug("Can't copy from %s to %s on another endpoint", self, dest)
+            return False
+
+        isRecipe = diff in self.recipes
+
+        if self.diffKeys[diff] in self.bundled:
+            # Only part of an object
+            return False
+
+        if isRecipe and dest.bucketName != self.bucketName:
+            # The chunks are in this bucket
+            return False
+
+        if dest.dedup and not isRecipe:
+            # Stream it, to store it in chunks
+            return False
+
+        keyName = self.diffKeys[diff]
+        newName = dest._keyName(diff.toUUID, diff.fromUUID, dest.selectReceivePath(paths))
+
+        if isRecipe:
+            newName = _recipeName(newName, diff.size)
+
+        newName = dest._shard(newName)
+
+        logger.info("Copying %s/%s to %s/%s", self.bucketName, keyName, dest.bucketName, newName)
+
+        dest._changing(newName)
+
+        try:
+            dest._copyObject(
+                dest.bucket, newName, keyName, self._objectSize(diff), fromBucket=self.bucketName,
+            )
+        except boto.exception.S3ResponseError as error:
+            logger.warn(
+                "Can't copy %s to %s (%s: %s), so streaming it",
+                keyName, dest, error.code, error.message,
+            )
+            dest._changed(newName)
+            return False
+
+        dest._stored(newName, diff)
+
+        return True
+
+    def receive(self, diff, paths):
+        """ Return Context Manager for a file-like (stream) object to store a diff. """
+        path = self.selectReceivePath(paths)
+        keyName = self._keyName(diff.toUUID, diff.fromUUID, path)
+
+        expected = (diff.size or 0) * (theEstimateMargin if diff.sizeIsEstimated else 1)
+        bundle = self.bundling and diff.size is not None and expected <= theBundledSize
+
+        if self.dedup and not bundle:
+            # The recipe's name has the diff's size, once it's known
+            (diffName, keyName) = (keyName, keyName + theRecipeExtension)
+
+        keyName = self._shard(keyName)
+
+        if self._skipDryRun(logger)("receive %s in %s", keyName, self):
+            return None
+
+        self._changing(keyName)
+
+        progress = _BotoProgress(diff.size) if self.showProgress is True else None
+
+        if bundle:
+            return _Uploader(
+                self.bucket, keyName, progress, onComplete=lambda: self._stored(keyName, diff),
+                size=diff.size, sizeIsEstimated=diff.sizeIsEstimated,
+                bundle=lambda data: self._addToBundle(keyName, data, diff),
+            )
+
+        if self.dedup:
+            def stored(name):
+                self._changed(keyName)
+                self._stored(name, diff)
+
+            return _ChunkUploader(
+                self._connect, lambda size: self._shard(_recipeName(diffName, size)),
+                self.dedupWorkers, self._knownChunks, progress, onComplete=stored,
+            )
+
+        return _Uploader(
+            self.bucket, keyName, progress, onComplete=lambda: self._stored(keyName, diff),
+            size=diff.size, sizeIsEstimated=diff.sizeIsEstimated, partSize=self.partSize,
+        )
+
+    def receiveVolumeInfo(self, paths):
+        """ Return Context Manager for a file-like (stream) object to store volume info. """
+        path = self.selectReceivePath(paths)
+        path = self._shard(path.lstrip("/") + Store.theInfoExtension)
+
+        if self._skipDryRun(logger)("receive info in '%s'", path):
+            return None
+
+        self._changing(path.lstrip("/"))
+
+        bundle = None
+        if self.bundling:
+            def bundle(data):
+                self._addToBundle(path.lstrip("/"), data)
+
+        return _Uploader(
+            self.bucket, path, bufferSize=theInfoBufferSize,
+            onComplete=lambda: self._stored(path.lstrip("/")), simple=True, bundle=bundle,
+        )
+
+    def _addToBundle(self, keyName, data, diff=None):
+        """ Add a small diff, or volume info (without a diff), to the next bundle.
+
+        It must already be stored by itself, until the bundle is stored.
+        """
+        with self._lock:
+            if diff is None:
+                self._bundleInfos.append((keyName, data))
+            else:
+                self._bundleDiffs.append((keyName, data, diff))
+
+            full = sum(len(data) for (_, data, _) in self._bundleDiffs) >= theBundleSize
+
+        if full:
+            self._flushBundle()
+
+    def _flushBundle(self):
+        """ Store the small diffs and info waiting for a bundle, and the bundle's index.
+
+        Then delete their own keys.
+        """
+        with self._lock:
+            (diffs, infos) = (self._bundleDiffs, self._bundleInfos)
+            (self._bundleDiffs, self._bundleInfos) = ([], [])
+
+        if not diffs and not infos:
+            return
+
+        name = self._prefix + theBundleDir + uuid.uuid4().hex
+        (bundleName, indexName) = (name + theBundleExtension, name + theIndexExtension)
+
+        self._changing(indexName)
+
+        index = dict(version=theIndexVersion, diffs=[], infos=infos)
+        offset = 0
+
+        for (keyName, data, diff) in diffs:
+            index['diffs'].append((keyName, offset, len(data), diff.toGen))
+            offset += len(data)
+
+        if diffs:
+            key = self.bucket.new_key(bundleName)
+            key.set_contents_from_string(
+                b"".join(data for (_, data, _) in diffs), encrypt_key=isEncrypted,
+            )
+
+        key = self.bucket.new_key(indexName)
+        key.set_contents_from_string(json.dumps(index), encrypt_key=isEncrypted)
+
+        logger.info(
+            "Stored %d diffs (%s) and %d infos in %s",
+            len(diffs), humanize(offset), len(infos), bundleName,
+        )
+
+        for ((keyName, offset, size, toGen), (_, _, diff)) in zip(index['diffs'], diffs):
+            self.bundled[keyName] = (bundleName, offset, size)
+            self._stored(keyName, diff, write=False)
+
+        self._stored(indexName)
+
+        # They're safe in the bundle now
+        keyNames = [keyName for (keyName, _, _) in diffs] + [keyName for (keyName, _) in infos]
+        self._changing(*keyNames)
+
+        result = self.bucket.delete_keys(keyNames, quiet=True)
+        for error in result.errors:
+            logger.error("Can't delete %s (%s: %s)", error.key, error.code, error.message)
+
+        self._changed(*keyNames)
+        self._writeManifest()
+
+    theKeyPattern = "^(?P<fullpath>.*)/(?P<to>[-a-zA-Z0-9]*)_(?P<from>[-a-zA-Z0-9]*)$"
+
+    def _keyName(self, toUUID, fromUUID, path):
+        return "%s/%s_%s" % (self._fullPath(path).lstrip("/"), toUUID, fromUUID)
+
+    def _parseKeyName(self, name):
+        """ Returns dict with fullpath, to, from. """
+        name = self._unshard(name)
+
+        if name.endswith(Store.theInfoExtension):
+            return {'type': 'info'}
+
+        if name.endswith(theBundleExtension):
+            return {'type': 'bundle'}
+
+        if name.endswith(theIndexExtension):
+            return {'type': 'index'}
+
+        (keyType, size) = ('diff', None)
+        if name.endswith(theRecipeExtension):
+            (name, keyType) = (name[:-len(theRecipeExtension)], 'recipe')
+
+            (base, _, sizeName) = name.rpartition(".")
+            if base and sizeName.isdigit():
+                (name, size) = (base, int(sizeName))
+
+        match = self.keyPattern.match(name)
+        if not match:
+            return None
+
+        match = match.groupdict()
+        match.update(type=keyType, size=size)
+
+        return match
+
+    def send(self, diff, streamVersion=1):
+        """ Write the diff (toVol from fromVol) to the stream context manager.
+
+        The stored stream is sent as-is, whatever its version.
+        """
+        keyName = self.diffKeys[diff]
+        key = None if keyName in self.bundled else self.bucket.get_key(keyName)
+
+        if self._skipDryRun(logger)("send %s in %s", keyName, self):
+            return None
+
+        progress = _BotoProgress(diff.size) if self.showProgress is True else None
+
+        if diff in self.recipes:
+            return _ChunkDownloader(self._connect, key, self.dedupWorkers, progress)
+
+        if keyName in self.bundled:
+            (bundleName, offset, size) = self.bundled[keyName]
+            return _Downloader(self.bucket.new_key(bundleName), progress, offset, size)
+
+        return _Downloader(key, progress)
+
+    def keep(self, diff):
+        """ Mark this diff (or volume) to be kept in path. """
+        path = self.extraKeys[diff]
+
+        if not path.startswith("/"):
+            logger.debug("Keeping %s", path)
+            del self.extraKeys[diff]
+            return
+
+        # Copy into self.userPath, if not there already
+
+        keyName = self.diffKeys[diff]
+        newPath = os.path.join(self.userPath, os.path.basename(path))
+        newName = self._diffKeyName(diff, newPath)
+
+        if not self._skipDryRun(logger)("Copy %s to %s", keyName, newName):
+            # Copied along with the others, when we're done
+            self._keeps.append((newName, keyName, diff))
+
+    def _copyKept(self):
+        """ Copy the diffs scheduled by keep, several at once. """
+        keeps = {newName: (keyName, diff) for (newName, keyName, diff) in self._keeps}
+        self._keeps = []
+
+        if not keeps:
+            return
+
+        logger.info("Copying %d kept diffs", len(keeps))
+
+        self._changing(*keeps)
+
+        # { newName: data } of bundled diffs, which are copied by themselves
+        rebundled = {}
+
+        def copy(bucket, newName):
+            (keyName, diff) = keeps[newName]
+
+            if keyName in self.bundled:
+                (bundleName, offset, size) = self.bundled[keyName]
+                data = _Downloader(bucket.new_key(bundleName), None, offset, size).read()
+
+                bucket.new_key(newName).set_contents_from_string(data, encrypt_key=isEncrypted)
+                rebundled[newName] = data
+                return
+
+            self._copyObject(bucket, newName, keyName, self._objectSize(diff))
+
+        errors = self._forEach(copy, keeps.keys(), self.copyWorkers)
+
+        for (newName, (keyName, diff)) in keeps.items():
+            if newName in errors:
+                logger.error("Can't copy %s to %s (%s)", keyName, newName, errors[newName])
+                self._changed(newName)
+                continue
+
+            self._stored(newName, diff, write=False)
+
+            if newName in rebundled and self.bundling:
+                self._addToBundle(newName, rebundled[newName], diff)
+
+        self._writeManifest()
+
+    def _copyObject(self, bucket, newName, keyName, size, fromBucket=None):
+        """ Copy an object into the bucket, in parallel parts if it's large.
+
+        fromBucket is the name of the bucket to copy from, if it isn't this one.
+        """
+        fromBucket = fromBucket or bucket.name
+
+        if size is None or size <= theCopyPartSize:
+            bucket.copy_key(newName, fromBucket, keyName, encrypt_key=isEncrypted)
+            return
+
+        partSize = max(theCopyPartSize, -(-size // theMaxParts))
+
+        # (part number, first byte, last byte)
+        parts = [
+            (number + 1, start, min(start + partSize, size) - 1)
+            for (number, start) in enumerate(xrange(0, size, partSize))
+        ]
+
+        upload = bucket.initiate_multipart_upload(newName, encrypt_key=isEncrypted)
+
+        def copyPart(bucket, part):
+            # The upload, over this thread's connection
+            partUpload = boto.s3.multipart.MultiPartUpload(bucket)
+            (partUpload.key_name, partUpload.id) = (upload.key_name, upload.id)
+
+            (number, start, end) = part
+            partUpload.copy_part_from_key(fromBucket, keyName, number, start, end)
+
+        logger.debug("Copying %s to %s in %d parts", keyName, newName, len(parts))
+
+        errors = self._forEach(copyPart, parts, self.copyWorkers)
+
+        if errors:
+            upload.cancel_upload()
+            raise errors.values()[0]
+
+        upload.complete_upload()
+
+    def _open(self):
+        """ Check that unused diffs can be trashed, before transferring any. """
+        if self.mode != 'w' or self.dryrun:
+            return
+
+        if self.dedup:
+            # Recipes anywhere in the bucket may share a chunk, so trashing never frees them
+            raise Exception("Can't delete unused diffs while storing shared chunks in %s" % (
+                self,
+            ))
+
+        if self.trashMode != 'tag':
+            return
+
+        if self.bucket.get_versioning_status().get('Versioning') != 'Enabled':
+            # Deleting tagged keys from an unversioned bucket would delete them for good
+            raise Exception("Can't trash diffs with tags, because %s isn't versioned" % (self, ))
+
+    def _close(self):
+        """ Finish scheduled copies, store the last bundle, and close our change key. """
+        self._copyKept()
+        self._flushBundle()
+        self._closeChanges()
+
+    def deleteUnused(self):
+        """ Delete any old snapshots in path, if not kept. """
+        self._copyKept()
+
+        (count, size, recipes) = (0, 0, 0)
+        (keyNames, infoNames) = ({}, set())
+
+        # { bundleName: {keyName} }
+        bundled = collections.defaultdict(set)
+
+        for (diff, path) in self.extraKeys.items():
+            if path.startswith("/"):
+                continue
+
+            keyName = self.diffKeys[diff]
+
+            count += 1
+            size += diff.size
+
+            if diff in self.recipes:
+                recipes += 1
+
+            if self._skipDryRun(logger, 'INFO')("Trash: %s", diff):
+                continue
+
+            if keyName in self.bundled:
+                bundled[self.bundled[keyName][0]].add(keyName)
+                continue
+
+            keyNames[keyName] = self._objectSize(diff)
+            infoNames.add(self._infoKeyName(keyName))
+
+        changes = list(keyNames) + list(bundled)
+        self._changing(*changes)
+
+        unbundled = self._unbundle(bundled, keyNames)
+
+        if keyNames:
+            trashed = self._trash(keyNames, infoNames)
+        else:
+            trashed = []
+
+        if self.manifest is not None:
+            for keyName in trashed + unbundled:
+                self.manifest.pop(keyName, None)
+
+        for keyName in unbundled:
+            del self.bundled[keyName]
+
+        self._changed(*changes)
+
+        if keyNames or unbundled:
+            self._writeManifest()
+
+        logger.info("Trashed %d diffs (%s)", count, humanize(size))
+
+        if recipes:
+            logger.warn("Trashed %d deduplicated diffs' recipes, but not their chunks", recipes)
+
+    def migrateShards(self):
+        """ Move the diffs under path into hashed shards, and shard new keys from now on.
+
+        Objects are copied first, then the manifest is updated, then the old keys are deleted.
+        """
+        if self.mode != 'w':
+            raise Exception("Can't move keys in %s, because it isn't opened for deletes" % (self, ))
+
+        # Scheduled copies and bundles read or replace the old keys
+        self._copyKept()
+        self._flushBundle()
+
+        self.sharded = True
+
+        # { newName: (keyName, size) }
+        moves = {}
+        infoNames = set()
+        moved = {}
+
+        for (diff, path) in self.extraKeys.items():
+            keyName = self.diffKeys[diff]
 
-    def __str__(self):
-        """ Return text description. """
-        return unicode(self).encode('utf-8')
+            if path.startswith("/") or keyName in self.bundled:
+                # Not ours, or already spread out in bundles
+                continue
 
-    def _flushPartialUploads(self, dryrun):
-        for upload in self.bucket.list_multipart_uploads():
-            # logger.debug("Upload: %s", upload.__dict__)
-            # for part in upload:
-                # logger.debug("  Part: %s", part.__dict__)
+            newName = self._shard(self._unshard(keyName))
 
-            if not upload.key_name.startswith(self.userPath.lstrip("/")):
+            if newName == keyName:
                 continue
 
-            if self._skipDryRun(logger, 'INFO', dryrun)(
-                "Delete old partial upload: %s (%d parts)",
-                upload,
-                len([part for part in upload]),
-            ):
+            if self._skipDryRun(logger, 'INFO')("Move %s to %s", keyName, newName):
                 continue
 
-            upload.cancel_upload()
+            moves[newName] = (keyName, self._objectSize(diff))
+            moved[diff] = newName
 
-    def _fillVolumesAndPaths(self, paths):
-        """ Fill in paths.
+            infoName = self._infoKeyName(keyName)
+            if infoName not in infoNames:
+                infoNames.add(infoName)
+                moves[_shardKey(self._prefix, infoName)] = (infoName, None)
 
-        :arg paths: = { Store.Volume: ["linux path",]}
-        """
-        self.diffs = collections.defaultdict((lambda: []))
-        self.extraKeys = {}
+        logger.info("Moving %d diffs into shards", len(moved))
 
-        for key in self.bucket.list():
-            if key.name.startswith(theTrashPrefix):
-                continue
+        if not moves:
+            self._writeManifest()
+            return
 
-            keyInfo = self._parseKeyName(key.name)
+        self._changing(*moves)
 
-            if keyInfo is None:
-                if key.name[-1:] != '/':
-                    logger.warning("Ignoring '%s' in S3", key.name)
-                continue
+        def copy(bucket, newName):
+            (keyName, size) = moves[newName]
+            self._copyObject(bucket, newName, keyName, size)
 
-            if keyInfo['type'] == 'info':
-                stream = io.BytesIO()
-                key.get_contents_to_file(stream)
-                Store.Volume.readInfo(stream)
+        errors = self._forEach(copy, moves.keys(), self.copyWorkers)
+
+        for (newName, error) in errors.items():
+            (keyName, size) = moves[newName]
+            if keyName in infoNames and getattr(error, 'status', None) == 404:
                 continue
+            logger.error("Can't move %s to %s (%s)", keyName, newName, error)
 
-            if keyInfo['from'] == 'None':
-                keyInfo['from'] = None
+        for (diff, newName) in moved.items():
+            if newName in errors:
+                continue
 
-            path = self._relativePath("/" + keyInfo['fullpath'])
+            keyName = self.diffKeys[diff]
+            self.diffKeys[diff] = newName
 
-            if path is None:
-                continue
+            if self.manifest is not None and keyName in self.manifest:
+                self.manifest[newName] = self.manifest.pop(keyName)
+                self._stored(newName, write=False)
 
-            diff = Store.Diff(self, keyInfo['to'], keyInfo['from'], key.size)
+        self._writeManifest()
 
-            logger.debug("Adding %s in %s", diff, path)
+        deletes = [moves[newName][0] for newName in moves if newName not in errors]
+        result = self.bucket.delete_keys(deletes, quiet=True)
 
-            self.diffs[diff.fromVol].append(diff)
-            paths[diff.toVol].append(path)
+        for error in result.errors:
+            logger.error("Can't delete %s (%s: %s)", error.key, error.code, error.message)
 
-            self.extraKeys[diff] = path
+        self._changed(*moves)
+        self._writeManifest()
 
-        # logger.debug("Diffs:\n%s", pprint.pformat(self.diffs))
-        # logger.debug("Vols:\n%s", pprint.pformat(self.vols))
-        # logger.debug("Extra:\n%s", (self.extraKeys))
+    def _unbundle(self, bundled, keyNames):
+        """ Drop diffs from their bundles' indexes, and return the dropped diffs' keys.
 
-    def listContents(self):
-        """ Return list of volumes or diffs in this Store's selected directory. """
-        items = list(self.extraKeys.items())
-        items.sort(key=lambda t: t[1])
+        bundled is { bundleName: {keyName} }.
+        Bundles left empty are added to keyNames { keyName: size }, to be trashed,
+        after their other info is stored by itself.
+        Other bundles keep their data, until all their diffs are unused.
+        """
+        unbundled = []
 
-        (count, size) = (0, 0)
+        for (bundleName, names) in bundled.items():
+            key = self.bucket.new_key(bundleName[:-len(theBundleExtension)] + theIndexExtension)
 
-        for (diff, path) in items:
-            if path.startswith("/"):
+            try:
+                index = _readIndex(key)
+            except Exception as error:
+                logger.error("Can't read %s (%s)", key.name, error)
                 continue
-            yield str(diff)
-            count += 1
-            size += diff.size
 
-        yield "TOTAL: %d diffs %s" % (count, humanize(size))
+            index['diffs'] = [entry for entry in index['diffs'] if entry[0] not in names]
 
-    def getEdges(self, fromVol):
-        """ Return the edges available from fromVol. """
-        return self.diffs[fromVol]
+            # Info goes with its diffs, as it does for diffs stored by themselves
+            infoNames = {self._infoKeyName(keyName) for keyName in names}
+            index['infos'] = [entry for entry in index['infos'] if entry[0] not in infoNames]
 
-    def hasEdge(self, diff):
-        """ Test whether edge is in this sink. """
-        return diff.toVol in [d.toVol for d in self.diffs[diff.fromVol]]
+            if index['diffs']:
+                key.set_contents_from_string(json.dumps(index), encrypt_key=isEncrypted)
+            else:
+                for (infoName, info) in index['infos']:
+                    # Still used by other snapshots' diffs, so keep it by itself
+                    info = info.encode('utf-8')
+                    infoKey = self.bucket.new_key(infoName)
+                    infoKey.set_contents_from_string(info, encrypt_key=isEncrypted)
 
-    def measureSize(self, diff, chunkSize):
-        """ Spend some time to get an accurate size. """
-        logger.warn("Don't need to measure S3 diffs")
+                    if self.bundling:
+                        self._addToBundle(infoName, info)
 
-    def receive(self, diff, paths):
-        """ Return Context Manager for a file-like (stream) object to store a diff. """
-        path = self.selectReceivePath(paths)
-        keyName = self._keyName(diff.toUUID, diff.fromUUID, path)
+                keyNames[bundleName] = None
+                keyNames[key.name] = None
 
-        if self._skipDryRun(logger)("receive %s in %s", keyName, self):
-            return None
+            unbundled.extend(names)
 
-        progress = _BotoProgress(diff.size) if self.showProgress is True else None
-        return _Uploader(self.bucket, keyName, progress)
+        return unbundled
 
-    def receiveVolumeInfo(self, paths):
-        """ Return Context Manager for a file-like (stream) object to store volume info. """
-        path = self.selectReceivePath(paths)
-        path = path + Store.theInfoExtension
+    def _trash(self, keyNames, infoNames):
+        """ Trash diff keys, and info keys if they exist.  Returns the trashed keys.
 
-        if self._skipDryRun(logger)("receive info in '%s'", path):
-            return None
+        keyNames is { keyName: size }.
+        """
+        if self.trashMode == 'tag':
+            action = self._tagKey
+        else:
+            def action(bucket, keyName):
+                self._copyObject(bucket, theTrashPrefix + keyName, keyName, keyNames.get(keyName))
 
-        return _Uploader(self.bucket, path, bufferSize=theInfoBufferSize)
+        errors = self._forEach(action, list(keyNames) + list(infoNames), theTrashWorkers)
 
-    theKeyPattern = "^(?P<fullpath>.*)/(?P<to>[-a-zA-Z0-9]*)_(?P<from>[-a-zA-Z0-9]*)$"
+        for (keyName, error) in errors.items():
+            if keyName in infoNames and getattr(error, 'status', None) == 404:
+                continue
+            logger.error("Can't trash %s (%s)", keyName, error)
 
-    def _keyName(self, toUUID, fromUUID, path):
-        return "%s/%s_%s" % (self._fullPath(path).lstrip("/"), toUUID, fromUUID)
+        failed = set(errors.keys())
+        deletes = [keyName for keyName in list(keyNames) + list(infoNames) if keyName not in failed]
 
-    def _parseKeyName(self, name):
-        """ Returns dict with fullpath, to, from. """
-        if name.endswith(Store.theInfoExtension):
-            return {'type': 'info'}
+        if deletes:
+            # Multi-object delete, up to 1000 keys per request
+            result = self.bucket.delete_keys(deletes, quiet=True)
 
-        match = self.keyPattern.match(name)
-        if not match:
-            return None
+            for error in result.errors:
+                logger.error("Can't delete %s (%s: %s)", error.key, error.code, error.message)
+                failed.add(error.key)
 
-        match = match.groupdict()
-        match.update(type='diff')
+        return [keyName for keyName in keyNames if keyName not in failed]
 
-        return match
+    def _forEach(self, action, items, workers):
+        """ Call action(bucket, item) for each item, in a pool of threads.
 
-    def send(self, diff):
-        """ Write the diff (toVol from fromVol) to the stream context manager. """
-        path = self._fullPath(self.extraKeys[diff])
-        keyName = self._keyName(diff.toUUID, diff.fromUUID, path)
-        key = self.bucket.get_key(keyName)
+        Each thread has its own bucket connection.
+        Returns { item: error } for the items that failed.
+        """
+        queue = Queue.Queue()
+        for item in items:
+            queue.put(item)
+
+        errors = {}
+
+        def work():
+            bucket = self._connect(validate=False)
+
+            while True:
+                try:
+                    item = queue.get_nowait()
+                except Queue.Empty:
+                    return
+
+                try:
+                    action(bucket, item)
+                except Exception as error:
+                    errors[item] = error
+
+        workers = [
+            threading.Thread(target=work, name="S3 worker")
+            for _ in range(min(workers, len(items)))
+        ]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        return errors
 
-        if self._skipDryRun(logger)("send %s in %s", keyName, self):
-            return None
+    @staticmethod
+    def _tagKey(bucket, keyName):
+        """ Tag a key for a lifecycle rule to expire (boto has no tagging API). """
+        headers = {
+            'Content-MD5': base64.b64encode(hashlib.md5(theTrashTagging).digest()),
+            'Content-Type': 'application/xml',
+        }
+
+        response = bucket.connection.make_request(
+            'PUT', bucket.name, keyName,
+            headers=headers, query_args='tagging', data=theTrashTagging,
+        )
+        body = response.read()
 
-        progress = _BotoProgress(diff.size) if self.showProgress is True else None
-        return _Downloader(key, progress)
+        if response.status != 200:
+            raise bucket.connection.provider.storage_response_error(
+                response.status, response.reason, body,
+            )
 
-    def keep(self, diff):
-        """ Mark this diff (or volume) to be kept in path. """
-        path = self.extraKeys[diff]
+    def deletePartials(self):
+        """ Delete any old partial uploads/downloads in path. """
+        self._flushPartialUploads(self.dryrun)
 
-        if not path.startswith("/"):
-            logger.debug("Keeping %s", path)
-            del self.extraKeys[diff]
-            return
 
-        # Copy into self.userPath, if not there already
+def _roundPartSize(size):
+    """ Return size rounded up to whole MB, within S3's part size limits. """
+    size = -(-size // (1 << 20)) * (1 << 20)
+    return max(theMinPartSize, min(size, theMaxPartSize))
 
-        keyName = self._keyName(diff.toUUID, diff.fromUUID, path)
-        newPath = os.path.join(self.userPath, os.path.basename(path))
-        newName = self._keyName(diff.toUUID, diff.fromUUID, newPath)
 
-        if not self._skipDryRun(logger)("Copy %s to %s", keyName, newName):
-            self.bucket.copy_key(newName, self.bucket.name, keyName)
+def _shardKey(prefix, keyName):
+    """ Return keyName under prefix, moved into its shard. """
+    rest = keyName[len(prefix):]
+    shard = theShardFormat % (hashlib.md5(rest).hexdigest()[:theShardDigits], )
+    return "%s%s/%s" % (prefix, shard, rest)
 
-    def deleteUnused(self):
-        """ Delete any old snapshots in path, if not kept. """
-        (count, size) = (0, 0)
 
-        for (diff, path) in self.extraKeys.items():
-            if path.startswith("/"):
-                continue
+def _recipeName(keyName, size):
+    """ Return the key of the recipe for a diff's key, with the diff's size. """
+    return "%s.%d%s" % (keyName, size, theRecipeExtension)
 
-            keyName = self._keyName(diff.toUUID, diff.fromUUID, path)
 
-            count += 1
-            size += diff.size
+def _readIndex(key):
+    """ Return the index of a bundle, as { diffs: [(keyName, offset, size, toGen)], infos }. """
+    index = json.loads(key.get_contents_as_string())
 
-            if self._skipDryRun(logger, 'INFO')("Trash: %s", diff):
-                continue
+    if index.get('version') != theIndexVersion:
+        raise Exception("Can't read %s (index version %s)" % (key.name, index.get('version')))
 
-            try:
-                self.bucket.copy_key(theTrashPrefix + keyName, self.bucket.name, keyName)
-                self.bucket.delete_key(keyName)
-            except boto.exception.S3ResponseError as error:
-                logger.error("%s: %s", error.code, error.message)
+    return index
 
-            try:
-                keyName = os.path.dirname(keyName) + Store.theInfoExtension
-                self.bucket.copy_key(theTrashPrefix + keyName, self.bucket.name, keyName)
-                self.bucket.delete_key(keyName)
-            except boto.exception.S3ResponseError as error:
-                logger.debug("%s: %s", error.code, error.message)
 
-        logger.info("Trashed %d diffs (%s)", count, humanize(size))
+def _readRecipe(key):
+    """ Return the recipe of a deduplicated diff, as { size, chunks: [(name, size)] }. """
+    recipe = json.loads(key.get_contents_as_string())
 
-    def deletePartials(self):
-        """ Delete any old partial uploads/downloads in path. """
-        self._flushPartialUploads(self.dryrun)
+    if recipe.get('version') != theRecipeVersion:
+        raise Exception("Can't read %s (recipe version %s)" % (key.name, recipe.get('version')))
+
+    return recipe
 
 
 class _BotoProgress(progress.DisplayProgress):
@@ -308,11 +1499,16 @@ class _BotoProgress(progress.DisplayProgress):
 
 class _Downloader(io.RawIOBase):
 
-    def __init__(self, key, progress=None):
+    def __init__(self, key, progress=None, start=0, size=None):
         self.progress = progress
         self.key = key
         self.mark = 0
 
+        # Range of the key to read, or all of it
+        self.whole = size is None
+        self.start = start
+        self.size = key.size if size is None else size
+
     def __enter__(self):
         if self.progress:
             self.progress.__enter__()
@@ -323,13 +1519,18 @@ class _Downloader(io.RawIOBase):
             self.progress.__exit__(exceptionType, exceptionValue, traceback)
 
     def read(self, n=-1):
-        if self.mark >= self.key.size or n == 0:
+        if self.mark >= self.size or n == 0:
             return b''
 
         if n < 0:
+            n = self.size - self.mark
+
+        if self.whole and self.mark == 0 and n >= self.size:
             headers = None
         else:
-            headers = {"Range": "bytes=%s-%s" % (self.mark, self.mark + n - 1)}
+            start = self.start + self.mark
+            end = start + min(n, self.size - self.mark) - 1
+            headers = {"Range": "bytes=%s-%s" % (start, end)}
 
         if self.progress is None:
             data = self.key.get_contents_as_string(
@@ -355,8 +1556,12 @@ class _Downloader(io.RawIOBase):
 
 class _Uploader(io.RawIOBase):
 
-    def __init__(self, bucket, keyName, progress=None, bufferSize=None):
+    def __init__(
+        self, bucket, keyName, progress=None, bufferSize=None, onComplete=None,
+        size=None, sizeIsEstimated=False, partSize=thePartSize, simple=False, bundle=None,
+    ):
         self.progress = progress
+        self.onComplete = onComplete
         self.bucket = bucket
         self.keyName = keyName.lstrip("/")
         self.uploader = None
@@ -367,6 +1572,44 @@ class _Uploader(io.RawIOBase):
         self.bufferSize = bufferSize
         self.exception = None
 
+        # Expected size of the upload, and bytes uploaded (or skipped) so far
+        self.size = size
+        self.sizeIsEstimated = sizeIsEstimated
+        self.sent = 0
+
+        # Small diffs don't need a whole default part
+        expected = (size or 0) * (theEstimateMargin if sizeIsEstimated else 1)
+        if size:
+            partSize = min(partSize, _roundPartSize(expected))
+        self.partSize = partSize
+
+        # Small uploads are buffered for a single PUT, unless they grow too large
+        self.simple = simple or (size is not None and expected <= theSimplePutSize)
+        self.pending = None
+
+        # bundle(data) packs an upload that stays small into a bundle, once it's stored
+        self.bundle = bundle
+
+    @property
+    def chunkSize(self):
+        """ Size for the next part, read by Store.transfer before each part. """
+        part = self.parts[self.chunkCount or 0]
+
+        if part is not None:
+            # Resume with the same parts as before
+            return part[0]
+
+        # Grow the parts enough for the rest to fit in the parts left
+        partsUsed = self.chunkCount or 0
+        expected = (self.size or 0) * (theEstimateMargin if self.sizeIsEstimated else 1)
+
+        # Streams can be longer than expected, so assume at least as much again as sent
+        remaining = max(expected - self.sent, self.sent)
+        partsLeft = max(theMaxParts - partsUsed, 1)
+
+        self.partSize = max(self.partSize, _roundPartSize(-(-remaining // partsLeft)))
+        return self.partSize
+
     def __enter__(self):
         self.open()
         if self.progress:
@@ -378,7 +1621,7 @@ class _Uploader(io.RawIOBase):
             return self
 
     def open(self):
-        if self.uploader is not None:
+        if self.uploader is not None or self.pending is not None:
             logger.warning(
                 "Ignoring double open%s",
                 _displayTraceBack(),
@@ -390,6 +1633,10 @@ class _Uploader(io.RawIOBase):
         self.chunkCount = 0
         self.parts = util.DefaultList()
 
+        if self.simple:
+            self.pending = []
+            return
+
         for upload in self.bucket.list_multipart_uploads():
             if upload.key_name != self.keyName:
                 continue
@@ -405,6 +1652,9 @@ class _Uploader(io.RawIOBase):
             self.uploader = upload
             return
 
+        self._initiate()
+
+    def _initiate(self):
         self.uploader = self.bucket.initiate_multipart_upload(
             self.keyName,
             encrypt_key=isEncrypted,
@@ -443,6 +1693,7 @@ class _Uploader(io.RawIOBase):
             return False
 
         self.chunkCount += 1
+        self.sent += chunkSize
 
         logger.info(
             "Skipping already uploaded %s chunk #%d",
@@ -456,9 +1707,25 @@ class _Uploader(io.RawIOBase):
         if len(bytes) == 0:
             logger.debug("Ignoring empty upload request.")
             return 0
-        return self.upload(bytes)
+
+        if self.pending is None:
+            return self.upload(bytes)
+
+        self.pending.append(memoryview(bytes).tobytes())
+
+        if sum(len(data) for data in self.pending) > theSimplePutSize:
+            logger.debug("Switching to a multipart upload")
+            (data, self.pending) = (b"".join(self.pending), None)
+            self._initiate()
+            self.upload(data)
+
+        return len(bytes)
 
     def close(self):
+        if self.pending is not None:
+            self._put()
+            return
+
         if self.uploader is None:
             logger.debug(
                 "Ignoring double close%s",
@@ -472,6 +1739,8 @@ class _Uploader(io.RawIOBase):
 
         if self.exception is None:
             self.uploader.complete_upload()
+            if self.onComplete is not None:
+                self.onComplete()
             # You cannot change metadata after uploading
             # if self.metadata:
             #     key = self.bucket.get_key(self.keyName)
@@ -484,6 +1753,34 @@ class _Uploader(io.RawIOBase):
 
         self.uploader = None
 
+    def _put(self):
+        """ Store a small upload with a single PUT, then add it to a bundle if it's small. """
+        (data, self.pending) = (b"".join(self.pending), None)
+
+        if self.exception is not None:
+            return
+
+        self.sent += len(data)
+
+        key = self.bucket.new_key(self.keyName)
+        key.update_metadata(self.metadata)
+
+        if self.progress is None:
+            key.set_contents_from_string(data, encrypt_key=isEncrypted)
+        else:
+            cb = _BotoProgress(len(data), "PUT", self.progress)
+
+            with cb:
+                key.set_contents_from_string(
+                    data, encrypt_key=isEncrypted, **_BotoProgress.botoArgs(cb)
+                )
+
+        if self.onComplete is not None:
+            self.onComplete()
+
+        if self.bundle is not None and len(data) <= theBundledSize:
+            self.bundle(data)
+
     def fileno(self):
         raise IOError("S3 uploads don't use file numbers.")
 
@@ -497,6 +1794,7 @@ class _Uploader(io.RawIOBase):
         self.chunkCount += 1
         size = len(bytes)
         fileObject = io.BytesIO(bytes)
+        self.sent += size
 
         if self.progress is None:
             self.uploader.upload_part_from_file(
@@ -515,3 +1813,272 @@ class _Uploader(io.RawIOBase):
                 )
 
         return size
+
+
+class _ChunkUploader(object):
+
+    """ Stores a stream as deduplicated chunks, then a recipe listing them.
+
+    Chunks already in the bucket aren't uploaded again.
+    """
+
+    def __init__(self, connect, nameRecipe, workers, knownChunks, progress=None, onComplete=None):
+        """ Initialize.
+
+        nameRecipe(size) returns the recipe's key, and onComplete(keyName) is called once
+        the recipe is stored.
+        """
+        self.connect = connect
+        self.nameRecipe = nameRecipe
+        self.keyName = None
+        self.workers = workers
+        self.knownChunks = knownChunks
+        self.progress = progress
+        self.onComplete = onComplete
+
+        # [(chunkName, size)] in the recipe
+        self.chunks = []
+        self.size = 0
+
+        # Bytes in new chunks
+        self.stored = 0
+
+        self.chunker = None
+        self.errors = []
+        self._lock = threading.Lock()
+        self._jobs = None
+        self._threads = []
+        self._queued = set()
+
+    def __enter__(self):
+        self.chunker = dedup.Chunker()
+
+        # Bounded, so the stream waits for slow uploads
+        self._jobs = Queue.Queue(2 * self.workers)
+
+        self._threads = [
+            threading.Thread(target=self._work, name="S3 chunk uploader")
+            for _ in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+        if self.progress:
+            self.progress.__enter__()
+
+        return self
+
+    def __exit__(self, exceptionType, exceptionValue, traceback):
+        try:
+            if exceptionType is None:
+                chunk = self.chunker.close()
+                if chunk is not None:
+                    self._add(chunk)
+
+            for _ in self._threads:
+                self._jobs.put(None)
+            for thread in self._threads:
+                thread.join()
+
+            if exceptionType is None:
+                if self.errors:
+                    raise self.errors[0]
+                self._writeRecipe()
+        finally:
+            if self.progress:
+                self.progress.__exit__(exceptionType, exceptionValue, traceback)
+
+        return False  # Don't suppress exception
+
+    def write(self, data):
+        for chunk in self.chunker.feed(data):
+            self._add(chunk)
+        return len(data)
+
+    def _add(self, chunk):
+        if self.errors:
+            raise self.errors[0]
+
+        name = dedup.chunkName(chunk)
+        self.chunks.append((name, len(chunk)))
+        self.size += len(chunk)
+
+        if name not in self.knownChunks and name not in self._queued:
+            self._queued.add(name)
+            self._jobs.put((name, chunk))
+
+        if self.progress:
+            self.progress.update(self.size)
+
+    def _work(self):
+        bucket = self.connect(validate=False)
+
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+
+            (name, chunk) = job
+
+            try:
+                if bucket.get_key(theChunkPrefix + name) is None:
+                    key = bucket.new_key(theChunkPrefix + name)
+                    key.set_contents_from_string(chunk, encrypt_key=isEncrypted)
+
+                    with self._lock:
+                        self.stored += len(chunk)
+
+                self.knownChunks.add(name)
+            except Exception as error:
+                self.errors.append(error)
+
+    def _writeRecipe(self):
+        recipe = dict(version=theRecipeVersion, size=self.size, chunks=self.chunks)
+
+        self.keyName = self.nameRecipe(self.size)
+        key = self.connect(validate=False).new_key(self.keyName)
+        key.set_contents_from_string(json.dumps(recipe), encrypt_key=isEncrypted)
+
+        logger.info(
+            "Stored %s in %d chunks, with %s in new chunks",
+            humanize(self.size), len(self.chunks), humanize(self.stored),
+        )
+
+        if self.onComplete is not None:
+            self.onComplete(self.keyName)
+
+
+class _ChunkFetch(object):
+
+    """ One chunk, downloaded by a worker. """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.data = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class _ChunkDownloader(object):
+
+    """ Reads a deduplicated diff, fetching the next chunks in parallel. """
+
+    def __init__(self, connect, key, workers, progress=None):
+        self.connect = connect
+        self.key = key
+        self.workers = workers
+        self.progress = progress
+
+        self.sent = 0
+        self._chunks = None
+        self._pending = collections.deque()
+        self._jobs = Queue.Queue()
+        self._threads = []
+
+        # Current chunk, and bytes read from it
+        self._data = None
+        self._offset = 0
+
+    def __enter__(self):
+        self._chunks = collections.deque(_readRecipe(self.key)['chunks'])
+
+        self._threads = [
+            threading.Thread(target=self._work, name="S3 chunk downloader")
+            for _ in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+        self._fetchAhead()
+
+        if self.progress:
+            self.progress.__enter__()
+
+        return self
+
+    def __exit__(self, exceptionType, exceptionValue, traceback):
+        self._pending.clear()
+        self._chunks.clear()
+
+        # Drop fetches that haven't started
+        try:
+            while True:
+                self._jobs.get_nowait()
+        except Queue.Empty:
+            pass
+
+        for _ in self._threads:
+            self._jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+
+        if self.progress:
+            self.progress.__exit__(exceptionType, exceptionValue, traceback)
+
+        return False  # Don't suppress exception
+
+    def read(self, n=-1):
+        """ Return the next n bytes (or all the rest), from as many chunks as it takes. """
+        pieces = []
+
+        while n != 0:
+            if self._data is None:
+                if not self._pending:
+                    break
+
+                fetch = self._pending.popleft()
+                self._fetchAhead()
+                fetch.done.wait()
+
+                if fetch.error is not None:
+                    raise fetch.error
+
+                (self._data, self._offset) = (fetch.data, 0)
+
+            size = len(self._data) - self._offset if n < 0 else n
+            piece = self._data[self._offset:self._offset + size]
+            pieces.append(piece)
+            self._offset += len(piece)
+
+            if n > 0:
+                n -= len(piece)
+
+            if self._offset >= len(self._data):
+                self._data = None
+
+        data = b"".join(pieces)
+
+        self.sent += len(data)
+        if self.progress:
+            self.progress.update(self.sent)
+
+        return data
+
+    def _fetchAhead(self):
+        while self._chunks and len(self._pending) < 2 * self.workers:
+            fetch = _ChunkFetch(*self._chunks.popleft())
+            self._pending.append(fetch)
+            self._jobs.put(fetch)
+
+    def _work(self):
+        bucket = self.connect(validate=False)
+
+        while True:
+            fetch = self._jobs.get()
+            if fetch is None:
+                return
+
+            try:
+                data = bucket.new_key(theChunkPrefix + fetch.name).get_contents_as_string()
+
+                if len(data) != fetch.size or dedup.chunkName(data) != fetch.name:
+                    raise Exception("Chunk %s%s is corrupt" % (theChunkPrefix, fetch.name))
+
+                fetch.data = data
+            except Exception as error:
+                fetch.error = error
+
+            fetch.done.set()
@@ -4,10 +4,17 @@ Copyright (c) 2014-2015 Ames Cornish.  All rights reserved.  Licensed under GPLv
 """
 
 from progress import DisplayProgress
+import BestDiffs
 import ButterStore
+import bulk
+import compress
+import mux
+import send
+import splice
 import Store
 import version
 
+import collections
 import io
 import json
 import logging
@@ -15,6 +22,8 @@ import os.path
 import platform
 import subprocess
 import sys
+import threading
+import time
 import traceback
 import urllib
 
@@ -25,6 +34,27 @@ DEVNULL = open(os.devnull, 'wb')
 
 theVersion = version.version
 
+# Passed to a server stream that the client stopped early
+theCancelled = Exception("Stream cancelled by client")
+
+# Seconds between progress reports for direct transfers
+theProgressInterval = 0.5
+
+# Stores a server may reach for direct transfers
+theDirectSchemes = ("ssh://", "s3://")
+
+# ssh connections to a host share one master connection through this socket
+theControlPath = "~/.ssh/buttersink-%C"
+
+SSHOptions = collections.namedtuple('SSHOptions', (
+    'cipher',       # For ssh -c, or None for ssh's choice
+    'compress',     # True to compress everything
+    'keepalive',    # Seconds between ServerAlive checks, or None
+    'persist',      # Seconds to keep an idle master connection, or 0 to not share one
+))
+
+theSSHOptions = SSHOptions(cipher=None, compress=False, keepalive=None, persist=0)
+
 
 class _Obj2Arg:
 
@@ -97,6 +127,8 @@ class _Dict2Obj:
 
 class _SSHStream(io.RawIOBase):
 
+    """ Data stream to or from the remote server, one read or write command per chunk. """
+
     def __init__(self, client, progress=None):
         self._client = client
         self._open = True
@@ -185,6 +217,296 @@ class _SSHStream(io.RawIOBase):
         return data
 
 
+class _ChannelStream(io.RawIOBase):
+
+    """ Data stream to or from the remote server, over a multiplexed channel. """
+
+    def __init__(self, channel, progress=None, parser=None):
+        self._channel = channel
+        self._progress = progress
+        self._parser = parser  # Fixes up passthrough streams
+        self._writing = channel.result['direction'] == 'write'
+        self.totalSize = 0
+
+        # Received frame being read, and offset into it
+        self._frame = None
+        self._offset = 0
+        self._ended = False
+        self._finalResult = None
+
+        # Compresses or decompresses the data, if the server agreed to
+        codec = channel.result.get('codec')
+        self._encoder = compress.Encoder(channel.sendData) if codec and self._writing else None
+        self._decoder = compress.Decoder() if codec and not self._writing else None
+
+        if self._writing:
+            channel._addCredit(channel.result['credit'])
+
+    def __enter__(self):
+        if self._progress:
+            self._progress.__enter__()
+        return self
+
+    def __exit__(self, exceptionType, exception, trace):
+        if self._progress:
+            self._progress.__exit__(exceptionType, exception, trace)
+
+        if exceptionType is None and self._writing and self._parser is not None:
+            try:
+                self._parser.close()
+            except Exception:
+                self._finish(cancel=True)
+                raise
+
+        try:
+            result = self._finish(cancel=exceptionType is not None)
+        except Exception as error:
+            if exceptionType is None:
+                raise
+            logger.debug("Secondary error: %s", error)
+            return False
+
+        if exceptionType is None and result and 'error' in result:
+            raise Exception(result)
+
+        return False  # Don't supress exception
+
+    def write(self, data):
+        pieces = [data] if self._parser is None else self._parser.feed(data)
+
+        for piece in pieces:
+            self._sendData(piece)
+
+        self.totalSize += len(data)
+        if self._progress:
+            self._progress.update(self.totalSize)
+
+    def read(self, size):
+        pieces = []
+
+        while size > 0 and not self._ended:
+            if self._frame is None:
+                payload = self._receiveData()
+
+                if payload is None:
+                    self._ended = True
+                    break
+
+                (self._frame, self._offset) = (payload, 0)
+
+            piece = self._frame[self._offset:self._offset + size]
+            pieces.append(piece)
+            size -= len(piece)
+            self._offset += len(piece)
+
+            if self._offset == len(self._frame):
+                self._frame = None
+
+        data = "".join(pieces)
+
+        if self._parser is not None:
+            data = self._parser.parse(data)
+
+        self.totalSize += len(data)
+        if self._progress:
+            self._progress.update(self.totalSize)
+
+        if not data and self._ended:
+            result = self._finish()
+            if result and 'error' in result:
+                raise Exception(result)
+
+            if self._parser is not None:
+                self._parser.close()
+
+        return data
+
+    def _sendData(self, data):
+        if self._encoder is not None:
+            sent = self._encoder.write(data)
+        else:
+            sent = self._channel.sendData(data)
+
+        if not sent:
+            # The server stopped accepting data, and will report why
+            raise Exception(self._finish())
+
+    def _receiveData(self):
+        """ Return the next piece of data, or None at the end. """
+        (kind, payload) = self._channel.receive()
+
+        if kind != mux.DATA:
+            if kind == mux.REPLY:
+                # Error before the end of the stream
+                self._finalResult = json.loads(payload)
+            return None
+
+        self._channel.grant()
+
+        if self._decoder is not None:
+            payload = self._decoder.decode(payload)
+
+        return payload
+
+    def _finish(self, cancel=False):
+        """ End the stream, and return the server's (out-of-band) result. """
+        if self._finalResult is None and self._encoder is not None:
+            (encoder, self._encoder) = (self._encoder, None)
+
+            if cancel:
+                encoder.abort()
+            else:
+                try:
+                    # Returns False if the server cancelled, which it reports in its result
+                    encoder.close()
+                except Exception:
+                    self._finish(cancel=True)
+                    raise
+
+        if self._finalResult is None:
+            if self._writing:
+                self._channel.send(mux.CANCEL if cancel else mux.EOF)
+            elif not self._ended:
+                self._channel.send(mux.CANCEL)
+
+            self._finalResult = self._channel.reply()
+            self._channel.mux.close(self._channel)
+
+        return self._finalResult
+
+
+class _BulkStream(_ChannelStream):
+
+    """ Data stream to or from the remote server, over TCP connections beside a channel.
+
+    The channel carries the result, and any cancellation.
+    """
+
+    def __init__(self, channel, connections, cipher, progress=None, parser=None):
+        super(_BulkStream, self).__init__(channel, progress, parser)
+
+        if self._writing:
+            self._bulk = bulk.Sender(channel.id, connections, cipher)
+        else:
+            self._bulk = bulk.Receiver(channel.id, connections, cipher)
+
+        # Receivers check the total size sent over TCP,
+        # and both ends check the total the other reports over ssh
+        self._moved = 0
+
+    def _sendData(self, data):
+        if self._channel.cancelled:
+            # The server stopped accepting data, and will report why
+            raise Exception(self._finish(cancel=True))
+
+        try:
+            self._bulk.write(data)
+            self._moved += len(data)
+        except Exception as error:
+            result = self._finish(cancel=True)
+            if result and 'error' in result:
+                raise Exception(result)
+            raise error
+
+    def _receiveData(self):
+        data = self._bulk.read()
+        self._moved += len(data)
+        return data or None
+
+    def _finish(self, cancel=False):
+        error = None
+        complete = self._finalResult is None and not cancel and (self._writing or self._ended)
+
+        if self._finalResult is None:
+            if self._writing and not cancel:
+                try:
+                    self._bulk.close()
+                except Exception as closeError:
+                    (error, cancel) = (closeError, True)
+            else:
+                self._bulk.abort()
+
+        result = super(_BulkStream, self)._finish(cancel)
+
+        # The server's error explains ours
+        if error is not None and not (result and 'error' in result):
+            raise error
+
+        if complete and result and 'error' not in result and result.get('size') != self._moved:
+            raise Exception("Server %s %s bytes, but %d were sent over TCP" % (
+                "received" if self._writing else "sent", result.get('size'), self._moved,
+            ))
+
+        return result
+
+
+class _PlanSource(Store.Store):
+
+    """ The edges of a client's source Store, for planning on the server. """
+
+    def __init__(self, path, vols, edges):
+        super(_PlanSource, self).__init__(None, path, 'r', True)
+        self.isRemote = True
+
+        # {fromVol: [Diff]}
+        self.diffs = collections.defaultdict(list)
+
+        for (toUUID, fromUUID, size, sizeIsEstimated) in edges:
+            diff = Store.Diff(self, vols[toUUID], vols.get(fromUUID), size, sizeIsEstimated)
+            self.diffs[diff.fromVol].append(diff)
+
+    def __unicode__(self):
+        return u"client source"
+
+    def _fillVolumesAndPaths(self, paths):
+        pass
+
+    def getEdges(self, fromVol):
+        return self.diffs[fromVol]
+
+    def hasEdge(self, diff):
+        return diff in self.diffs[diff.fromVol]
+
+    def measureSize(self, diff, chunkSize):
+        raise NotImplementedError
+
+    def send(self, diff, streamVersion=1):
+        raise NotImplementedError
+
+    def receive(self, diff, paths):
+        raise NotImplementedError
+
+    def receiveVolumeInfo(self, paths):
+        raise NotImplementedError
+
+    def keep(self, diff):
+        raise NotImplementedError
+
+    def deleteUnused(self):
+        raise NotImplementedError
+
+    def deletePartials(self):
+        raise NotImplementedError
+
+
+class _ChannelProgress(object):
+
+    """ Reports the progress of a server-side transfer to the client. """
+
+    def __init__(self, channel):
+        self._channel = channel
+        self._lastTime = 0
+
+    def update(self, sent):
+        now = time.time()
+
+        if now - self._lastTime < theProgressInterval:
+            return
+
+        self._lastTime = now
+        self._channel.send(mux.DATA, json.dumps(dict(size=sent)))
+
+
 class SSHStore(Store.Store):
 
     """ A synchronization source or sink to a btrfs over SSH. """
@@ -204,20 +526,38 @@ class SSHStore(Store.Store):
         self._client = _Client(host, 'r' if dryrun else mode, path)
         self.isRemote = True
 
+        # Used to start the ssh session, and to share it with other stores
+        self.sshOptions = theSSHOptions
+
         self.toArg = _Obj2Arg()
         self.toObj = _Dict2Obj(self)
 
+        # {fromVol: [edges]} received ahead of getEdges
+        self._edges = {}
+
+        # (encrypt, count) to move stream data over count TCP connections
+        self.tcp = None
+
+        # True to compress stream data over ssh with zstd, if the server can
+        self.zstd = False
+
     def __unicode__(self):
         """ English description of self. """
         return u"ssh://%s%s" % (self.host, self.userPath)
 
     def _open(self):
         """ Open connection to remote host. """
-        self._client._open()
+        self._client.options = self.sshOptions
+        self._client = thePool.open(self._client)
+
+        # Older servers only handle version 1 streams
+        remote = self._client.remoteVersion
+        self.sendStreamVersion = remote.get('sendStreamVersion', 1)
+        self.receiveStreamVersion = remote.get('receiveStreamVersion', 1)
 
     def _close(self):
         """ Close connection to remote host. """
-        self._client._close()
+        thePool.close(self._client)
 
     # Abstract methods
 
@@ -234,11 +574,85 @@ class SSHStore(Store.Store):
 
     def getEdges(self, fromVol):
         """ Return the edges available from fromVol. """
+        if fromVol in self._edges:
+            return self._edges.pop(fromVol)
+
         return [
             self.toObj.diff(diff)
             for diff in self._client.getEdges(self.toArg.vol(fromVol))
         ]
 
+    def prefetchEdges(self, fromVols):
+        """ Ask for the edges from all of fromVols at once. """
+        fromVols = [vol for vol in set(fromVols) if vol not in self._edges]
+
+        if len(fromVols) < 2 or not self._client.remoteVersion.get('edgesMany', False):
+            return
+
+        results = self._client.getEdgesMany(json.dumps([
+            self.toArg.vol(fromVol) for fromVol in fromVols
+        ]))
+
+        for (fromVol, diffs) in zip(fromVols, results):
+            self._edges[fromVol] = [self.toObj.diff(diff) for diff in diffs]
+
+    def planDiffs(self, volumes, sources, delete, chunkSize, willMeasureLater):
+        """ Send the edges in sources to the server, and let it choose the diffs.
+
+        This takes one round trip, instead of one for each volume the planner considers.
+        """
+        if len(sources) != 1 or not self._client.remoteVersion.get('plan', False):
+            return None
+
+        (source, ) = sources
+
+        # {uuid: Volume}
+        vols = {vol.uuid: vol for vol in list(volumes) + list(self.paths)}
+        # {(toUUID, fromUUID): Diff}
+        edges = {}
+
+        # Follow edges from everything the server might reach
+        fromVols = [None] + list(self.paths) + list(source.paths)
+        seen = set()
+
+        while fromVols:
+            seen.update(fromVols)
+            source.prefetchEdges(fromVols)
+
+            for fromVol in fromVols:
+                for edge in source.getEdges(fromVol):
+                    edges[(edge.toUUID, edge.fromUUID)] = edge
+                    vols[edge.toUUID] = edge.toVol
+
+            fromVols = list({edge.toVol for edge in edges.values()} - seen)
+
+        toDict = _Obj2Dict()
+
+        request = dict(
+            volumes=[toDict.vol(vol) for vol in vols.values()],
+            required=[vol.uuid for vol in volumes],
+            edges=[
+                (edge.toUUID, edge.fromUUID, edge.size, edge.sizeIsEstimated)
+                for edge in edges.values()
+            ],
+            delete=delete,
+            willMeasureLater=willMeasureLater,
+        )
+
+        logger.debug("Planning %d volumes from %d edges remotely", len(vols), len(edges))
+
+        diffs = []
+
+        for values in self._client.planDiffs(json.dumps(request), chunkSize):
+            if values.pop('sink') == 'source':
+                diffs.append(edges[(values['toVol'], values['fromVol'])])
+            else:
+                values['toVol'] = vols.get(values['toVol'], values['toVol'])
+                values['fromVol'] = vols.get(values['fromVol'], values['fromVol'])
+                diffs.append(self.toObj.diff(values))
+
+        return diffs
+
     def measureSize(self, diff, chunkSize):
         """ Spend some time to get an accurate size. """
         (toUUID, fromUUID) = self.toArg.diff(diff)
@@ -251,20 +665,63 @@ class SSHStore(Store.Store):
             isInteractive,
         ))
 
+    def measureSizes(self, diffs, chunkSize, workers=1):
+        """ Have the server measure diffs in parallel, and yield each as its size arrives. """
+        if not self._client.remoteVersion.get('measureMany', False):
+            for diff in super(SSHStore, self).measureSizes(diffs, chunkSize, workers):
+                yield diff
+            return
+
+        # {(toUUID, fromUUID): diff}
+        diffs = {self.toArg.diff(diff): diff for diff in diffs}
+
+        if not diffs:
+            return
+
+        args = (
+            json.dumps([key + (diff.size, ) for (key, diff) in diffs.items()]),
+            chunkSize,
+            workers,
+            sys.stderr.isatty(),
+        )
+
+        if self._client.mux is None:
+            # Results only arrive at the end
+            results = self._client.measureSizes(*args)
+        else:
+            results = self._client.callUpdates('measureMany', *args)
+
+        for values in results:
+            measured = self.toObj.diff(values)
+            diff = diffs[self.toArg.diff(measured)]
+            diff.setSize(measured.size, measured.sizeIsEstimated)
+            yield diff
+
     def hasEdge(self, diff):
         """ True if Store already contains this edge. """
         return diff.toVol in self.paths
 
-    def send(self, diff):
+    def send(self, diff, streamVersion=1):
         """ Return Context Manager for a file-like (stream) object to send a diff. """
         if Store.skipDryRun(logger, self.dryrun)("send %s", diff):
             return None
 
         (diffTo, diffFrom) = self.toArg.diff(diff)
-        self._client.send(diffTo, diffFrom)
+        streamVersion = min(streamVersion, self.sendStreamVersion)
+
+        if self._client.passthrough:
+            # The server sends btrfs output as is, and we fix it up
+            connections = self._client.bulkConnections(self.tcp)
+            codec = self._client.streamCodec(self.zstd)
+            opened = self._client.send(diffTo, diffFrom, streamVersion, True, connections, codec)
+            parser = send.StreamParser(diff.toUUID, diff.toGen, diff.fromUUID, diff.fromGen)
+        elif streamVersion > 1:
+            (opened, parser) = (self._client.send(diffTo, diffFrom, streamVersion), None)
+        else:
+            (opened, parser) = (self._client.send(diffTo, diffFrom), None)
 
         progress = DisplayProgress(diff.size) if self.showProgress is True else None
-        return _SSHStream(self._client, progress)
+        return self._client.stream(opened, progress, parser)
 
     def receive(self, diff, paths):
         """ Return Context Manager for a file-like (stream) object to store a diff. """
@@ -275,10 +732,62 @@ class SSHStore(Store.Store):
             return None
 
         (diffTo, diffFrom) = self.toArg.diff(diff)
-        self._client.receive(path, diffTo, diffFrom)
 
+        if self._client.passthrough:
+            # We check and fix up the stream, and btrfs receives it as is
+            connections = self._client.bulkConnections(self.tcp)
+            codec = self._client.streamCodec(self.zstd)
+            opened = self._client.receive(path, diffTo, diffFrom, True, connections, codec)
+            parser = send.StreamParser(
+                diff.toUUID, diff.toGen, diff.fromUUID, diff.fromGen,
+                maxVersion=self.receiveStreamVersion,
+            )
+        else:
+            (opened, parser) = (self._client.receive(path, diffTo, diffFrom), None)
+
+        progress = DisplayProgress(diff.size) if self.showProgress is True else None
+        return self._client.stream(opened, progress, parser)
+
+    def directURL(self):
+        """ Return a URL other hosts can use to reach this Store. """
+        return "ssh://%s%s/" % (self.host, self.userPath.rstrip("/"))
+
+    def sendDirect(self, diff, dest, paths, chunkSize, verify=False):
+        """ Have the server push diff straight to dest.
+
+        The server writes to dest as its own user, so it must have been started
+        in a mode that allows writing.
+        """
+        url = dest.directURL()
+
+        if url is None or self.mode == 'r':
+            return False
+
+        (diffTo, diffFrom) = self.toArg.diff(diff)
+        progress = DisplayProgress(diff.size) if dest.showProgress is True else None
+
+        self._client.callWithProgress(
+            progress, 'push', diffTo, diffFrom, diff.size, url, chunkSize, verify,
+        )
+
+        return True
+
+    def receiveDirect(self, diff, paths, chunkSize, verify=False):
+        """ Have the server pull diff straight from its sink. """
+        url = diff.sink.directURL()
+
+        if url is None:
+            return False
+
+        path = self._relativePath(self.selectReceivePath(paths))
+        (diffTo, diffFrom) = self.toArg.diff(diff)
         progress = DisplayProgress(diff.size) if self.showProgress is True else None
-        return _SSHStream(self._client, progress)
+
+        self._client.callWithProgress(
+            progress, 'pull', path, diffTo, diffFrom, diff.size, url, chunkSize, verify,
+        )
+
+        return True
 
     def receiveVolumeInfo(self, paths):
         """ Return Context Manager for a file-like (stream) object to store volume info. """
@@ -288,9 +797,9 @@ class SSHStore(Store.Store):
         if Store.skipDryRun(logger, self.dryrun)("receive info to %s", path):
             return None
 
-        self._client.receiveInfo(path)
+        opened = self._client.receiveInfo(path)
 
-        return _SSHStream(self._client)
+        return self._client.stream(opened)
 
     def keep(self, diff):
         """ Mark this diff (or volume) to be kept in path. """
@@ -313,22 +822,84 @@ class SSHStore(Store.Store):
             self._client.deletePartials()
 
 
+class _Pool(object):
+
+    """ Shares server sessions between SSHStores for the same host, directory and mode. """
+
+    def __init__(self):
+        # {key: _Client}
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def open(self, client):
+        """ Return an open client like client, sharing an open session if there is one. """
+        with self._lock:
+            if client._process is None:
+                client = self._clients.setdefault(client.key, client)
+            else:
+                # Already started by the caller
+                self._clients.setdefault(client.key, client)
+
+            client.users += 1
+
+        # A slow host only holds up the stores sharing its session
+        try:
+            with client._opening:
+                client._open()
+        except Exception:
+            self.close(client)
+            raise
+
+        return client
+
+    def close(self, client):
+        """ Close a client's session, when its last store is done with it. """
+        with self._lock:
+            client.users -= 1
+
+            if client.users > 0:
+                return
+
+            if self._clients.get(client.key) is client:
+                del self._clients[client.key]
+
+        client._close()
+
+
+thePool = _Pool()
+
+
 class _Client(object):
 
-    def __init__(self, host, mode, directory):
+    def __init__(self, host, mode, directory, options=theSSHOptions):
         self._host = host
         self._mode = mode
         self._directory = directory
+        self.options = options
+        self.users = 0
         self._process = None
+        self._opening = threading.Lock()
         self.error = None
+        self.remoteVersion = None
+
+        # The server passes send streams through, for us to fix up
+        self.passthrough = False
+
+        # Multiplexes concurrent commands and streams, if the server can
+        self.mux = None
+
+        # Result of the 'bulk' command, for streams over TCP
+        self._bulk = None
+
+        # Warned that the server can't compress streams
+        self._warnedCodec = False
 
     def _open(self):
         """ Open connection to remote host. """
         if self._process is not None:
             return
 
-        cmd = [
-            'ssh',
+        cmd = ['ssh'] + self._sshArgs() + [
             self._host,
             'sudo',
             'buttersink',
@@ -346,8 +917,49 @@ class _Client(object):
             stdout=subprocess.PIPE,
         )
 
-        version = self.version()
-        logger.info("Remote version: %s", version)
+        self._start()
+
+    @property
+    def key(self):
+        """ Clients with the same key can share a session. """
+        return (self._host, self._mode, self._directory, self.options)
+
+    def _sshArgs(self):
+        """ Return the ssh arguments for self.options. """
+        args = []
+
+        if self.options.persist:
+            args += [
+                '-o', 'ControlMaster=auto',
+                '-o', 'ControlPath=' + theControlPath,
+                '-o', 'ControlPersist=%d' % (self.options.persist, ),
+            ]
+
+        if self.options.cipher:
+            args += ['-c', self.options.cipher]
+
+        if self.options.compress:
+            args += ['-C']
+
+        if self.options.keepalive:
+            args += [
+                '-o', 'ServerAliveInterval=%d' % (self.options.keepalive, ),
+                '-o', 'ServerAliveCountMax=3',
+            ]
+
+        return args
+
+    def _start(self):
+        """ Negotiate the protocol with a newly started server. """
+        self.remoteVersion = self.version()
+        logger.info("Remote version: %s", self.remoteVersion)
+
+        if self.remoteVersion.get('channels', False):
+            self.multiplex()
+            self.mux = mux.ClientMultiplexer(self._process.stdout, self._process.stdin)
+            self.mux.start()
+
+            self.passthrough = bool(self.remoteVersion.get('passthrough', False))
 
     def _close(self):
         """ Close connection to remote host. """
@@ -358,6 +970,12 @@ class _Client(object):
 
         self._process.stdin.close()
 
+        if self.mux is not None:
+            self.mux.join()
+            self.mux = None
+
+        self._bulk = None
+
         logger.debug("Waiting for ssh process to finish...")
         self._process.wait()  # Wait for ssh session to finish.
 
@@ -367,18 +985,7 @@ class _Client(object):
         self._process = None
 
     def _checkMode(self, name, mode):
-        modes = ["read-only", "append", "write"]
-
-        def value(mode):
-            return [s[0] for s in modes].index(mode)
-
-        allowedMode = value(self._mode)
-        requestedMode = value(mode)
-        if requestedMode > allowedMode:
-            raise Exception(
-                "%s connection does not allow %s method '%s'" %
-                (modes[allowedMode], modes[requestedMode], name)
-            )
+        checkMode(self._mode, name, mode)
 
     def _getResult(self):
         result = self._process.stdout.readline().rstrip("\n")
@@ -397,6 +1004,9 @@ class _Client(object):
             # logger.warn("Not sending %s because of %s", command, self.error)
             return dict(error=self.error, message="Can't send command", command=command[0])
 
+        if self.mux is not None:
+            return self._call(command)
+
         try:
             command = ['None' if c is None else urllib.quote_plus(str(c), '/') for c in command]
         except Exception:
@@ -418,6 +1028,142 @@ class _Client(object):
 
         return result
 
+    def _call(self, command):
+        """ Call command on its own channel.
+
+        Returns the result, or the channel for commands that open a stream.
+        """
+        channel = self.mux.open()
+
+        try:
+            result = channel.call(self._channelCommand(command))
+        except Exception:
+            self.mux.close(channel)
+            raise
+
+        if isinstance(result, dict) and result.get('stream', False):
+            return channel
+
+        self.mux.close(channel)
+
+        if result and 'error' in result:
+            raise Exception(result)
+
+        return result
+
+    def _channelCommand(self, command):
+        return ['None' if c is None else str(c) for c in command]
+
+    def callWithProgress(self, progress, *command):
+        """ Run a long command, displaying the progress the server reports on its channel. """
+        if self.mux is None or self.error is not None:
+            self._checkMode(command[0], commandModes[command[0]])
+            return self._sendCommand(*command)
+
+        if progress is not None:
+            progress.open()
+
+        try:
+            for update in self.callUpdates(*command):
+                if progress is not None:
+                    progress.update(update['size'])
+        finally:
+            if progress is not None:
+                progress.close()
+
+    def callUpdates(self, *command):
+        """ Run a long command on a channel, and yield the updates sent before its result. """
+        self._checkMode(command[0], commandModes[command[0]])
+
+        channel = self.mux.open()
+
+        try:
+            channel.request(self._channelCommand(command))
+
+            while True:
+                (kind, payload) = channel.receive()
+
+                if kind == mux.REPLY:
+                    result = json.loads(payload)
+                    break
+
+                if kind == mux.DATA:
+                    yield json.loads(payload)
+        finally:
+            self.mux.close(channel)
+
+        if result and 'error' in result:
+            raise Exception(result)
+
+    def bulkConnections(self, tcp):
+        """ Return how many TCP connections a stream should use, or 0 for none.
+
+        tcp is (encrypt, count), or None.
+        The server listens for them on a one-time port, with a one-time token and key.
+        """
+        if tcp is None or self.mux is None or not self.remoteVersion.get('bulk', False):
+            return 0
+
+        (encrypt, count) = tcp
+
+        if self._bulk is None:
+            if encrypt and not bulk.available:
+                raise Exception("Encrypted TCP transfers need the 'cryptography' package")
+
+            self._bulk = self.openBulk(encrypt)
+            logger.debug("Streaming over TCP port %d", self._bulk['port'])
+
+        return count
+
+    def streamCodec(self, zstd):
+        """ Return the compression a stream should use, or '' for none.
+
+        The server lists the codecs it can use in its version.
+        """
+        if not zstd or self.mux is None:
+            return ''
+
+        if not compress.available:
+            raise Exception("zstd compression needs the 'zstandard' package")
+
+        for codec in self.remoteVersion.get('codecs', []):
+            if codec in compress.theCodecs:
+                return codec
+
+        if not self._warnedCodec:
+            logger.warn("Sending uncompressed streams, because the server can't use zstd")
+            self._warnedCodec = True
+
+        return ''
+
+    def stream(self, opened, progress=None, parser=None):
+        """ Return a stream for data after a command that opened one.
+
+        parser fixes up passthrough streams, which only use channels.
+        """
+        if self.mux is None:
+            return _SSHStream(self, progress)
+
+        count = opened.result.get('connections', 0)
+
+        if not count:
+            return _ChannelStream(opened, progress, parser)
+
+        # Connect to the address the ssh session came in on, if the server knows it
+        host = self._bulk['host'] or self._host.rpartition('@')[2]
+        key = self._bulk['key']
+
+        try:
+            connections = bulk.connect(
+                host, self._bulk['port'], self._bulk['token'].decode('hex'), opened.id, count,
+            )
+        except Exception:
+            self.mux.close(opened)
+            raise
+
+        cipher = bulk.Cipher(None if key is None else key.decode('hex'))
+        return _BulkStream(opened, connections, cipher, progress, parser)
+
     @classmethod
     def _addMethod(cls, method, name, mode):
         def fn(self, *args):
@@ -427,11 +1173,45 @@ class _Client(object):
 
 commands = {}
 
+# {name: mode}
+commandModes = {}
+
+# {name: 'read' or 'write'} for commands that open a stream
+streamCommands = {}
+
+# Commands that transfer data over the command line protocol, not channels
+theLineCommands = ('write', 'read', 'multiplex')
+
+# Commands that don't need exclusive use of the ButterStore
+theConcurrentCommands = ('measure', 'measureMany', 'version')
+
+
+def checkMode(allowedMode, name, mode):
+    """ Raise if a connection in allowedMode may not run command name, which needs mode. """
+    modes = ["read-only", "append", "write"]
+
+    def value(mode):
+        return [s[0] for s in modes].index(mode)
+
+    allowedMode = value(allowedMode)
+    requestedMode = value(mode)
+    if requestedMode > allowedMode:
+        raise Exception(
+            "%s connection does not allow %s method '%s'" %
+            (modes[allowedMode], modes[requestedMode], name)
+        )
+
 
-def command(name, mode):
-    """ Label a method as a command with name. """
+def command(name, mode, stream=None):
+    """ Label a method as a command with name.
+
+    stream is 'read' or 'write' for commands that open a stream.
+    """
     def decorator(fn):
         commands[name] = fn.__name__
+        commandModes[name] = mode
+        if stream is not None:
+            streamCommands[name] = stream
         _Client._addMethod(fn.__name__, name, mode)
         return fn
     return decorator
@@ -444,16 +1224,41 @@ class StoreProxyServer(object):
     Use in a 'with' statement.
     """
 
-    def __init__(self, path, mode):
-        """ Initialize. """
+    def __init__(self, path, mode, input=None, output=None):
+        """ Initialize.
+
+        Commands are read from input and results written to output,
+        which default to stdin and stdout.
+        """
         logger.debug("Proxy(%s) %s", mode, path)
         self.path = path
         self.mode = mode
+        self.input = input or sys.stdin
+        self.output = output or sys.stdout
         self.butterStore = None
         self.running = False
         self.toObj = None
         self.toDict = None
-        self.stream = None
+
+        # Each channel thread has its own stream
+        self._local = threading.local()
+        self.mux = None
+        self._storeLock = threading.Lock()
+
+        # Listens for TCP connections that carry stream data
+        self.bulk = None
+
+        # {url: Store} open for direct transfers
+        self._peers = {}
+
+    @property
+    def stream(self):
+        """ The open stream for the current command. """
+        return getattr(self._local, 'stream', None)
+
+    @stream.setter
+    def stream(self, stream):
+        self._local.stream = stream
 
     def __enter__(self):
         """ Enter 'with' statement. """
@@ -461,6 +1266,15 @@ class StoreProxyServer(object):
 
     def __exit__(self, exceptionType, exception, trace):
         """ Exit 'with' statement. """
+        if self.bulk is not None:
+            self.bulk.close()
+
+        for peer in self._peers.values():
+            try:
+                peer.__exit__(None, None, None)
+            except Exception as error:
+                logger.info("Error closing %s: %s", peer, error)
+
         try:
             self._close()
         except Exception as error:
@@ -477,22 +1291,33 @@ class StoreProxyServer(object):
         self.stream = stream
         self.stream.__enter__()
 
-    def _close(self):
+    def _close(self, exception=None):
         if self.stream is None:
             return
         try:
-            self.stream.__exit__(None, None, None)
+            self.stream.__exit__(
+                None if exception is None else type(exception), exception, None
+            )
         finally:
             self.stream = None
 
-    def run(self):
-        """ Run the server.  Returns with system error code. """
+    def run(self, cache=None):
+        """ Run the server.  Returns with system error code.
+
+        cache is a ButterStore.Cache kept by a long-running server.
+        """
         normalized = os.path.normpath(self.path) + ("/" if self.path.endswith("/") else "")
         if self.path != normalized:
             sys.stderr.write("Please use full path '%s'" % (normalized,))
             return -1
 
-        self.butterStore = ButterStore.ButterStore(None, self.path, self.mode, dryrun=False)
+        return self.serve(
+            ButterStore.ButterStore(None, self.path, self.mode, dryrun=False, cache=cache)
+        )
+
+    def serve(self, store):
+        """ Respond to commands for store.  Returns with system error code. """
+        self.butterStore = store
         # self.butterStore.ignoreExtraVolumes = True
 
         self.toObj = _Arg2Obj(self.butterStore)
@@ -503,6 +1328,10 @@ class StoreProxyServer(object):
         with self.butterStore:
             with self:
                 while self.running:
+                    if self.mux is not None:
+                        self.mux.serve()
+                        break
+
                     self._processCommand()
 
         return 0
@@ -531,9 +1360,9 @@ class StoreProxyServer(object):
         except Exception as error:
             result = json.dumps(self._errorInfo(command, error))
 
-        sys.stdout.write(result)
-        sys.stdout.write("\n")
-        sys.stdout.flush()
+        self.output.write(result)
+        self.output.write("\n")
+        self.output.flush()
 
     def _errorMessage(self, message):
         sys.stderr.write(str(message))
@@ -541,7 +1370,7 @@ class StoreProxyServer(object):
         sys.stderr.flush()
 
     def _processCommand(self):
-        commandLine = sys.stdin.readline().rstrip('\n').split(" ")
+        commandLine = self.input.readline().rstrip('\n').split(" ")
         commandLine = [urllib.unquote_plus(c) for c in commandLine]
         command = commandLine[0]
 
@@ -552,10 +1381,19 @@ class StoreProxyServer(object):
             self.running = False
             return
 
+        self._sendResult(self._runCommand(commandLine))
+
+    def _runCommand(self, commandLine):
+        """ Run a command, and return its result or error information. """
+        command = commandLine[0]
+
         try:
             if command not in commands:
                 raise Exception("Unknown command")
 
+            # Don't trust the client to respect the mode the server was started in
+            checkMode(self.mode, command, commandModes[command])
+
             method = getattr(self, commands[command])
             fn = method.__get__(self, StoreProxyServer)
             result = fn(*commandLine[1:])
@@ -565,7 +1403,229 @@ class StoreProxyServer(object):
             # logger.exception("Failed %s", command)
             result = self._errorInfo(command, error)
 
-        self._sendResult(result)
+        return result
+
+    def _serveChannel(self, channel, commandLine):
+        """ Run a command from a channel, in its own thread. """
+        command = commandLine[0]
+        self._local.channel = channel
+
+        if command in theLineCommands:
+            result = dict(error="Command is not available on channels", command=command)
+        elif command in theConcurrentCommands:
+            result = self._runCommand(commandLine)
+        else:
+            with self._storeLock:
+                result = self._runCommand(commandLine)
+
+        if self.stream is not None:
+            if 'error' in result:
+                self._close(Exception(result['error']))
+            else:
+                direction = streamCommands[command]
+                connections = getattr(self._local, 'connections', 0) if self.bulk else 0
+
+                # TCP streams aren't compressed
+                codec = getattr(self._local, 'codec', '') if not connections else ''
+
+                channel.send(mux.REPLY, json.dumps(dict(
+                    message="streaming...",
+                    stream=True,
+                    direction=direction,
+                    credit=mux.theCreditWindow,
+                    connections=connections,
+                    codec=codec,
+                )))
+
+                try:
+                    if connections:
+                        result = self._pumpBulk(channel, direction, connections)
+                    else:
+                        result = self._pumpChannel(channel, direction, codec)
+                except Exception as error:
+                    result = self._errorInfo(command, error)
+
+        try:
+            result = json.dumps(result)
+        except Exception as error:
+            result = json.dumps(self._errorInfo(command, error))
+
+        channel.send(mux.REPLY, result)
+
+    def _pumpChannel(self, channel, direction, codec=''):
+        """ Move stream data over a channel, compressed with codec if it's set.
+
+        Errors are raised after the end of the data.
+        """
+        (error, total, cancelled) = (None, 0, False)
+
+        passthrough = getattr(self.stream, 'passthrough', False)
+
+        if direction == 'read' and passthrough and splice.available and not codec:
+            # btrfs send output goes straight to the ssh connection
+            try:
+                total = channel.spliceData(self.stream.fileno())
+            except Exception as streamError:
+                (error, total) = (streamError, 0)
+
+            if total is None:
+                (cancelled, total) = (True, 0)
+
+            channel.send(mux.EOF)
+        elif direction == 'read':
+            encoder = compress.Encoder(channel.sendData) if codec else None
+            sendData = encoder.write if encoder else channel.sendData
+
+            while True:
+                try:
+                    data = self.stream.read(mux.theFrameSize)
+                except Exception as streamError:
+                    error = streamError
+                    break
+
+                if not data:
+                    break
+
+                if not sendData(data):
+                    cancelled = True
+                    break
+
+                total += len(data)
+
+            if encoder is not None and not cancelled:
+                if error is not None:
+                    encoder.abort()
+                elif not encoder.close():
+                    cancelled = True
+
+            channel.send(mux.EOF)
+        else:
+            decoder = compress.Decoder() if codec else None
+
+            while True:
+                (kind, data) = channel.receive()
+
+                if kind == mux.EOF:
+                    break
+
+                if kind == mux.CANCEL:
+                    cancelled = True
+                    break
+
+                if kind != mux.DATA or error is not None:
+                    continue  # Discard data sent before the client saw the error
+
+                try:
+                    if decoder is not None:
+                        data = decoder.decode(data)
+
+                    self.stream.write(data)
+                    total += len(data)
+                except Exception as streamError:
+                    error = streamError
+                    channel.send(mux.CANCEL)
+                    continue
+
+                channel.grant()
+
+        try:
+            self._close(error or (theCancelled if cancelled else None))
+        except Exception as closeError:
+            error = error or closeError
+
+        if error is not None:
+            raise error
+
+        return dict(message="Cancelled" if cancelled else "Finished", size=total)
+
+    def _pumpBulk(self, channel, direction, count):
+        """ Move stream data over TCP connections, with cancellation over the channel.
+
+        Errors are raised after the end of the data.
+        """
+        (error, total, cancelled) = (None, 0, False)
+
+        try:
+            connections = self.bulk.connections(channel.id, count)
+        except Exception as connectError:
+            self._close(connectError)
+            raise
+
+        if direction == 'read':
+            sender = bulk.Sender(channel.id, connections, self.bulk.cipher)
+
+            try:
+                while True:
+                    try:
+                        data = self.stream.read(bulk.theChunkSize)
+                    except Exception as streamError:
+                        error = streamError
+                        break
+
+                    if not data:
+                        break
+
+                    sender.write(data)
+                    total += len(data)
+
+                sender.close()
+            except Exception as sendError:
+                # The client closed its connections, and cancels over the channel
+                logger.debug("TCP send stopped: %s", sendError)
+                sender.abort()
+                self._waitForEnd(channel)
+                cancelled = True
+
+            channel.send(mux.EOF)
+        else:
+            receiver = bulk.Receiver(channel.id, connections, self.bulk.cipher)
+            receiveError = None
+
+            while error is None:
+                try:
+                    data = receiver.read()
+                except Exception as readError:
+                    # The client cancelled over the channel, or the data was cut short
+                    logger.debug("TCP receive stopped: %s", readError)
+                    receiveError = readError
+                    break
+
+                if not data:
+                    break
+
+                try:
+                    self.stream.write(data)
+                    total += len(data)
+                except Exception as streamError:
+                    error = streamError
+                    channel.send(mux.CANCEL)
+
+            receiver.abort()
+            cancelled = self._waitForEnd(channel)
+
+            if not cancelled:
+                error = error or receiveError
+
+        try:
+            self._close(error or (theCancelled if cancelled else None))
+        except Exception as closeError:
+            error = error or closeError
+
+        if error is not None:
+            raise error
+
+        return dict(message="Cancelled" if cancelled else "Finished", size=total)
+
+    def _waitForEnd(self, channel):
+        """ Wait for the client to end the stream.  Returns True if it cancelled. """
+        while True:
+            (kind, data) = channel.receive()
+
+            if kind == mux.EOF:
+                return False
+
+            if kind == mux.CANCEL:
+                return True
 
     @command('quit', 'r')
     def quit(self):
@@ -576,23 +1636,154 @@ class StoreProxyServer(object):
     @command('version', 'r')
     def version(self):
         """ Return kernel and btrfs version. """
+        butter = getattr(self.butterStore, 'butter', None)
         return dict(
             buttersink=theVersion,
-            btrfs=self.butterStore.butter.btrfsVersion,
+            btrfs=butter.btrfsVersion if butter else None,
             linux=platform.platform(),
+            sendStreamVersion=self.butterStore.sendStreamVersion,
+            receiveStreamVersion=self.butterStore.receiveStreamVersion,
+            channels=True,
+            passthrough=True,
+            bulk=True,
+            plan=True,
+            edgesMany=True,
+            measureMany=True,
+            codecs=list(compress.theCodecs),
         )
 
-    @command('send', 'r')
-    def send(self, diffTo, diffFrom):
-        """ Do a btrfs send. """
-        diff = self.toObj.diff(diffTo, diffFrom)
-        self._open(self.butterStore.send(diff))
+    @command('multiplex', 'r')
+    def multiplex(self):
+        """ Switch to multiplexed channels, after this reply. """
+        self.mux = mux.ServerMultiplexer(self.input, self.output, self._serveChannel)
+        return dict(message="multiplexing")
+
+    @command('bulk', 'r')
+    def openBulk(self, encrypt='True'):
+        """ Listen for TCP connections to carry stream data.
+
+        Returns the port, and the one-time token and key (if encrypted) to use.
+        """
+        encrypt = self.toObj.bool(encrypt)
+
+        if encrypt and not bulk.available:
+            raise Exception("Encrypted TCP transfers need the 'cryptography' package")
+
+        if self.bulk is not None:
+            self.bulk.close()
+
+        self.bulk = bulk.Listener(encrypt)
+
+        # "client address, client port, server address, server port"
+        connection = os.environ.get('SSH_CONNECTION', '').split()
+
+        return dict(
+            port=self.bulk.port,
+            token=self.bulk.token.encode('hex'),
+            key=None if self.bulk.key is None else self.bulk.key.encode('hex'),
+            host=connection[2] if len(connection) == 4 else None,
+        )
+
+    @command('push', 'a')
+    def sendDirect(self, diffTo, diffFrom, estimatedSize, url, chunkSize, verify):
+        """ Transfer a diff to the Store at url, without passing it through the client. """
+        diff = self.toObj.diff(diffTo, diffFrom, estimatedSize)
+        paths = self.butterStore.getPaths(diff.toVol)
+        dest = self._peer(url, isDest=True)
+
+        streamVersion = min(self.butterStore.sendStreamVersion, dest.receiveStreamVersion)
+
+        Store.transfer(
+            self.butterStore.send(diff, streamVersion),
+            dest.receive(diff, paths),
+            int(chunkSize),
+            self.toObj.bool(verify),
+            self._progress(),
+        )
+
+    @command('pull', 'a')
+    def receiveDirect(self, path, diffTo, diffFrom, estimatedSize, url, chunkSize, verify):
+        """ Transfer a diff from the Store at url, without passing it through the client. """
+        diff = self.toObj.diff(diffTo, diffFrom, estimatedSize)
+        source = self._peer(url, isDest=False)
+
+        edges = [edge for edge in source.getEdges(diff.fromVol) if edge.toVol == diff.toVol]
+        if not edges:
+            raise Exception("%s is not in %s" % (diff, source))
+
+        streamVersion = min(source.sendStreamVersion, self.butterStore.receiveStreamVersion)
+
+        Store.transfer(
+            source.send(edges[0], streamVersion),
+            self.butterStore.receive(diff, [path, ]),
+            int(chunkSize),
+            self.toObj.bool(verify),
+            self._progress(),
+        )
+
+    def _peer(self, url, isDest):
+        """ Return the open Store at url, for direct transfers.
+
+        The client chooses the url, so it can only be a remote store,
+        which is opened read-only as a source, and never for deleting as a destination.
+        """
+        if not url.startswith(theDirectSchemes):
+            raise Exception("Can't transfer directly with %s" % (url,))
+
+        key = (url, isDest)
 
-    @command('receive', 'a')
-    def receive(self, path, diffTo, diffFrom):
-        """ Receive a btrfs diff. """
+        if key not in self._peers:
+            import buttersink  # Imports this module, so not at the top
+
+            peer = buttersink.parseSink(url, isDest, False, False)
+            peer.showProgress = False
+            peer.__enter__()
+
+            self._peers[key] = peer
+
+        return self._peers[key]
+
+    def _progress(self):
+        """ Return a progress display for the client, if the current command has a channel. """
+        channel = getattr(self._local, 'channel', None)
+        return None if channel is None else _ChannelProgress(channel)
+
+    @command('send', 'r', stream='read')
+    def send(
+        self, diffTo, diffFrom, streamVersion='1', passthrough='False', connections='0', codec='',
+    ):
+        """ Do a btrfs send.
+
+        A passthrough stream must be fixed up by the client.
+        The stream uses that many TCP connections, if more than 0.
+        The stream is compressed with codec, if it's set.
+        """
         diff = self.toObj.diff(diffTo, diffFrom)
-        self._open(self.butterStore.receive(diff, [path, ]))
+        passthrough = self.toObj.bool(passthrough)
+        self._local.connections = int(connections)
+        self._local.codec = self._codec(codec)
+        self._open(self.butterStore.send(diff, int(streamVersion), passthrough))
+
+    @command('receive', 'a', stream='write')
+    def receive(
+        self, path, diffTo, diffFrom, passthrough='False', connections='0', codec='',
+    ):
+        """ Receive a btrfs diff.
+
+        A passthrough stream must be checked and fixed up by the client.
+        The stream uses that many TCP connections, if more than 0.
+        The stream is compressed with codec, if it's set.
+        """
+        diff = self.toObj.diff(diffTo, diffFrom)
+        passthrough = self.toObj.bool(passthrough)
+        self._local.connections = int(connections)
+        self._local.codec = self._codec(codec)
+        self._open(self.butterStore.receive(diff, [path, ], passthrough))
+
+    def _codec(self, codec):
+        if codec and codec not in compress.theCodecs:
+            raise Exception("Can't use %s compression" % (codec, ))
+        return codec
 
     @command('write', 'r')
     def streamWrite(self, size):
@@ -606,7 +1797,7 @@ class StoreProxyServer(object):
             return
 
         self._sendResult(dict(message="writing...", stream=True, size=size))
-        data = sys.stdin.read(size)
+        data = self.input.read(size)
         self.stream.write(data)
 
     @command('read', 'r')
@@ -623,7 +1814,7 @@ class StoreProxyServer(object):
             return dict(message="Finished", size=0)
 
         self._sendResult(dict(message="reading...", stream=True, size=size))
-        sys.stdout.write(data)
+        self.output.write(data)
 
     @command('volumes', 'r')
     def fillVolumesAndPaths(self):
@@ -633,20 +1824,68 @@ class StoreProxyServer(object):
             for vol, paths in self.butterStore.paths.items()
         ]
 
+    @command('plan', 'r')
+    def planDiffs(self, request, chunkSize):
+        """ Choose the diffs to reach the client's volumes, from its edges and ours. """
+        request = json.loads(request)
+
+        vols = {values['uuid']: Store.Volume(**values) for values in request['volumes']}
+        source = _PlanSource(self.path, vols, request['edges'])
+
+        best = BestDiffs.BestDiffs(
+            [vols[uuid] for uuid in request['required']],
+            request['delete'],
+        )
+
+        diffs = best.plan(int(chunkSize), request['willMeasureLater'], source, self.butterStore)
+
+        return [
+            dict(self.toDict.diff(diff), sink='dest' if diff.sink is self.butterStore else 'source')
+            for diff in diffs
+        ]
+
     @command('edges', 'r')
     def getEdges(self, fromVol):
         """ Return the edges available from fromVol. """
         return [self.toDict.diff(d) for d in self.butterStore.getEdges(self.toObj.vol(fromVol))]
 
+    @command('edgesMany', 'r')
+    def getEdgesMany(self, fromVols):
+        """ Return the edges available from each of a list of volumes, in one reply. """
+        return [self.getEdges(fromVol) for fromVol in json.loads(fromVols)]
+
     @command('measure', 'r')
     def measureSize(self, diffTo, diffFrom, estimatedSize, chunkSize, isInteractive):
         """ Spend some time to get an accurate size. """
         diff = self.toObj.diff(diffTo, diffFrom, estimatedSize)
         isInteractive = self.toObj.bool(isInteractive)
-        self.butterStore.showProgress = None if isInteractive else False
-        self.butterStore.measureSize(diff, int(chunkSize))
+        self.butterStore.measureSize(diff, int(chunkSize), showProgress=isInteractive)
         return self.toDict.diff(diff)
 
+    @command('measureMany', 'r')
+    def measureSizes(self, diffs, chunkSize, workers, isInteractive):
+        """ Measure several diffs at once, sending each to the client as it's measured. """
+        diffs = [
+            self.toObj.diff(toUUID, fromUUID, str(estimatedSize))
+            for (toUUID, fromUUID, estimatedSize) in json.loads(diffs)
+        ]
+        isInteractive = self.toObj.bool(isInteractive)
+
+        channel = getattr(self._local, 'channel', None)
+        results = []
+
+        for diff in self.butterStore.measureSizes(
+            diffs, int(chunkSize), int(workers), showProgress=isInteractive,
+        ):
+            result = self.toDict.diff(diff)
+            results.append(result)
+
+            if channel is not None:
+                channel.send(mux.DATA, json.dumps(result))
+
+        # Channel clients already have them
+        return results if channel is None else []
+
     @command('keep', 'r')
     def keep(self, diffTo, diffFrom):
         """ Mark this diff (or volume) to be kept in path. """
@@ -673,7 +1912,7 @@ class StoreProxyServer(object):
         """ Delete any old partial uploads/downloads in path. """
         self.butterStore.deletePartials(dryrun=True)
 
-    @command('info', 'a')
+    @command('info', 'a', stream='write')
     def receiveInfo(self, path):
         """ Receive volume info. """
         self.stream = open(path, "w")
@@ -5,6 +5,7 @@ Copyright (c) 2014 Ames Cornish.  All rights reserved.  Licensed under GPLv3.
 """
 
 from util import humanize
+import send
 
 import abc
 import collections
@@ -64,11 +65,18 @@ class Store(object):
         self.isRemote = False
         self.isDiffStore = False
 
+        # Highest btrfs send stream versions this Store can produce and store
+        self.sendStreamVersion = 1
+        self.receiveStreamVersion = 1
+
         # False - Never show progress
         # True - Always show progress
         # None - Show progress for one-sided actions (e.g. measuring)
         self.showProgress = None
 
+        # Let remote Stores transfer diffs between themselves, bypassing this host
+        self.direct = False
+
     def __enter__(self):
         """ So we can use a 'with' statement. """
         self._open()
@@ -87,6 +95,10 @@ class Store(object):
         vols.sort(key=lambda v: self.getSendPath(v))
         return [vol.display(self, detail="line") for vol in vols]
 
+    def listDiffs(self):
+        """ Return the stored diffs in this Store's selected directory. """
+        raise Exception("%s doesn't store diffs" % (self,))
+
     def listVolumes(self):
         """ Return list of all volumes in this Store's selected directory. """
         for (vol, paths) in self.paths.items():
@@ -203,11 +215,36 @@ class Store(object):
         """ Return the edges available from fromVol. """
         raise NotImplementedError
 
+    def prefetchEdges(self, fromVols):
+        """ Prepare to return the edges from each of fromVols soon.
+
+        Stores with slow round trips can ask for them all at once.
+        """
+        pass
+
+    def planDiffs(self, volumes, sources, delete, chunkSize, willMeasureLater):
+        """ Choose the diffs to reach volumes from edges in sources and self.
+
+        Returns the chosen diffs, or None to let the caller choose them.
+        Stores with slow round trips can plan next to their data.
+        """
+        return None
+
     @abc.abstractmethod
     def measureSize(self, diff, chunkSize):
         """ Spend some time to get an accurate size. """
         raise NotImplementedError
 
+    def measureSizes(self, diffs, chunkSize, workers=1):
+        """ Spend some time to get accurate sizes for several diffs.
+
+        Yields each diff as it's measured.
+        Stores that can measure several diffs at once use up to workers.
+        """
+        for diff in diffs:
+            self.measureSize(diff, chunkSize)
+            yield diff
+
     @abc.abstractmethod
     def hasEdge(self, diff):
         """ True if Store already contains this edge. """
@@ -219,10 +256,31 @@ class Store(object):
         raise NotImplementedError
 
     @abc.abstractmethod
-    def send(self, diff):
-        """ Return Context Manager for a file-like (stream) object to send a diff. """
+    def send(self, diff, streamVersion=1):
+        """ Return Context Manager for a file-like (stream) object to send a diff.
+
+        streamVersion is the highest send stream version the receiver accepts.
+        """
         raise NotImplementedError
 
+    def directURL(self):
+        """ Return a URL other hosts can use to reach this Store, or None if they can't. """
+        return None
+
+    def sendDirect(self, diff, dest, paths, chunkSize, verify=False):
+        """ Transfer diff from this Store straight to dest, without passing it through this host.
+
+        Returns False if this Store can't, and the caller must transfer it.
+        """
+        return False
+
+    def receiveDirect(self, diff, paths, chunkSize, verify=False):
+        """ Fetch diff straight from diff.sink, without passing it through this host.
+
+        Returns False if this Store can't, and the caller must transfer it.
+        """
+        return False
+
     @abc.abstractmethod
     def receiveVolumeInfo(self, paths):
         """ Return Context Manager for a file-like (stream) object to store volume info. """
@@ -247,8 +305,12 @@ class Store(object):
         raise NotImplementedError
 
 
-def transfer(sendContext, receiveContext, chunkSize):
-    """ Transfer (large) data from sender to receiver. """
+def transfer(sendContext, receiveContext, chunkSize, verify=False, progress=None):
+    """ Transfer (large) data from sender to receiver.
+
+    If verify is set, check the crc of every send stream command on the way.
+    progress.update() is called with the count of bytes transferred.
+    """
     try:
         chunkSize = receiveContext.chunkSize
     except AttributeError:
@@ -259,29 +321,68 @@ def transfer(sendContext, receiveContext, chunkSize):
             # Open reader after writer,
             # so any raised errors will abort write before writer closes.
             with sendContext as reader:
-                checkBefore = None
-                if hasattr(writer, 'skipChunk'):
-                    checkBefore = hasattr(reader, 'checkSum')
+                if verify:
+                    # Exit verifier first, so bad data will abort write.
+                    with send.Verifier() as verifier:
+                        _copy(reader, writer, chunkSize, verifier, progress)
+                else:
+                    _copy(reader, writer, chunkSize, None, progress)
+
+
+def _copy(reader, writer, chunkSize, verifier, progress=None):
+    sent = 0
+
+    checkBefore = None
+    if hasattr(writer, 'skipChunk'):
+        checkBefore = hasattr(reader, 'checkSum')
+
+    while True:
+        # Writers may choose their own chunk sizes as they go
+        chunkSize = getattr(writer, 'chunkSize', chunkSize)
+
+        if checkBefore is True:
+            (size, checkSum) = reader.checkSum(chunkSize)
 
-                while True:
-                    if checkBefore is True:
-                        (size, checkSum) = reader.checkSum(chunkSize)
+            if writer.skipChunk(size, checkSum):
+                if verifier is not None:
+                    verifier.skip("resumed transfer")
+                reader.seek(size, io.SEEK_CUR)
+                sent += size
+                continue
 
-                        if writer.skipChunk(size, checkSum):
-                            reader.seek(size, io.SEEK_CUR)
-                            continue
+        data = reader.read(chunkSize)
+        if len(data) == 0:
+            break
 
-                    data = reader.read(chunkSize)
-                    if len(data) == 0:
-                        break
+        if verifier is not None:
+            verifier.write(data)
 
-                    if checkBefore is False:
-                        checkSum = hashlib.md5(data).hexdigest()
+        if checkBefore is False:
+            checkSum = hashlib.md5(data).hexdigest()
 
-                        if writer.skipChunk(len(data), checkSum, data):
-                            continue
+            if writer.skipChunk(len(data), checkSum, data):
+                sent += len(data)
+                continue
 
-                    writer.write(data)
+        writer.write(data)
+        sent += len(data)
+
+        if progress is not None:
+            progress.update(sent)
+
+
+def verify(sendContext, chunkSize):
+    """ Check the crc of every command in a (large) send stream. """
+    if sendContext is None:
+        return
+
+    with sendContext as reader:
+        with send.Verifier() as verifier:
+            while True:
+                data = reader.read(chunkSize)
+                if len(data) == 0:
+                    break
+                verifier.write(data)
 
 
 class Diff:
@@ -338,8 +439,11 @@ class Diff:
         if self.fromVol is not None and size is not None and not sizeIsEstimated:
             Diff.theKnownSizes[self.toUUID][self.fromUUID] = size
 
-    def sendTo(self, dest, chunkSize):
-        """ Send this difference to the dest Store. """
+    def sendTo(self, dest, chunkSize, verify=False):
+        """ Send this difference to the dest Store.
+
+        If verify is set, check send stream crcs during the transfer.
+        """
         vol = self.toVol
         paths = self.sink.getPaths(vol)
 
@@ -350,16 +454,20 @@ class Diff:
             # Log, but don't skip yet, so we can log more detailed skipped actions later
             skipDryRun(logger, dest.dryrun, 'INFO')("Xfer: %s", self)
 
-            receiveContext = dest.receive(self, paths)
+            if self._sendDirect(dest, paths, chunkSize, verify):
+                logger.debug("Transferred directly")
+            else:
+                receiveContext = dest.receive(self, paths)
 
-            sendContext = self.sink.send(self)
+                streamVersion = min(self.sink.sendStreamVersion, dest.receiveStreamVersion)
+                sendContext = self.sink.send(self, streamVersion)
 
-            # try:
-            #     receiveContext.metadata['btrfsVersion'] = self.btrfsVersion
-            # except AttributeError:
-            #     pass
+                # try:
+                #     receiveContext.metadata['btrfsVersion'] = self.btrfsVersion
+                # except AttributeError:
+                #     pass
 
-            transfer(sendContext, receiveContext, chunkSize)
+                transfer(sendContext, receiveContext, chunkSize, verify)
 
         if vol.hasInfo():
             infoContext = dest.receiveVolumeInfo(paths)
@@ -371,6 +479,16 @@ class Diff:
                 with infoContext as stream:
                     vol.writeInfo(stream)
 
+    def _sendDirect(self, dest, paths, chunkSize, verify):
+        """ Let the source or dest transfer this diff between themselves, if they can. """
+        if dest.dryrun or self.sink.dryrun or not (self.sink.direct and dest.direct):
+            return False
+
+        return (
+            self.sink.sendDirect(self, dest, paths, chunkSize, verify) or
+            dest.receiveDirect(self, paths, chunkSize, verify)
+        )
+
     def _updateSize(self):
         if self._size and not self._sizeIsEstimated:
             return
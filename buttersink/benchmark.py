@@ -0,0 +1,431 @@
+#! /usr/bin/python
+
+""" Micro-benchmarks for buttersink hot paths.
+
+Run from the source tree with "make bench".
+
+Copyright (c) 2014 Ames Cornish.  All rights reserved.  Licensed under GPLv3.
+"""
+
+if True:  # imports
+
+    import argparse
+    import os
+    import Queue
+    import subprocess
+    import sys
+    import threading
+    import time
+    import timeit
+
+    import BestDiffs
+    import btrfs
+    import bulk
+    import send
+    import SSHStore
+    import Store
+
+command = argparse.ArgumentParser(
+    description="Time buttersink hot paths.",
+    epilog="""
+
+Copyright (c) 2014 Ames Cornish.  All rights reserved.  Licensed under GPLv3.
+See README.md and LICENSE.txt for more info.
+    """,
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+)
+
+command.add_argument('-n', '--number', type=int, default=None,
+                     help='repetitions of each benchmark (default is automatic)')
+command.add_argument('pattern', metavar='<pattern>', nargs='?', default='',
+                     help='only run benchmarks with names containing pattern')
+command.add_argument('--memory-server', type=int, default=None,
+                     help=argparse.SUPPRESS)
+
+theBenchmarks = []
+
+
+def benchmark(fn):
+    """ Register a function returning (callable, count of items per call).
+
+    It may also return a third callable, to clean up afterwards.
+    """
+    theBenchmarks.append(fn)
+    return fn
+
+
+def _rootItems(count):
+    """ Return a TREE_SEARCH result buffer with count root items. """
+    item = btrfs.btrfs_root_item.write(dict(
+        uuid="01234567-89ab-cdef-0123-456789abcdef",
+        received_uuid="fedcba98-7654-3210-fedc-ba9876543210",
+        ctransid=12345,
+    )).tostring()
+
+    header = btrfs.btrfs_ioctl_search_header.write(dict(
+        objectid=256,
+        type=btrfs.objectTypeKeys['BTRFS_ROOT_ITEM_KEY'],
+        len=len(item),
+    )).tostring()
+
+    return (header + item) * count
+
+
+@benchmark
+def rootItemGeneric():
+    """ Decode one root item, walking the nested field types. """
+    structure = btrfs.btrfs_root_item
+    data = _rootItems(1)[btrfs.btrfs_ioctl_search_header.size:]
+
+    def run():
+        args = list(structure._struct.unpack_from(data, 0))
+        args.reverse()
+        structure.popValue(args)
+
+    return (run, 1)
+
+
+@benchmark
+def rootItemCompiled():
+    """ Decode one root item with the compiled decoder. """
+    structure = btrfs.btrfs_root_item
+    data = _rootItems(1)[btrfs.btrfs_ioctl_search_header.size:]
+
+    def run():
+        structure.read(data)
+
+    return (run, 1)
+
+
+@benchmark
+def treeSearchBuffer():
+    """ Decode a full TREE_SEARCH buffer of root items. """
+    count = btrfs.BTRFS_SEARCH_ARGS_BUFSIZE // (
+        btrfs.btrfs_ioctl_search_header.size + btrfs.btrfs_root_item.size
+    )
+    data = _rootItems(count)
+
+    def run():
+        for (header, buf) in btrfs.btrfs_ioctl_search_header.readRecords(data, count):
+            buf.read(btrfs.btrfs_root_item)
+
+    return (run, count)
+
+
+@benchmark
+def sendStreamParse():
+    """ Follow command boundaries through a 1 MiB send stream chunk. """
+    command = send.btrfs_cmd_header.write(dict(
+        len=4096 - send.btrfs_cmd_header.size,
+        cmd=send.BTRFS_SEND_C_WRITE,
+    )).tostring()
+    chunk = (command + "\0" * (4096 - len(command))) * 256
+
+    header = send.btrfs_stream_header.write(dict(
+        magic=send.BTRFS_SEND_STREAM_MAGIC,
+        version=send.BTRFS_SEND_STREAM_VERSION,
+    )).tostring()
+
+    parser = send.StreamParser()
+    parser.parse(header + chunk)
+
+    def run():
+        parser.parse(chunk)
+
+    return (run, 256)
+
+
+class _MemoryStore(Store.Store):
+
+    """ A series of snapshots, with diffs between neighbours. """
+
+    def __init__(self, count):
+        """ Initialize. """
+        super(_MemoryStore, self).__init__(None, "/benchmark/", 'r', False)
+        self.volumes = [
+            Store.Volume("%08x-0000-0000-0000-000000000000" % (i,), i + 1, 1 << 30)
+            for i in xrange(count)
+        ]
+
+    def _fillVolumesAndPaths(self, paths):
+        for (i, vol) in enumerate(self.volumes):
+            paths[vol].append("snapshot%03d" % (i,))
+
+    def getEdges(self, fromVol):
+        """ Return the edges available from fromVol. """
+        if fromVol is None:
+            return [Store.Diff(self, vol, None, vol.size) for vol in self.volumes]
+
+        if fromVol not in self.paths:
+            return []
+
+        i = self.volumes.index(fromVol)
+        return [
+            Store.Diff(self, vol, fromVol, vol.size // 64, True)
+            for vol in self.volumes[max(0, i - 1):i + 2]
+            if vol != fromVol
+        ]
+
+    def hasEdge(self, diff):
+        """ True if Store already contains this edge. """
+        return diff.toVol in self.paths
+
+    def measureSize(self, diff, chunkSize):
+        """ Spend some time to get an accurate size. """
+        raise NotImplementedError
+
+    def send(self, diff, streamVersion=1):
+        """ Return Context Manager for a file-like (stream) object to send a diff. """
+        raise NotImplementedError
+
+    def receive(self, diff, paths):
+        """ Return Context Manager for a file-like (stream) object to store a diff. """
+        raise NotImplementedError
+
+    def receiveVolumeInfo(self, paths):
+        """ Return Context Manager for a file-like (stream) object to store volume info. """
+        raise NotImplementedError
+
+    def keep(self, diff):
+        """ Mark this diff (or volume) to be kept in path. """
+        raise NotImplementedError
+
+    def deleteUnused(self):
+        """ Delete any old snapshots in path, if not kept. """
+        raise NotImplementedError
+
+    def deletePartials(self):
+        """ Delete any old partial uploads/downloads in path. """
+        raise NotImplementedError
+
+
+def _delay(source, dest, latency):
+    """ Copy source to dest in background threads, delivering each read after latency. """
+    queue = Queue.Queue()
+
+    def read():
+        while True:
+            data = os.read(source.fileno(), 1 << 16)
+            queue.put((time.time() + latency, data))
+            if not data:
+                break
+
+    def write():
+        while True:
+            (due, data) = queue.get()
+            time.sleep(max(0, due - time.time()))
+            if not data:
+                dest.close()
+                break
+            dest.write(data)
+            dest.flush()
+
+    for target in (read, write):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+
+
+class _DistantProcess(object):
+
+    """ A subprocess with latency on its pipes, like a far away ssh server. """
+
+    def __init__(self, cmd, latency):
+        """ Initialize. """
+        self._process = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            close_fds=True,
+        )
+
+        (read, write) = os.pipe()
+        _delay(os.fdopen(read, 'rb', 0), self._process.stdin, latency)
+        self.stdin = os.fdopen(write, 'wb', 0)
+
+        (read, write) = os.pipe()
+        _delay(self._process.stdout, os.fdopen(write, 'wb', 0), latency)
+        self.stdout = os.fdopen(read, 'rb')
+
+    def wait(self):
+        """ Wait for the subprocess to finish. """
+        return self._process.wait()
+
+
+def _planning(batched, count=100, latency=0.005):
+    """ Plan transfers from a distant server with count snapshots. """
+    source = SSHStore.SSHStore("benchmark", "/benchmark/", 'r', dryrun=False)
+
+    server = [sys.executable, os.path.abspath(__file__), '--memory-server', str(count)]
+    source._client._process = _DistantProcess(server, latency)
+    source._client._start()
+
+    if not batched:
+        source._client.remoteVersion['edgesMany'] = False
+
+    source.__enter__()
+    dest = _MemoryStore(0).__enter__()
+    volumes = list(source.listVolumes())
+
+    def run():
+        BestDiffs.BestDiffs(volumes, measureSize=False).analyze(1 << 20, source, dest)
+
+    def done():
+        source.__exit__(None, None, None)
+
+    return (run, count, done)
+
+
+@benchmark
+def sshPlanningSequential():
+    """ Plan 100 distant snapshots over a 10 ms round trip, one query at a time. """
+    return _planning(batched=False)
+
+
+@benchmark
+def sshPlanningBatched():
+    """ Plan 100 distant snapshots over a 10 ms round trip, a height at a time. """
+    return _planning(batched=True)
+
+
+def _destPlanning(remote, count=100, latency=0.005):
+    """ Plan transfers of count snapshots to a distant server that has half of them. """
+    dest = SSHStore.SSHStore("benchmark", "/benchmark/", 'r', dryrun=False)
+
+    server = [sys.executable, os.path.abspath(__file__), '--memory-server', str(count // 2)]
+    dest._client._process = _DistantProcess(server, latency)
+    dest._client._start()
+
+    if not remote:
+        dest._client.remoteVersion['plan'] = False
+
+    dest.__enter__()
+    source = _MemoryStore(count).__enter__()
+    volumes = list(source.listVolumes())
+
+    def run():
+        BestDiffs.BestDiffs(volumes, measureSize=False).analyze(1 << 20, source, dest)
+
+    def done():
+        dest.__exit__(None, None, None)
+
+    return (run, count, done)
+
+
+@benchmark
+def sshDestPlanningPipelined():
+    """ Plan 100 snapshots into a server over a 10 ms round trip, a height at a time. """
+    return _destPlanning(remote=False)
+
+
+@benchmark
+def sshDestPlanningRemote():
+    """ Plan 100 snapshots into a server over a 10 ms round trip, planning on the server. """
+    return _destPlanning(remote=True)
+
+
+def _bulk(encrypt, chunks=64, streams=4):
+    """ Move chunks of random data over localhost TCP connections, checking what arrives. """
+    listener = bulk.Listener(encrypt)
+    chunk = os.urandom(bulk.theChunkSize)
+    streamIDs = iter(xrange(1 << 32))
+
+    def transfer(cut=False):
+        """ Send the chunks, or cut the connections after them, and return the bytes read. """
+        streamID = next(streamIDs)
+        connections = bulk.connect('localhost', listener.port, listener.token, streamID, streams)
+        sender = bulk.Sender(streamID, connections, listener.cipher)
+        receiver = bulk.Receiver(
+            streamID, listener.connections(streamID, streams), listener.cipher,
+        )
+
+        def send():
+            for _ in xrange(chunks):
+                sender.write(memoryview(chunk))
+            if not cut:
+                sender.close()
+
+        thread = threading.Thread(target=send)
+        thread.start()
+
+        total = 0
+        try:
+            for _ in xrange(chunks):
+                if receiver.read() != chunk:
+                    raise Exception("Chunk %d was damaged or out of order" % (total // len(chunk)))
+                total += len(chunk)
+
+            if cut:
+                # Everything arrived, but not the sealed end of the stream
+                sender.abort()
+                try:
+                    receiver.read()
+                except Exception:
+                    return total  # As it should
+                raise Exception("A TCP stream cut short was taken as complete")
+
+            if receiver.read() != "":
+                raise Exception("Data after the end of the stream")
+        finally:
+            thread.join()
+            receiver.abort()
+
+        return total
+
+    transfer(cut=True)
+
+    return (transfer, chunks, listener.close)
+
+
+@benchmark
+def bulkPlain():
+    """ Move 64 MiB over 4 localhost TCP connections, unencrypted, per MiB. """
+    return _bulk(encrypt=False)
+
+
+@benchmark
+def bulkEncrypted():
+    """ Move 64 MiB over 4 localhost TCP connections, sealed with AES-GCM, per MiB. """
+    return _bulk(encrypt=True)
+
+
+def main():
+    """ Main program. """
+    args = command.parse_args()
+
+    if args.memory_server is not None:
+        server = SSHStore.StoreProxyServer("/benchmark/", 'r')
+        return server.serve(_MemoryStore(args.memory_server))
+
+    for fn in theBenchmarks:
+        name = fn.__name__
+        if args.pattern not in name:
+            continue
+
+        result = fn()
+        (run, items) = result[:2]
+        timer = timeit.Timer(run)
+
+        number = args.number
+        if number is None:
+            number = 1
+            while timer.timeit(number) < 0.2:
+                number *= 10
+
+        elapsed = min(timer.repeat(3, number)) / number
+
+        print("%-24s %10.2f us/call %10.2f us/item  %s" % (
+            name,
+            elapsed * 1e6,
+            elapsed * 1e6 / items,
+            fn.__doc__.strip(),
+        ))
+
+        if len(result) > 2:
+            result[2]()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -13,6 +13,7 @@ from ioctl import Structure, t
 from util import pretty, humanize
 
 import collections
+import errno
 import ioctl
 import logging
 import os.path
@@ -90,11 +91,21 @@ btrfs_ioctl_dev_info_args = Structure(
     packed=True
 )
 
+BTRFS_FS_INFO_FLAG_GENERATION = (1 << 1)
+
 btrfs_ioctl_fs_info_args = Structure(
     (t.u64, 'max_id'),               # /* out */
     (t.u64, 'num_devices'),          # /* out */
     (t.u8, 'fsid', BTRFS_FSID_SIZE, bytes2uuid, uuid2bytes),     # /* out */
-    (t.u64, 'reserved', 124, t.readBuffer),            # /* pad to 1k */
+    (t.u32, 'nodesize'),             # /* out */
+    (t.u32, 'sectorsize'),           # /* out */
+    (t.u32, 'clone_alignment'),      # /* out */
+    (t.u16, 'csum_type'),            # /* out */
+    (t.u16, 'csum_size'),            # /* out */
+    (t.u64, 'flags'),                # /* in/out */
+    (t.u64, 'generation'),           # /* out */
+    (t.u8, 'metadata_uuid', BTRFS_FSID_SIZE, bytes2uuid, uuid2bytes),  # /* out */
+    (t.u64, 'reserved', 118, t.readBuffer),            # /* pad to 1k */
     packed=True
 )
 
@@ -294,6 +305,36 @@ btrfs_ioctl_received_subvol_args = Structure(
     packed=True
 )
 
+btrfs_ioctl_timespec = Structure(
+    (t.u64, 'sec'),
+    (t.u32, 'nsec'),
+    ('x', 'pad', 4),
+    packed=True
+)
+
+BTRFS_VOL_NAME_MAX = 255
+btrfs_ioctl_get_subvol_info_args = Structure(
+    (t.u64, 'treeid'),                      # /* out */
+    (t.char, 'name', BTRFS_VOL_NAME_MAX + 1, t.readString, t.writeString),
+    (t.u64, 'parent_id'),                   # /* out */
+    (t.u64, 'dirid'),                       # /* out */
+    (t.u64, 'generation'),                  # /* out */
+    (t.u64, 'flags'),                       # /* out */
+    (t.u8, 'uuid', BTRFS_UUID_SIZE, bytes2uuid, uuid2bytes),
+    (t.u8, 'parent_uuid', BTRFS_UUID_SIZE, bytes2uuid, uuid2bytes),
+    (t.u8, 'received_uuid', BTRFS_UUID_SIZE, bytes2uuid, uuid2bytes),
+    (t.u64, 'ctransid'),
+    (t.u64, 'otransid'),
+    (t.u64, 'stransid'),
+    (t.u64, 'rtransid'),
+    (btrfs_ioctl_timespec, 'ctime'),
+    (btrfs_ioctl_timespec, 'otime'),
+    (btrfs_ioctl_timespec, 'stime'),
+    (btrfs_ioctl_timespec, 'rtime'),
+    (t.u64, 'reserved', 8, t.readBuffer),
+    packed=True
+)
+
 BTRFS_IOCTL_MAGIC = 0x94
 
 objectTypeKeys = {
@@ -347,6 +388,7 @@ BTRFS_ROOT_SUBVOL_RDONLY = (1 << 0)
 
 BTRFS_ROOT_TREE_OBJECTID = 1
 BTRFS_FS_TREE_OBJECTID = 5
+BTRFS_ROOT_TREE_DIR_OBJECTID = 6
 BTRFS_QUOTA_TREE_OBJECTID = 8
 
 
@@ -363,7 +405,7 @@ class _Volume(object):
         self.current_gen = info.ctransid
         # self.size = info.bytes_used
         self.readOnly = bool(info.flags & BTRFS_ROOT_SUBVOL_RDONLY)
-        self.level = info.level
+        self.level = getattr(info, 'level', None)  # Not in btrfs_ioctl_get_subvol_info_args
         self.uuid = info.uuid
         self.parent_uuid = info.parent_uuid
         self.received_uuid = info.received_uuid
@@ -483,6 +525,14 @@ class _Volume(object):
         return SnapShot(path)
 
 
+def _isSubvolume(path):
+    """ True if path is the root directory of a subvolume. """
+    try:
+        return os.path.isdir(path) and os.lstat(path).st_ino == BTRFS_FIRST_FREE_OBJECTID
+    except OSError:
+        return False
+
+
 def timeOrNone(btrfsTime):
     return btrfsTime if btrfsTime.sec or btrfsTime.nsec else None
 
@@ -511,19 +561,151 @@ class FileSystem(ioctl.Device):
         self.volumes = {}
         self.mounts = {}
 
+        # Last committed transaction when subvolumes were scanned
+        self.generation = None
+
     @property
     def subvolumes(self):
-        """ Subvolumes contained in this mount. """
+        """ Subvolumes contained in this mount.
+
+        Later calls only reread what changed since the last call.
+        """
         self.SYNC()
         self._getDevices()
-        self._getRoots()
+
+        generation = self._getGeneration()
+
+        if self._rootsChanged(generation):
+            self.volumes = {}
+            self.defaultID = None
+            self._getRoots()
+            self._getUsage()
+        elif generation != self.generation:
+            # Quota sizes change with almost every write
+            self._getUsage()
+
+        self.generation = generation
+
+        self.mounts = {}
         self._getMounts()
-        self._getUsage()
 
         volumes = self.volumes.values()
         volumes.sort(key=(lambda v: v.fullPath))
         return volumes
 
+    def subvolumesNear(self, path):
+        """ Subvolume at path, and its candidate diff parents, without reading every subvolume.
+
+        Candidates are the snapshots in the same directory, found from its
+        directory's root refs, and the snapshots sharing a parent or received
+        uuid with it, wherever they are.  One pass over the root tree finds
+        them, and only their paths and quota sizes are looked up.
+
+        Raises IOError if the kernel doesn't support BTRFS_IOC_GET_SUBVOL_INFO.
+        """
+        self.SYNC()
+        self._getDevices()
+
+        if not _isSubvolume(path):
+            raise IOError(errno.EINVAL, "Not a subvolume", path)
+
+        with SnapShot(path) as snapShot:
+            info = snapShot.GET_SUBVOL_INFO()
+
+        self.volumes = {}
+        self.mounts = {}
+        self.defaultID = None
+
+        # Only some subvolumes are read, so the next full scan must start over
+        self.generation = None
+
+        try:
+            siblings = set(self._getChildren(info.parent_id, info.dirid))
+            siblings.add(info.treeid)
+
+            related = set(
+                uuid for uuid in (info.uuid, info.parent_uuid, info.received_uuid)
+                if uuid is not None
+            )
+
+            def isCandidate(rootid, item):
+                return rootid in siblings or any(
+                    getattr(item, name, None) in related
+                    for name in ('uuid', 'parent_uuid', 'received_uuid')
+                )
+
+            # This also finds the default subvolume, which identifies mount points
+            self._getRoots(match=isCandidate)
+
+            # Paths go through the subvolumes containing these
+            for volume in self.volumes.values():
+                for (dirTree, dirID, dirSeq) in volume.links.keys():
+                    self._getRoot(dirTree)
+
+            if self.defaultID is not None:
+                self._getRoot(self.defaultID)
+
+            self._getMounts()
+            self._getUsage(self.volumes.keys())
+        except Exception:
+            self.volumes = {}
+            self.mounts = {}
+            self.defaultID = None
+            raise
+
+        volumes = self.volumes.values()
+        volumes.sort(key=(lambda v: v.fullPath))
+        return volumes
+
+    def _getGeneration(self):
+        """ Return the last committed transaction, or None if the kernel won't say. """
+        info = self.FS_INFO(flags=BTRFS_FS_INFO_FLAG_GENERATION)
+        return info.generation if info.flags & BTRFS_FS_INFO_FLAG_GENERATION else None
+
+    def _rootsChanged(self, generation):
+        """ True if subvolumes might have been added, removed, or renamed since the last scan. """
+        if self.generation is None or generation is None:
+            return True
+
+        if generation == self.generation:
+            return False
+
+        # Subvolume names are also in the trees of the directories that hold them
+        trees = set([BTRFS_ROOT_TREE_OBJECTID])
+        for vol in self.volumes.values():
+            trees.update(dirTree for (dirTree, dirID, dirSeq) in vol.links)
+
+        return any(self._changedSince(tree, self.generation) for tree in trees)
+
+    def _changedSince(self, treeid, generation):
+        """ True if any of the tree's items were written after generation. """
+        for item in self._walkTree(treeid, minTransid=generation + 1):
+            return True
+        return False
+
+    def _getChildren(self, treeid, dirid):
+        """ Yield the ids of subvolumes directly inside directory dirid of tree treeid. """
+        refKey = objectTypeKeys['BTRFS_ROOT_REF_KEY']
+        first = FileSystem.Key(treeid, refKey, 0)
+        last = FileSystem.Key(treeid, refKey, t.max_u64)
+
+        for (header, buf) in self._walkTree(BTRFS_ROOT_TREE_OBJECTID, first, last):
+            if header.type == refKey and buf.read(btrfs_root_ref).dirid == dirid:
+                yield header.offset
+
+    def _getRoot(self, rootid):
+        """ Add one subvolume from the root tree, and the subvolumes containing it. """
+        if rootid in self.volumes:
+            return
+
+        self._getRoots(rootid)
+
+        if rootid not in self.volumes:
+            return
+
+        for (dirTree, dirID, dirSeq) in self.volumes[rootid].links.keys():
+            self._getRoot(dirTree)
+
     def _rescanSizes(self, force=True):
         """ Zero and recalculate quota sizes to subvolume sizes will be correct. """
         status = self.QUOTA_CTL(cmd=BTRFS_QUOTA_CTL_ENABLE).status
@@ -608,8 +790,9 @@ class FileSystem(ioctl.Device):
 
     Key.next = (lambda key: FileSystem.Key(key.objectid, key.type, key.offset + 1))
 
-    def _walkTree(self, treeid):
-        key = FileSystem.Key.first
+    def _walkTree(self, treeid, first=None, last=None, minTransid=0):
+        key = first or FileSystem.Key.first
+        last = last or FileSystem.Key.last
 
         while True:
             # Returned objects seem to be monotonically increasing in (objectid, type, offset)
@@ -618,43 +801,58 @@ class FileSystem(ioctl.Device):
                 key=dict(
                     tree_id=treeid,
                     min_type=key.type,
-                    max_type=FileSystem.Key.last.type,
+                    max_type=last.type,
                     min_objectid=key.objectid,
-                    max_objectid=FileSystem.Key.last.objectid,
+                    max_objectid=last.objectid,
                     min_offset=key.offset,
-                    max_offset=FileSystem.Key.last.offset,
-                    min_transid=0,
+                    max_offset=last.offset,
+                    min_transid=minTransid,
                     max_transid=t.max_u64,
                     nr_items=4096,
                 ),
             )
             # logger.debug("Search key result: \n%s", pretty(result.key))
 
-            buf = ioctl.Buffer(result.buf)
             results = result.key.nr_items
 
-            # logger.debug("Reading %d nodes from %d bytes", results, buf.len)
+            # logger.debug("Reading %d nodes", results)
             if results == 0:
                 break
 
-            for _ in xrange(results):
-                # assert buf.len >= btrfs_ioctl_search_header.size, buf.len
-                data = buf.read(btrfs_ioctl_search_header)
-
+            for (data, buf) in btrfs_ioctl_search_header.readRecords(result.buf, results):
                 # logger.debug("Object %d: %s", i, pretty(data))
 
-                # assert buf.len >= data.len, (buf.len, data.len)
-                yield (data, buf.readBuffer(data.len))
+                yield (data, buf)
 
                 key = FileSystem.Key(data.objectid, data.type, data.offset).next()
 
-    def _getRoots(self):
-        for (header, buf) in self._walkTree(BTRFS_ROOT_TREE_OBJECTID):
+    def _getRoots(self, objectid=None, match=None):
+        """ Read root tree items, for all objects or just objectid.
+
+        If match is given, only subvolumes for which match(rootid, rootItem) is true are added.
+        """
+        # Snapshots often share directories
+        directories = {}
+
+        if objectid is None:
+            (first, last) = (None, None)
+        else:
+            first = FileSystem.Key(objectid, 0, 0)
+            last = FileSystem.Key(objectid, t.max_u32, t.max_u64)
+
+        for (header, buf) in self._walkTree(BTRFS_ROOT_TREE_OBJECTID, first, last):
             if header.type == objectTypeKeys['BTRFS_ROOT_BACKREF_KEY']:
+                if header.objectid not in self.volumes:
+                    continue
+
                 info = buf.read(btrfs_root_ref)
                 name = buf.readView(info.name_len).tobytes()
 
-                directory = self.INO_LOOKUP(treeid=header.offset, objectid=info.dirid)
+                if (header.offset, info.dirid) not in directories:
+                    directories[(header.offset, info.dirid)] = self.INO_LOOKUP(
+                        treeid=header.offset, objectid=info.dirid,
+                    )
+                directory = directories[(header.offset, info.dirid)]
 
                 logger.debug("%s: %s %s", name, pretty(info), pretty(directory))
 
@@ -677,7 +875,7 @@ class FileSystem(ioctl.Device):
                     (header.objectid >= BTRFS_FIRST_FREE_OBJECTID
                      and header.objectid <= BTRFS_LAST_FREE_OBJECTID)
                         or header.objectid == BTRFS_FS_TREE_OBJECTID
-                ):
+                ) and (match is None or match(header.objectid, info)):
                     assert header.objectid not in self.volumes, header.objectid
                     self.volumes[header.objectid] = _Volume(
                         self,
@@ -692,17 +890,30 @@ class FileSystem(ioctl.Device):
                     self.defaultID = info.location.objectid
                 logger.debug("Found dir '%s' is %d", name, self.defaultID)
 
-    def _getUsage(self):
+    def _getUsage(self, rootids=None):
         try:
             self._rescanSizes(False)
-            self._unsafeGetUsage()
+            self._unsafeGetUsage(rootids)
         except (IOError, _BtrfsError) as error:
             logger.warn("%s", error)
             self._rescanSizes()
-            self._unsafeGetUsage()
+            self._unsafeGetUsage(rootids)
 
-    def _unsafeGetUsage(self):
-        for (header, buf) in self._walkTree(BTRFS_QUOTA_TREE_OBJECTID):
+    def _unsafeGetUsage(self, rootids=None):
+        """ Read quota sizes, for all subvolumes or just the level 0 qgroups for rootids. """
+        if rootids is None:
+            ranges = [(None, None)]
+        else:
+            infoKey = objectTypeKeys['BTRFS_QGROUP_INFO_KEY']
+            ranges = [
+                (FileSystem.Key(0, infoKey, rootid), FileSystem.Key(0, infoKey, rootid))
+                for rootid in rootids
+            ]
+
+        for (header, buf) in (
+            item for (first, last) in ranges
+            for item in self._walkTree(BTRFS_QUOTA_TREE_OBJECTID, first, last)
+        ):
             # logger.debug("%s %s", objectTypeNames[header.type], header)
 
             if header.type == objectTypeKeys['BTRFS_QGROUP_INFO_KEY']:
@@ -781,6 +992,7 @@ class SnapShot(ioctl.Device):
     SET_RECEIVED_SUBVOL = Control.IOWR(37, btrfs_ioctl_received_subvol_args)
     SUBVOL_GETFLAGS = Control.IOR(25, btrfs_flags)
     SUBVOL_SETFLAGS = Control.IOW(26, btrfs_flags)
+    GET_SUBVOL_INFO = Control.IOR(60, btrfs_ioctl_get_subvol_info_args)
 
 
 # define BTRFS_IOC_START_SYNC _IOR(BTRFS_IOCTL_MAGIC, 24, __u64)
@@ -0,0 +1,396 @@
+""" Bulk data over parallel TCP connections, beside an ssh control connection.
+
+The ssh connection authenticates both ends, and carries a one-time token,
+port, and (optional) key for each session.  Each stream then opens its own
+TCP connections, and sends its data as sequenced chunks spread across them.
+Each connection ends with a record of the chunk count and the total size,
+so a stream that was cut short can't pass as complete.  Chunks and end
+records are sealed with AES-GCM, or left plain on trusted networks.
+
+Copyright (c) 2014-2016 Ames Cornish.  All rights reserved.  Licensed under GPLv3.
+"""
+
+import hmac
+import logging
+import os
+import Queue
+import socket
+import struct
+import threading
+
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM = None
+
+logger = logging.getLogger(__name__)
+# logger.setLevel('DEBUG')
+
+theHello = struct.Struct("!16sI")          # token, stream id
+theChunkHeader = struct.Struct("!QI")      # sequence number, payload length (0 ends)
+theEnd = struct.Struct("!Q")               # total size, the payload of an end record
+theNonce = struct.Struct("!IQ")            # stream id, sequence number
+
+# Set in the nonce of end records, so they never share one with a chunk
+theEndFlag = 1 << 63
+
+theChunkSize = 1 << 20
+theWindow = 32             # Chunks a receiver holds ahead of its reader
+theConnectTimeout = 30     # Seconds to wait for a stream's connections
+
+available = AESGCM is not None
+
+
+class Cipher(object):
+
+    """ Seals and opens chunks with AES-GCM, or passes them through without a key. """
+
+    def __init__(self, key=None):
+        """ Initialize. """
+        if key is not None and AESGCM is None:
+            raise Exception("Encrypted TCP transfers need the 'cryptography' package")
+
+        self._aead = AESGCM(key) if key is not None else None
+
+    def seal(self, streamID, header, data):
+        """ Return the payload to send after header. """
+        if self._aead is None:
+            return data
+        return self._aead.encrypt(self._nonce(streamID, header), data, header)
+
+    def open(self, streamID, header, payload):
+        """ Return the data in a received payload, or raise if it's been tampered with. """
+        if self._aead is None:
+            return payload
+        return self._aead.decrypt(self._nonce(streamID, header), payload, header)
+
+    def _nonce(self, streamID, header):
+        (sequence, size) = theChunkHeader.unpack(header)
+        return theNonce.pack(streamID, sequence if size else sequence | theEndFlag)
+
+    @property
+    def overhead(self):
+        """ Bytes added to each sealed chunk. """
+        return 0 if self._aead is None else 16
+
+
+class Listener(object):
+
+    """ Accepts a session's TCP connections, and sorts them by stream. """
+
+    def __init__(self, encrypt):
+        """ Initialize. """
+        self.token = os.urandom(16)
+        self.key = AESGCM.generate_key(bit_length=256) if encrypt and AESGCM else None
+        self.cipher = Cipher(self.key if encrypt else None)
+
+        try:
+            # Accept IPv4 and IPv6 connections
+            self._socket = socket.socket(socket.AF_INET6)
+            self._socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        except (socket.error, AttributeError) as error:
+            logger.debug("Listening for IPv4 only (%s)", error)
+            self._socket = socket.socket(socket.AF_INET)
+
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(('', 0))
+        self._socket.listen(16)
+        self.port = self._socket.getsockname()[1]
+
+        # {stream id: [sockets]}
+        self._connections = {}
+        self._connected = threading.Condition()
+
+        thread = threading.Thread(target=self._accept, name="bulk listener")
+        thread.daemon = True
+        thread.start()
+
+    def connections(self, streamID, count):
+        """ Wait for, and return, count connections for a stream. """
+        with self._connected:
+            connections = self._connections.setdefault(streamID, [])
+
+            for _ in xrange(theConnectTimeout * 10):
+                if len(connections) >= count:
+                    break
+                self._connected.wait(0.1)
+            else:
+                raise Exception("Only %d of %d TCP connections arrived" % (len(connections), count))
+
+            return self._connections.pop(streamID)
+
+    def close(self):
+        """ Stop accepting connections. """
+        self._socket.close()
+
+    def _accept(self):
+        while True:
+            try:
+                (connection, address) = self._socket.accept()
+            except socket.error as error:
+                logger.debug("Stopped listening: %s", error)
+                return
+
+            try:
+                connection.settimeout(theConnectTimeout)
+                (token, streamID) = theHello.unpack(_receive(connection, theHello.size))
+                connection.settimeout(None)
+            except Exception as error:
+                logger.warn("Bad TCP connection from %s: %s", address, error)
+                connection.close()
+                continue
+
+            if not hmac.compare_digest(token, self.token):
+                logger.warn("Rejected TCP connection from %s", address)
+                connection.close()
+                continue
+
+            with self._connected:
+                self._connections.setdefault(streamID, []).append(connection)
+                self._connected.notify_all()
+
+
+def connect(host, port, token, streamID, count):
+    """ Open count connections to a Listener for a stream. """
+    connections = []
+
+    try:
+        for _ in xrange(count):
+            connection = socket.create_connection((host, port), theConnectTimeout)
+            connection.settimeout(None)
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connections.append(connection)
+            connection.sendall(theHello.pack(token, streamID))
+    except Exception:
+        for connection in connections:
+            connection.close()
+        raise
+
+    return connections
+
+
+class Sender(object):
+
+    """ Sends a stream as sequenced chunks, spread over several connections.
+
+    An encrypted stream over localhost, written from a bytearray and a memoryview:
+
+    >>> listener = Listener(encrypt=True)
+    >>> connections = connect('localhost', listener.port, listener.token, 7, 2)
+    >>> sender = Sender(7, connections, listener.cipher)
+    >>> receiver = Receiver(7, listener.connections(7, 2), listener.cipher)
+    >>> data = os.urandom(3 * theChunkSize + 1000)
+    >>> sender.write(bytearray(data[:1000]))
+    >>> sender.write(memoryview(data)[1000:])
+    >>> sender.close()
+    >>> received = []
+    >>> while not received or received[-1]:
+    ...     received.append(receiver.read())
+    >>> "".join(received) == data
+    True
+    >>> receiver.totalSize == sender.totalSize == len(data)
+    True
+    >>> listener.close()
+    """
+
+    def __init__(self, streamID, connections, cipher):
+        """ Initialize. """
+        self.streamID = streamID
+        self.error = None
+        self._connections = connections
+        self._cipher = cipher
+        self._sequence = 0
+        self.totalSize = 0
+
+        # Bounded, so writes wait for the network
+        self._chunks = Queue.Queue(2 * len(connections))
+
+        self._threads = [
+            threading.Thread(target=self._send, args=(connection,), name="bulk sender")
+            for connection in connections
+        ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def write(self, data):
+        """ Queue data to send.
+
+        Data may be a string, bytearray or memoryview, which is copied before it's queued.
+        """
+        data = memoryview(data)
+
+        for offset in xrange(0, len(data), theChunkSize):
+            self._check()
+            self._chunks.put((self._sequence, data[offset:offset + theChunkSize].tobytes()))
+            self._sequence += 1
+        self.totalSize += len(data)
+        self._check()
+
+    def close(self):
+        """ Send the end of the stream, and wait for everything to be sent. """
+        for _ in self._threads:
+            self._chunks.put((self._sequence, None))
+
+        for thread in self._threads:
+            thread.join()
+
+        self.abort()
+        self._check()
+
+    def abort(self):
+        """ Stop sending, and close the connections. """
+        for connection in self._connections:
+            _shutdown(connection)
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def _send(self, connection):
+        while True:
+            (sequence, data) = self._chunks.get()
+
+            try:
+                if self.error is not None:
+                    pass  # Discard the rest
+                elif data is None:
+                    # Each connection ends with the count of chunks and the total size
+                    header = theChunkHeader.pack(sequence, 0)
+                    connection.sendall(header)
+                    connection.sendall(
+                        self._cipher.seal(self.streamID, header, theEnd.pack(self.totalSize))
+                    )
+                else:
+                    header = theChunkHeader.pack(sequence, len(data))
+                    connection.sendall(header)
+                    connection.sendall(self._cipher.seal(self.streamID, header, data))
+            except Exception as error:
+                logger.debug("Bulk send error: %s", error)
+                self.error = self.error or error
+                self.abort()
+
+            if data is None:
+                return
+
+
+class Receiver(object):
+
+    """ Reassembles a stream's chunks from several connections, in order. """
+
+    def __init__(self, streamID, connections, cipher):
+        """ Initialize. """
+        self.streamID = streamID
+        self.error = None
+        self._connections = connections
+        self._cipher = cipher
+
+        # {sequence: data} received ahead of the reader
+        self._chunks = {}
+        self._next = 0
+        self._end = None
+        self.totalSize = 0
+        self._expectedSize = None
+        self._running = len(connections)
+        self._changed = threading.Condition()
+
+        self._threads = [
+            threading.Thread(target=self._receive, args=(connection,), name="bulk receiver")
+            for connection in connections
+        ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def read(self):
+        """ Return the next chunk of data, or an empty string at the end of the stream. """
+        with self._changed:
+            while self._next not in self._chunks:
+                if self._next == self._end:
+                    if self.totalSize != self._expectedSize:
+                        raise Exception("Received %d of %d bytes over TCP" % (
+                            self.totalSize, self._expectedSize,
+                        ))
+                    return ""
+
+                if self.error is not None:
+                    raise self.error
+
+                if self._running == 0:
+                    raise Exception("TCP connections ended before the stream")
+
+                self._changed.wait()
+
+            data = self._chunks.pop(self._next)
+            self._next += 1
+            self.totalSize += len(data)
+            self._changed.notify_all()
+            return data
+
+    def abort(self):
+        """ Stop receiving, and close the connections. """
+        with self._changed:
+            self.error = self.error or Exception("TCP transfer aborted")
+            self._changed.notify_all()
+
+        for connection in self._connections:
+            _shutdown(connection)
+
+    def _receive(self, connection):
+        try:
+            while True:
+                header = _receive(connection, theChunkHeader.size)
+                (sequence, size) = theChunkHeader.unpack(header)
+
+                if size == 0:
+                    payload = _receive(connection, theEnd.size + self._cipher.overhead)
+                    (total, ) = theEnd.unpack(self._cipher.open(self.streamID, header, payload))
+
+                    with self._changed:
+                        end = (sequence, total)
+                        if self._end is not None and (self._end, self._expectedSize) != end:
+                            raise Exception("TCP connections disagree about the end of the stream")
+                        (self._end, self._expectedSize) = end
+                        self._changed.notify_all()
+                    return
+
+                payload = _receive(connection, size + self._cipher.overhead)
+                data = self._cipher.open(self.streamID, header, payload)
+
+                with self._changed:
+                    while sequence >= self._next + theWindow and self.error is None:
+                        self._changed.wait()
+                    self._chunks[sequence] = data
+                    self._changed.notify_all()
+        except Exception as error:
+            logger.debug("Bulk receive error: %s", error)
+            with self._changed:
+                self.error = self.error or error
+        finally:
+            with self._changed:
+                self._running -= 1
+                self._changed.notify_all()
+
+
+def _receive(connection, size):
+    """ Receive exactly size bytes. """
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+
+    while received < size:
+        count = connection.recv_into(view[received:], size - received)
+        if count == 0:
+            raise Exception("TCP connection closed")
+        received += count
+
+    del view
+    return bytes(data)
+
+
+def _shutdown(connection):
+    try:
+        connection.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+        pass
+    connection.close()
@@ -21,8 +21,10 @@ if True:  # Headers
         from util import humanize
         import BestDiffs
         import ButterStore
+        import daemon
         import S3Store
         import SSHStore
+        import Store
 
 theDebug = bool(
     os.environ.get(
@@ -40,6 +42,8 @@ except IOError:
     theVersion = "<unknown>"
 
 theChunkSize = 100
+theTCPStreams = 4
+theMeasureWorkers = 1
 
 command = argparse.ArgumentParser(
     description="Synchronize two sets of btrfs snapshots.",
@@ -85,13 +89,99 @@ command.add_argument('-V', '--version', action="version", version='%(prog)s ' +
 command.add_argument('--part-size', action="store", type=int, default=theChunkSize,
                      help=('MB size of chunks in a multipart upload (default ' +
                            str(theChunkSize) +
-                           ')'
+                           ', larger for diffs that need it)'
                            ),
                      )
 
+command.add_argument('--verify', action="store_true",
+                     help="check the crc of every send stream command during transfers."
+                     " If only <dst> is supplied, check the diffs already stored there.",
+                     )
+
 command.add_argument('--exclude', action="append", type=str,
                      help="regular expresion to exclude subvols")
 
+command.add_argument('--measure-workers', action="store", type=int, default=theMeasureWorkers,
+                     help=('number of diffs to measure at once in each btrfs store (default ' +
+                           str(theMeasureWorkers) +
+                           ')'
+                           ),
+                     )
+
+command.add_argument('--direct', action="store_true",
+                     help="when both <src> and <dst> are remote, have them transfer diffs"
+                     " between themselves, instead of through this host",
+                     )
+
+command.add_argument('--tcp', choices=['encrypted', 'plain'],
+                     help="move ssh diff data over separate TCP connections,"
+                     " encrypted, or plain for trusted networks",
+                     )
+
+command.add_argument('--tcp-streams', action="store", type=int, default=theTCPStreams,
+                     help=('number of parallel TCP connections for each diff (default ' +
+                           str(theTCPStreams) +
+                           ')'
+                           ),
+                     )
+
+command.add_argument('--s3-whole-bucket', action="store_true",
+                     help="list the whole S3 bucket, to reuse diffs stored under other prefixes",
+                     )
+
+command.add_argument('--s3-trash', choices=['copy', 'tag'], default='copy',
+                     help="how --delete trashes S3 diffs: copy them under trash/ (default),"
+                     " or tag them for a lifecycle rule to expire, in a versioned bucket",
+                     )
+
+command.add_argument('--s3-copy-workers', type=int, default=S3Store.theCopyWorkers,
+                     help="number of S3 diffs, and parts of each large diff, to copy at once"
+                     " within the bucket (default %d)" % (S3Store.theCopyWorkers, ),
+                     )
+
+command.add_argument('--s3-dedup', action="store_true",
+                     help="store new S3 diffs as content-defined chunks, shared across the"
+                     " bucket, so identical data is only stored once",
+                     )
+
+command.add_argument('--s3-bundle', action="store_true",
+                     help="pack small S3 diffs and snapshot info into bundle objects, instead of"
+                     " storing each one separately",
+                     )
+
+command.add_argument('--s3-shard', action="store_true",
+                     help="store new S3 keys in hashed sub-prefixes, for more requests per"
+                     " second; with only <dst>, move its existing diffs into them",
+                     )
+
+command.add_argument('--zstd', action="store_true",
+                     help="compress ssh diff data with zstd, adapting the level to CPU and link"
+                     " speed (needs 'zstandard' on both hosts)",
+                     )
+
+command.add_argument('--ssh-cipher', metavar='CIPHER',
+                     help="cipher for ssh connections, e.g. aes128-gcm@openssh.com",
+                     )
+
+command.add_argument('--ssh-compress', action="store_true",
+                     help="compress ssh connections (helps only on slow links)",
+                     )
+
+command.add_argument('--ssh-keepalive', metavar='SECONDS', type=int,
+                     help="check idle ssh connections every SECONDS, and drop dead ones",
+                     )
+
+command.add_argument('--ssh-persist', metavar='SECONDS', type=int,
+                     default=SSHStore.theSSHOptions.persist,
+                     help="share one ssh connection per host between buttersinks, keeping it"
+                     " SECONDS after the last one exits (default 0, separate connections)",
+                     )
+
+command.add_argument('--daemon', action="store_true",
+                     help="serve ssh sessions from a long-running process,"
+                     " listening on the unix socket <dst> (usually " + daemon.theSocketPath + ")",
+                     )
+
 # Internals for SSH communication between two buttersinks
 
 command.add_argument('--server', action="store_true",
@@ -145,8 +235,11 @@ def _setupLogging(quiet, logFile, isServer):
     logging.getLogger('boto').setLevel("WARN")
 
 
-def parseSink(uri, isDest, willDelete, dryrun):
-    """ Parse command-line description of sink into a sink object. """
+def parseSink(uri, isDest, willDelete, dryrun, mode=None):
+    """ Parse command-line description of sink into a sink object.
+
+    mode overrides the one chosen from isDest and willDelete.
+    """
     if uri is None:
         return None
 
@@ -177,12 +270,13 @@ def parseSink(uri, isDest, willDelete, dryrun):
     if isDest and not path.endswith("/"):
         path += "/"
 
-    if not isDest:
-        mode = 'r'
-    elif willDelete:
-        mode = 'w'
-    else:
-        mode = 'a'
+    if mode is None:
+        if not isDest:
+            mode = 'r'
+        elif willDelete:
+            mode = 'w'
+        else:
+            mode = 'a'
 
     Sinks = {
         'btrfs': ButterStore.ButterStore,
@@ -194,16 +288,43 @@ def parseSink(uri, isDest, willDelete, dryrun):
     return Sinks[parts['method']](host, path, mode, dryrun)
 
 
+def _verifyDiffs(sink, chunkSize):
+    """ Check the send streams stored in sink, and return the exit code. """
+    (count, errors) = (0, 0)
+
+    for diff in sink.listDiffs():
+        logger.info("Verify: %s", diff)
+        count += 1
+
+        try:
+            Store.verify(sink.send(diff), chunkSize)
+        except Exception as error:
+            logger.error("%s: %s", diff, error)
+            errors += 1
+
+    logger.info("Verified %d diffs, %d bad", count, errors)
+
+    return 1 if errors else 0
+
+
 def main():
     """ Main program. """
     try:
         args = command.parse_args()
 
-        _setupLogging(args.quiet, args.logfile, args.server)
+        _setupLogging(args.quiet, args.logfile, args.server or args.daemon)
 
         logger.debug("Version: %s, Arguments: %s", theVersion, vars(args))
 
+        if args.daemon:
+            return daemon.Daemon(args.dest).run()
+
         if args.server:
+            connection = daemon.connect(args.mode, args.dest)
+            if connection is not None:
+                logger.debug("Relaying to daemon")
+                return daemon.relay(connection, sys.stdin, sys.stdout)
+
             server = SSHStore.StoreProxyServer(args.dest, args.mode)
             return(server.run())
 
@@ -215,6 +336,54 @@ def main():
             source = dest
             dest = None
 
+            if args.s3_shard:
+                # Moving a store's keys into shards deletes the old ones
+                source = parseSink(args.dest, False, args.delete, args.dry_run, mode='w')
+
+        sshOptions = SSHStore.SSHOptions(
+            cipher=args.ssh_cipher,
+            compress=args.ssh_compress,
+            keepalive=args.ssh_keepalive,
+            persist=args.ssh_persist,
+        )
+
+        for sink in (source, dest):
+            if isinstance(sink, SSHStore.SSHStore):
+                sink.sshOptions = sshOptions
+
+        if args.direct and dest is not None:
+            if isinstance(source, SSHStore.SSHStore) and not isinstance(dest, SSHStore.SSHStore):
+                # Only the source server can reach the dest, and it writes there as root
+                source = parseSink(args.source, False, args.delete, args.dry_run, mode='a')
+                source.sshOptions = sshOptions
+
+            source.direct = dest.direct = True
+
+        if args.tcp:
+            for sink in (source, dest):
+                if isinstance(sink, SSHStore.SSHStore):
+                    sink.tcp = (args.tcp == 'encrypted', args.tcp_streams)
+
+        if args.s3_whole_bucket:
+            for sink in (source, dest):
+                if isinstance(sink, S3Store.S3Store):
+                    sink.prefixOnly = False
+
+        if isinstance(dest, S3Store.S3Store):
+            dest.trashMode = args.s3_trash
+            dest.copyWorkers = args.s3_copy_workers
+            dest.partSize = args.part_size << 20
+            dest.dedup = args.s3_dedup
+            dest.bundling = args.s3_bundle
+
+            if args.s3_shard:
+                dest.sharded = True
+
+        if args.zstd:
+            for sink in (source, dest):
+                if isinstance(sink, SSHStore.SSHStore):
+                    sink.zstd = True
+
         if not sys.stderr.isatty():
             source.showProgress = dest.showProgress = False
         elif dest is None or (source.isRemote and not dest.isRemote):
@@ -240,6 +409,15 @@ def main():
                     )
                 return 1
 
+            if dest is None and args.s3_shard:
+                if not isinstance(source, S3Store.S3Store):
+                    raise Exception("--s3-shard only applies to S3 stores")
+                source.migrateShards()
+                return 0
+
+            if dest is None and args.verify:
+                return _verifyDiffs(source, args.part_size << 20)
+
             if dest is None:
                 for item in source.listContents():
                     print(item)
@@ -257,7 +435,9 @@ def main():
                                     return True
                         return False
                     volumes = (vol for vol in volumes if not is_excluded(vol))
-                best = BestDiffs.BestDiffs(volumes, args.delete, not args.estimate)
+                best = BestDiffs.BestDiffs(
+                    volumes, args.delete, not args.estimate, args.measure_workers,
+                )
                 best.analyze(args.part_size << 20, source, dest)
 
                 summary = best.summary()
@@ -273,7 +453,7 @@ def main():
                     if diff is None:
                         raise Exception("Missing diff.  Can't fully replicate.")
                     else:
-                        diff.sendTo(dest, chunkSize=args.part_size << 20)
+                        diff.sendTo(dest, chunkSize=args.part_size << 20, verify=args.verify)
 
                 if args.delete:
                     dest.deleteUnused()
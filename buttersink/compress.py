@@ -0,0 +1,320 @@
+""" Adaptive zstd compression for stream data over ssh.
+
+Data is sent in blocks, one per frame, each starting with a byte that says
+whether it's compressed.  Blocks are compressed in parallel on idle CPUs.
+The sender raises the zstd level while the link is slower than compression,
+lowers it while compression is slower than the link, and sends blocks as is
+while the data doesn't compress.
+
+Copyright (c) 2014-2016 Ames Cornish.  All rights reserved.  Licensed under GPLv3.
+"""
+
+import mux
+
+import collections
+import logging
+import multiprocessing
+import os
+import Queue
+import struct
+import threading
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+# logger.setLevel('DEBUG')
+
+theBlockHeader = struct.Struct("!B")
+
+# Block kinds
+(
+    RAW,        # Sent as is
+    ZSTD,       # A zstd frame, with its content size
+) = range(2)
+
+theBlockSize = mux.theFrameSize - theBlockHeader.size
+
+theMinLevel = 1
+theMaxLevel = 12
+theStartLevel = 3
+theMaxThreads = 8
+
+# Blocks that shrink less than this are sent as is
+theUsefulRatio = 0.9
+
+# Blocks sent as is after an incompressible block, doubling while it stays incompressible
+theFirstSkip = 4
+theMaxSkip = 256
+
+# Weight of the latest block in the running compress and send times
+theSmoothing = 0.25
+
+available = zstandard is not None
+
+# Codecs this host can use, in order of preference
+theCodecs = ('zstd', ) if available else ()
+
+
+def idleCPUs():
+    """ Return a count of CPUs that aren't busy, at least 1. """
+    try:
+        busy = os.getloadavg()[0]
+    except OSError:
+        busy = 0
+
+    count = int(multiprocessing.cpu_count() - busy)
+    return max(1, min(count, theMaxThreads))
+
+
+class _Block(object):
+
+    """ One block of data, compressed by a worker. """
+
+    def __init__(self, data, level):
+        self.data = data
+        self.level = level
+        self.payload = None
+        self.seconds = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class Encoder(object):
+
+    """ Compresses data into blocks, and sends them in order.
+
+    send(payload) sends one frame, and returns False if the receiver cancelled.
+    Data may be strings, bytearrays or memoryviews:
+
+    >>> frames = []
+    >>> encoder = Encoder(lambda payload: frames.append(payload) or True, threads=2)
+    >>> data = b"".join(b"%08d" % (i, ) for i in xrange(300000))
+    >>> encoder.write(bytearray(data[:1000]))
+    True
+    >>> encoder.write(memoryview(data)[1000:])
+    True
+    >>> encoder.close()
+    True
+    >>> decoder = Decoder()
+    >>> b"".join(decoder.decode(frame) for frame in frames) == data
+    True
+    """
+
+    def __init__(self, send, threads=None):
+        """ Initialize. """
+        if not available:
+            raise Exception("zstd compression needs the 'zstandard' package")
+
+        self._send = send
+        self._threads = threads or idleCPUs()
+        # Data short of a whole block
+        self._buffer = bytearray()
+
+        self.level = theStartLevel
+        self._skip = 0
+        self._nextSkip = theFirstSkip
+
+        # Running seconds per block
+        self._compressTime = None
+        self._sendTime = None
+
+        # Blocks being compressed, in sending order
+        self._pending = collections.deque()
+        self._jobs = Queue.Queue()
+        self._aborted = False
+
+        self._workers = [
+            threading.Thread(target=self._work, name="zstd compressor")
+            for _ in xrange(self._threads)
+        ]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+
+        logger.debug("Compressing with %d threads", self._threads)
+
+    def write(self, data):
+        """ Compress and send data.  Returns False if the receiver cancelled. """
+        if self._aborted:
+            return False
+
+        data = memoryview(data)
+        offset = 0
+
+        try:
+            if self._buffer:
+                offset = min(theBlockSize - len(self._buffer), len(data))
+                self._buffer += data[:offset]
+
+                if len(self._buffer) < theBlockSize:
+                    return True
+
+                (block, self._buffer) = (bytes(self._buffer), bytearray())
+                if not self._submit(block):
+                    self.abort()
+                    return False
+
+            # Whole blocks straight from the data, without buffering them
+            while len(data) - offset >= theBlockSize:
+                if not self._submit(data[offset:offset + theBlockSize].tobytes()):
+                    self.abort()
+                    return False
+                offset += theBlockSize
+
+            self._buffer += data[offset:]
+        except Exception:
+            self.abort()
+            raise
+
+        return True
+
+    def close(self):
+        """ Send any buffered data, and stop.  Returns False if the receiver cancelled. """
+        if self._aborted:
+            return False
+
+        try:
+            if self._buffer and not self._submit(bytes(self._buffer)):
+                self.abort()
+                return False
+
+            while self._pending:
+                if not self._sendNext():
+                    self.abort()
+                    return False
+        except Exception:
+            self.abort()
+            raise
+
+        self.abort()
+        return True
+
+    def abort(self):
+        """ Stop compressing, without sending anything else. """
+        self._aborted = True
+        self._pending.clear()
+
+        for _ in self._workers:
+            self._jobs.put(None)
+        self._workers = []
+
+    def _submit(self, data):
+        """ Queue a block, and send finished blocks beyond the ones being compressed. """
+        if self._skip > 0:
+            self._skip -= 1
+            block = _Block(data, None)
+            block.done.set()
+        else:
+            block = _Block(data, self.level)
+            self._jobs.put(block)
+
+        self._pending.append(block)
+
+        while len(self._pending) > self._threads:
+            if not self._sendNext():
+                return False
+
+        return True
+
+    def _sendNext(self):
+        block = self._pending.popleft()
+        block.done.wait()
+
+        if block.error is not None:
+            raise block.error
+
+        if block.payload is None or len(block.payload) > theUsefulRatio * len(block.data):
+            payload = theBlockHeader.pack(RAW) + block.data
+
+            if block.level is not None:
+                # Incompressible, so stop trying for a while
+                self._skip = self._nextSkip
+                self._nextSkip = min(2 * self._nextSkip, theMaxSkip)
+                logger.debug("Sending the next %d blocks uncompressed", self._skip)
+        else:
+            payload = theBlockHeader.pack(ZSTD) + block.payload
+            self._nextSkip = theFirstSkip
+
+        startTime = time.time()
+        if not self._send(payload):
+            return False
+
+        if block.level is not None:
+            self._adapt(block.seconds / self._threads, time.time() - startTime)
+
+        return True
+
+    def _adapt(self, compressTime, sendTime):
+        """ Pick the level that keeps compression just ahead of the link. """
+        def smooth(average, seconds):
+            if average is None:
+                return seconds
+            return (1 - theSmoothing) * average + theSmoothing * seconds
+
+        self._compressTime = smooth(self._compressTime, compressTime)
+        self._sendTime = smooth(self._sendTime, sendTime)
+
+        if self._compressTime < self._sendTime / 2 and self.level < theMaxLevel:
+            # Waiting on the link, so spend more CPU
+            self.level += 1
+        elif self._compressTime > self._sendTime and self.level > theMinLevel:
+            # Waiting on compression
+            self.level -= 1
+        else:
+            return
+
+        logger.debug(
+            "zstd level %d (compress %.3fs, send %.3fs per block)",
+            self.level, self._compressTime, self._sendTime,
+        )
+
+    def _work(self):
+        # Compressors aren't thread-safe, so each worker has its own
+        # {level: ZstdCompressor}
+        compressors = {}
+
+        while True:
+            block = self._jobs.get()
+            if block is None:
+                return
+
+            try:
+                if block.level not in compressors:
+                    compressors[block.level] = zstandard.ZstdCompressor(level=block.level)
+
+                startTime = time.time()
+                block.payload = compressors[block.level].compress(block.data)
+                block.seconds = time.time() - startTime
+            except Exception as error:
+                block.error = error
+
+            block.done.set()
+
+
+class Decoder(object):
+
+    """ Returns the data in received blocks. """
+
+    def __init__(self):
+        """ Initialize. """
+        if not available:
+            raise Exception("zstd compression needs the 'zstandard' package")
+
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    def decode(self, payload):
+        """ Return the data in a block. """
+        (kind, ) = theBlockHeader.unpack_from(payload)
+        data = buffer(payload, theBlockHeader.size)
+
+        if kind == RAW:
+            return str(data)
+
+        if kind == ZSTD:
+            return self._decompressor.decompress(data)
+
+        raise Exception("Unknown compressed block kind %d" % (kind, ))
@@ -0,0 +1,171 @@
+""" Long-running server for ssh sessions, with warm btrfs metadata.
+
+"buttersink --daemon" listens on a unix socket, usually started by systemd.
+Each "buttersink --server" started by ssh relays its session to the daemon,
+which keeps Butter and scanned subvolumes between sessions.
+
+Copyright (c) 2014-2016 Ames Cornish.  All rights reserved.  Licensed under GPLv3.
+"""
+
+import btrfs
+import Butter
+import ButterStore
+import splice
+import SSHStore
+
+import errno
+import logging
+import os
+import select
+import socket
+import threading
+import urllib
+
+logger = logging.getLogger(__name__)
+# logger.setLevel('DEBUG')
+
+theSocketPath = "/run/buttersink.sock"
+
+theBufferSize = 1 << 16
+
+
+class Daemon(object):
+
+    """ Serves proxy sessions from a unix socket, sharing Caches between them. """
+
+    def __init__(self, socketPath=theSocketPath):
+        """ Initialize. """
+        self.socketPath = socketPath
+        self.butter = Butter.Butter(dryrun=False)
+
+        # {fsid: ButterStore.Cache}
+        self.caches = {}
+        self._cachesLock = threading.Lock()
+
+    def run(self):
+        """ Accept sessions until killed.  Returns with system error code. """
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        try:
+            os.unlink(self.socketPath)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+
+        # Sessions run as root, so only root may connect
+        oldMask = os.umask(0o077)
+        try:
+            listener.bind(self.socketPath)
+        finally:
+            os.umask(oldMask)
+
+        listener.listen(16)
+        logger.info("Listening on %s", self.socketPath)
+
+        while True:
+            (connection, _) = listener.accept()
+
+            thread = threading.Thread(target=self._session, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def _session(self, connection):
+        """ Serve one relayed ssh session. """
+        input = connection.makefile('rb')
+        output = connection.makefile('wb')
+
+        try:
+            (mode, path) = [urllib.unquote_plus(arg) for arg in input.readline().split()]
+            logger.debug("Session(%s) %s", mode, path)
+
+            try:
+                cache = self._cache(path)
+            except (IOError, OSError) as error:
+                logger.debug("No cache for %s (%s)", path, error)
+                cache = None
+
+            server = SSHStore.StoreProxyServer(path, mode, input, output)
+            server.run(cache)
+        except Exception as error:
+            logger.warn("Session failed: %s", error)
+        finally:
+            try:
+                output.close()
+            except socket.error:
+                pass
+            input.close()
+            connection.close()
+
+    def _cache(self, path):
+        """ Return the Cache for the btrfs file system containing path. """
+        directory = path if os.path.isdir(path) else os.path.dirname(path)
+
+        with btrfs.FileSystem(directory) as mount:
+            fsid = mount.FS_INFO().fsid
+
+        with self._cachesLock:
+            if fsid not in self.caches:
+                self.caches[fsid] = ButterStore.Cache(self.butter)
+            return self.caches[fsid]
+
+
+def connect(mode, path, socketPath=theSocketPath):
+    """ Start a session with a running daemon, or return None if there isn't one. """
+    if not os.path.exists(socketPath):
+        return None
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        connection.connect(socketPath)
+    except socket.error as error:
+        logger.debug("No daemon at %s (%s)", socketPath, error)
+        connection.close()
+        return None
+
+    connection.sendall("%s %s\n" % (urllib.quote_plus(mode), urllib.quote_plus(path)))
+
+    return connection
+
+
+def relay(connection, input, output):
+    """ Copy input to the daemon, and its replies to output, until it ends the session. """
+    connectionFD = connection.fileno()
+    (inputFD, outputFD) = (input.fileno(), output.fileno())
+
+    # Splice where one side is a pipe, and fall back to copying where neither is
+    canSplice = {inputFD: splice.available, connectionFD: splice.available}
+
+    def forward(source, dest):
+        """ Move available data from source to dest.  Returns False at the end of source. """
+        if canSplice[source]:
+            try:
+                return splice.splice(source, dest, theBufferSize) > 0
+            except IOError as error:
+                if error.errno != errno.EINVAL:
+                    raise
+                canSplice[source] = False
+
+        data = os.read(source, theBufferSize)
+        if not data:
+            return False
+
+        while data:
+            data = data[os.write(dest, data):]
+        return True
+
+    reading = [inputFD, connectionFD]
+
+    while connectionFD in reading:
+        (ready, _, _) = select.select(reading, [], [])
+
+        if inputFD in ready and not forward(inputFD, connectionFD):
+            connection.shutdown(socket.SHUT_WR)
+            reading.remove(inputFD)
+
+        if connectionFD in ready and not forward(connectionFD, outputFD):
+            reading.remove(connectionFD)
+
+    connection.close()
+
+    return 0
@@ -0,0 +1,116 @@
+""" Content-defined chunking of send streams, for deduplicated storage.
+
+Streams are split between send stream commands, so chunks follow the data
+instead of fixed offsets, and the same commands in related streams make the
+same chunks.  A chunk ends before a command whose crc (which depends only on
+the command's content) has its low bits clear, once the chunk is big enough.
+
+Copyright (c) 2014-2016 Ames Cornish.  All rights reserved.  Licensed under GPLv3.
+"""
+
+import send
+
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+# logger.setLevel('DEBUG')
+
+# Chunks end at a command boundary between these sizes,
+# or in the middle of a command that would make them too big
+theMinChunkSize = 1 << 20
+theMaxChunkSize = 16 * (1 << 20)
+
+# One boundary in this many commands (about 4MB of writes) ends a chunk
+theBoundaryMask = 0x3f
+
+
+def chunkName(data):
+    """ Return the content hash that names a chunk. """
+    return hashlib.sha256(data).hexdigest()
+
+
+class Chunker(object):
+
+    """ Splits a send stream into chunks at content-defined command boundaries.
+
+    Pieces may be strings, bytearrays or memoryviews, split anywhere:
+
+    >>> command = send.btrfs_cmd_header.write(dict(len=4096, cmd=send.BTRFS_SEND_C_WRITE))
+    >>> stream = send.btrfs_stream_header.write(dict(
+    ...     magic=send.BTRFS_SEND_STREAM_MAGIC, version=1,
+    ... )).tostring() + (command.tostring() + b"x" * 4096) * 1024
+    >>> def chunks(pieces):
+    ...     chunker = Chunker()
+    ...     found = [chunk for piece in pieces for chunk in chunker.feed(piece)]
+    ...     return found + [chunker.close()]
+    >>> whole = chunks([stream])
+    >>> (len(whole), b"".join(whole) == stream)
+    (4, True)
+    >>> chunks([bytearray(stream[:5000]), memoryview(stream)[5000:]]) == whole
+    True
+    """
+
+    def __init__(self):
+        """ Initialize. """
+        self._pieces = []
+        self._size = 0
+
+        # Partial command header split across writes
+        self._header = bytearray()
+
+        # Bytes left in the current command (the stream header comes first)
+        self._remaining = send.btrfs_stream_header.size
+
+    def feed(self, data):
+        """ Add the next piece of the stream, and yield the chunks it completes. """
+        offset = 0
+        headerSize = send.btrfs_cmd_header.size
+
+        while offset < len(data):
+            if self._remaining:
+                used = min(self._remaining, len(data) - offset, theMaxChunkSize - self._size)
+                self._add(data[offset:offset + used])
+                self._remaining -= used
+                offset += used
+
+                if self._size >= theMaxChunkSize:
+                    yield self._take()
+                continue
+
+            used = min(headerSize - len(self._header), len(data) - offset)
+            self._header += data[offset:offset + used]
+            offset += used
+
+            if len(self._header) < headerSize:
+                break
+
+            cmdHeader = send.btrfs_cmd_header.read(self._header)
+
+            if self._size >= theMinChunkSize and not cmdHeader.crc & theBoundaryMask:
+                yield self._take()
+
+            self._add(bytes(self._header))
+            self._header = bytearray()
+            self._remaining = cmdHeader.len
+
+    def close(self):
+        """ Return the last chunk, or None if there's nothing left. """
+        if self._header:
+            # Not a valid send stream, but keep every byte
+            self._add(bytes(self._header))
+            self._header = bytearray()
+
+        return self._take() if self._size else None
+
+    def _add(self, data):
+        if not isinstance(data, bytes):
+            data = memoryview(data).tobytes()
+
+        self._pieces.append(data)
+        self._size += len(data)
+
+    def _take(self):
+        chunk = b"".join(self._pieces)
+        (self._pieces, self._size) = ([], 0)
+        return chunk
@@ -89,6 +89,10 @@ class _SkipType:
         if False:
             yield None  # Make this a generator
 
+    def decoderSource(self, index, namespace):
+        # Pad bytes don't unpack to any values
+        return ("None", index)
+
 
 class _TypeWriter:
 
@@ -96,6 +100,7 @@ class _TypeWriter:
         self._default = default
         self._writer = writer or (lambda x: x)
         self._reader = reader or (lambda x: x)
+        self._hasReader = reader is not None
 
     def popValue(self, argList):
         return self._reader(argList.pop())
@@ -103,6 +108,14 @@ class _TypeWriter:
     def yieldArgs(self, arg):
         yield self._writer(arg) or self._default
 
+    def decoderSource(self, index, namespace):
+        if not self._hasReader:
+            return ("v[%d]" % (index), index + 1)
+
+        name = "_r%d" % (len(namespace))
+        namespace[name] = self._reader
+        return ("%s(v[%d])" % (name, index), index + 1)
+
 
 class Structure:
 
@@ -160,6 +173,8 @@ class Structure:
 
         self._types = collections.OrderedDict(zip(names, types))
 
+        self._decode = self._compileDecoder()
+
     @property
     def size(self):
         """ Total packed data size. """
@@ -186,7 +201,7 @@ class Structure:
     def _parseDefinition(typeDef, name, len=1, reader=None, writer=None):
         """ Return (name, format, type) for field.
 
-        type.popValue() and type.yieldArgs() must be implemented.
+        type.popValue(), type.yieldArgs(), and type.decoderSource() must be implemented.
 
         """
         if isinstance(typeDef, Structure):
@@ -231,19 +246,73 @@ class Structure:
         # return self._Tuple(*[name for (name, typeObj) in self._types.items()])
         return self._Tuple(*[typeObj.popValue(argList) for (name, typeObj) in self._types.items()])
 
+    def decoderSource(self, index, namespace):
+        """ Return (python expression, next index) to build (nested) tuple from flat values v. """
+        name = "_t%d" % (len(namespace))
+        namespace[name] = self._Tuple
+
+        args = []
+        for typeObj in self._types.values():
+            (arg, index) = typeObj.decoderSource(index, namespace)
+            args.append(arg)
+
+        return ("%s(%s)" % (name, ", ".join(args)), index)
+
+    def _compileDecoder(self):
+        """ Generate a function specialized to unpack this structure.
+
+        This avoids walking the nested field types for every read.
+        """
+        namespace = {'_unpack_from': self._struct.unpack_from}
+        (expression, count) = self.decoderSource(0, namespace)
+
+        source = (
+            "def decode(data, offset=0):\n"
+            "    v = _unpack_from(data, offset)\n"
+            "    return %s\n"
+        ) % (expression, )
+
+        exec(compile(source, "<Structure %s decoder>" % (self._fmt, ), "exec"), namespace)
+        return namespace['decode']
+
     def read(self, data, offset=0):
         """ Read data structure and return (nested) named tuple(s). """
         if isinstance(data, Buffer):
             return data.read(self)
 
         try:
-            args = list(self._struct.unpack_from(data, offset))
+            return self._decode(data, offset)
         except TypeError as error:
             # Working around struct.unpack_from issue #10212
             logger.debug("error: %s", error)
-            args = list(self._struct.unpack_from(str(bytearray(data)), offset))
-        args.reverse()
-        return self.popValue(args)
+            return self._decode(str(bytearray(data)), offset)
+
+    def readRecords(self, data, count, offset=0, lengthField='len'):
+        """ Yield (header, Buffer) for each of count records of this header and its data.
+
+        Records are read in one pass over a memoryview of data, without copying.
+
+            >>> header = Structure((t.u8, 'type'), (t.u8, 'len'))
+            >>> for (h, buf) in header.readRecords(b'\\x07\\x02hi\\x08\\x00', 2):
+            ...     print h.type, repr(buf.readView().tobytes())
+            7 'hi'
+            8 ''
+
+        """
+        try:
+            data = memoryview(data)
+        except TypeError:
+            pass  # Python 2 arrays don't support memoryview
+
+        decode = self._decode
+        size = self.size
+
+        for _ in xrange(count):
+            header = decode(data, offset)
+            offset += size
+            length = getattr(header, lengthField)
+            yield (header, Buffer(data, offset, length))
+            offset += length
 
 
 class Buffer:
@@ -254,7 +323,7 @@ class Buffer:
         """ Initialize. """
         self.buf = buf
         self.offset = offset
-        self._len = (newLength + offset) if newLength else len(buf)
+        self._len = (newLength + offset) if newLength is not None else len(buf)
 
     def read(self, structure):
         """ Read and advance. """
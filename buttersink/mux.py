@@ -0,0 +1,349 @@
+""" Multiplex concurrent channels over one pair of streams.
+
+Each frame has a header with a channel id, a kind, and a payload length.
+A channel carries one call, its reply, and optionally a data stream,
+with credit-based flow control per channel.
+
+Copyright (c) 2014-2016 Ames Cornish.  All rights reserved.  Licensed under GPLv3.
+"""
+
+import splice
+
+import itertools
+import json
+import logging
+import os
+import Queue
+import struct
+import threading
+
+logger = logging.getLogger(__name__)
+# logger.setLevel('DEBUG')
+
+theFrameHeader = struct.Struct("!IBI")  # channel, kind, payload length
+theCredit = struct.Struct("!I")
+
+# Frame kinds
+(
+    CALL,       # JSON list of command and arguments
+    REPLY,      # JSON result of the call, or of the stream at its end
+    DATA,       # Stream data
+    CREDIT,     # Count of further DATA frames the receiver will accept
+    EOF,        # End of stream data
+    CANCEL,     # Stop sending stream data
+) = range(6)
+
+theFrameSize = 1 << 20
+theCreditWindow = 4
+
+
+class Channel(object):
+
+    """ One call, and its data stream, over a Multiplexer. """
+
+    def __init__(self, mux, channelID, credit=0):
+        """ Initialize. """
+        self.mux = mux
+        self.id = channelID
+        self.cancelled = False
+        self.result = None
+
+        # (kind, payload) of received REPLY, DATA, EOF and CANCEL frames
+        self._inbox = Queue.Queue()
+
+        self._credit = credit
+        self._creditChanged = threading.Condition()
+
+    def call(self, command):
+        """ Send a call, and return its (first) reply. """
+        self.request(command)
+        self.result = self.reply()
+        return self.result
+
+    def request(self, command):
+        """ Send a call, without waiting for its reply. """
+        self.send(CALL, json.dumps(command))
+
+    def reply(self):
+        """ Return the next reply, skipping any stream frames. """
+        while True:
+            (kind, payload) = self.receive()
+            if kind == REPLY:
+                return json.loads(payload)
+
+    def send(self, kind, payload=''):
+        """ Send a frame on this channel. """
+        self.mux.send(self.id, kind, payload)
+
+    def receive(self):
+        """ Return the next (kind, payload) received on this channel. """
+        item = self._inbox.get()
+        if item is None:
+            raise Exception("Lost ssh connection (%s)" % (self.mux.error,))
+        return item
+
+    def sendData(self, data):
+        """ Send data, waiting for credit.  Returns False if the receiver cancelled. """
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+
+        for offset in xrange(0, len(data), theFrameSize):
+            if not self._takeCredit():
+                return False
+
+            # Python 2 buffer objects can be written to text mode files, like stdout
+            self.send(DATA, buffer(data, offset, theFrameSize))
+
+        return True
+
+    def spliceData(self, fd):
+        """ Send everything read from pipe fd, without copying it through Python.
+
+        Returns the count of bytes sent, or None if the receiver cancelled.
+        """
+        # Each frame must fit in the pipe, because it's only drained once it's full
+        (readFD, writeFD, frameSize) = splice.pipe(theFrameSize)
+        total = 0
+
+        try:
+            while True:
+                size = splice.fill(fd, writeFD, frameSize)
+                if size == 0:
+                    return total
+
+                if not self._takeCredit():
+                    return None
+
+                self.mux.spliceFrame(self.id, DATA, readFD, size)
+                total += size
+        finally:
+            os.close(readFD)
+            os.close(writeFD)
+
+    def _takeCredit(self):
+        """ Wait to be allowed to send a DATA frame.  Returns False if the receiver cancelled. """
+        with self._creditChanged:
+            while self._credit == 0 and not self.cancelled and self.mux.error is None:
+                self._creditChanged.wait()
+
+            if self.cancelled:
+                return False
+
+            if self.mux.error is not None:
+                raise Exception("Lost ssh connection (%s)" % (self.mux.error,))
+
+            self._credit -= 1
+            return True
+
+    def grant(self, count=1):
+        """ Allow the sender to send count more DATA frames. """
+        self.send(CREDIT, theCredit.pack(count))
+
+    def _dispatch(self, kind, payload):
+        if kind == CREDIT:
+            self._addCredit(theCredit.unpack(payload)[0])
+            return
+
+        if kind == CANCEL:
+            with self._creditChanged:
+                self.cancelled = True
+                self._creditChanged.notify_all()
+
+        self._inbox.put((kind, payload))
+
+    def _addCredit(self, count):
+        with self._creditChanged:
+            self._credit += count
+            self._creditChanged.notify_all()
+
+    def _fail(self):
+        with self._creditChanged:
+            self._creditChanged.notify_all()
+        self._inbox.put(None)
+
+
+class Multiplexer(object):
+
+    """ Sends and receives channel frames over an input and output stream. """
+
+    def __init__(self, input, output):
+        """ Initialize. """
+        self.input = input
+        self.output = output
+        self.error = None
+
+        self.channels = {}
+        self._channelsLock = threading.Lock()
+        self._outputLock = threading.Lock()
+
+    def send(self, channelID, kind, payload=''):
+        """ Send a frame. """
+        header = theFrameHeader.pack(channelID, kind, len(payload))
+
+        with self._outputLock:
+            self.output.write(header)
+            if len(payload):
+                self.output.write(payload)
+            self.output.flush()
+
+    def spliceFrame(self, channelID, kind, fd, size):
+        """ Send a frame, splicing its payload from pipe fd. """
+        header = theFrameHeader.pack(channelID, kind, size)
+
+        with self._outputLock:
+            self.output.write(header)
+            self.output.flush()
+            splice.move(fd, self.output.fileno(), size)
+
+    def close(self, channel):
+        """ Forget a finished channel. """
+        with self._channelsLock:
+            self.channels.pop(channel.id, None)
+
+    def _add(self, channel):
+        with self._channelsLock:
+            if self.error is not None:
+                raise Exception("Lost ssh connection (%s)" % (self.error,))
+            if channel.id in self.channels:
+                raise Exception("Channel %d is already open" % (channel.id,))
+            self.channels[channel.id] = channel
+        return channel
+
+    def _readFrame(self):
+        """ Return the next (channelID, kind, payload), or None at the end of input. """
+        header = self.input.read(theFrameHeader.size)
+        if not header:
+            return None
+
+        if len(header) != theFrameHeader.size:
+            raise Exception("Truncated frame header")
+
+        (channelID, kind, size) = theFrameHeader.unpack(header)
+
+        payload = self.input.read(size) if size else ''
+        if len(payload) != size:
+            raise Exception("Truncated frame")
+
+        return (channelID, kind, payload)
+
+    def _dispatch(self, channelID, kind, payload):
+        with self._channelsLock:
+            channel = self.channels.get(channelID)
+
+        if channel is None:
+            # Late credit or cancellation for a finished channel
+            logger.debug("Ignoring frame %d for channel %d", kind, channelID)
+            return
+
+        channel._dispatch(kind, payload)
+
+    def _fail(self, error):
+        """ Wake up all channels after the input has ended. """
+        self.error = error
+
+        with self._channelsLock:
+            channels = list(self.channels.values())
+
+        for channel in channels:
+            channel._fail()
+
+
+class ClientMultiplexer(Multiplexer):
+
+    """ Opens channels, and reads their frames in a background thread. """
+
+    def __init__(self, input, output):
+        """ Initialize. """
+        super(ClientMultiplexer, self).__init__(input, output)
+        self._ids = itertools.count(1)
+        self._reader = threading.Thread(target=self._read, name="mux reader")
+        self._reader.daemon = True
+
+    def start(self):
+        """ Start reading frames. """
+        self._reader.start()
+
+    def join(self):
+        """ Wait for the input to end. """
+        self._reader.join()
+
+    def open(self):
+        """ Return a new channel. """
+        with self._channelsLock:
+            channelID = next(self._ids)
+        return self._add(Channel(self, channelID))
+
+    def _read(self):
+        try:
+            while True:
+                frame = self._readFrame()
+                if frame is None:
+                    break
+                self._dispatch(*frame)
+            error = "closed"
+        except Exception as readError:
+            logger.debug("Mux reader error: %s", readError)
+            error = readError
+
+        self._fail(error)
+
+
+class ServerMultiplexer(Multiplexer):
+
+    """ Serves each call in its own thread. """
+
+    def __init__(self, input, output, handler):
+        """ Initialize.
+
+        handler(channel, command) is called in a new thread for each call.
+        """
+        super(ServerMultiplexer, self).__init__(input, output)
+        self.handler = handler
+        self._threads = []
+
+    def serve(self):
+        """ Handle frames until the end of input, then wait for calls to finish. """
+        try:
+            while True:
+                frame = self._readFrame()
+                if frame is None:
+                    break
+
+                (channelID, kind, payload) = frame
+
+                if kind == CALL:
+                    self._call(channelID, json.loads(payload))
+                else:
+                    self._dispatch(channelID, kind, payload)
+            error = "closed"
+        except Exception as readError:
+            logger.debug("Mux server error: %s", readError)
+            error = readError
+
+        self._fail(error)
+
+        for thread in self._threads:
+            thread.join()
+
+    def _call(self, channelID, command):
+        channel = self._add(Channel(self, channelID, theCreditWindow))
+
+        thread = threading.Thread(
+            target=self._serve,
+            args=(channel, command),
+            name="channel %d" % (channelID,),
+        )
+        thread.daemon = True
+
+        self._threads = [t for t in self._threads if t.is_alive()]
+        self._threads.append(thread)
+
+        thread.start()
+
+    def _serve(self, channel, command):
+        try:
+            self.handler(channel, command)
+        except Exception as error:
+            logger.debug("Channel %d error: %s", channel.id, error)
+        finally:
+            self.close(channel)
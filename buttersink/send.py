@@ -7,18 +7,27 @@ import btrfs
 import ioctl
 
 # import binascii  # This provides "zip" crc
-# import crc32c  # This provides *slow* btrfs crc32c
-import crcmod.predefined  # This provides fast compiled extension
-crc32c = crcmod.predefined.mkPredefinedCrcFun("crc-32c")
+try:
+    import crc32c as _crc32c  # This provides hardware (SSE 4.2 or ARMv8) crc32c
+    if not getattr(_crc32c, 'hardware_based', False):
+        raise ImportError("crc32c is using a software implementation")
+    crc32c = _crc32c.crc32c
+except ImportError:
+    import crcmod.predefined  # This provides fast compiled extension
+    crc32c = crcmod.predefined.mkPredefinedCrcFun("crc-32c")
 
 import logging
+import Queue
 import struct
+import threading
 
 logger = logging.getLogger(__name__)
 # logger.setLevel('DEBUG')
 
 BTRFS_SEND_STREAM_MAGIC = "btrfs-stream\0"
-BTRFS_SEND_STREAM_VERSION = 1
+# Highest stream version understood here.
+# Version 2 adds compressed (encoded) writes and fallocate.
+BTRFS_SEND_STREAM_VERSION = 2
 
 btrfs_stream_header = Structure(
     (t.char, 'magic', len(BTRFS_SEND_STREAM_MAGIC)),
@@ -42,6 +51,12 @@ btrfs_tlv_header = Structure(
     packed=True
 )
 
+# Header of the (last) DATA attribute in version 2 streams
+btrfs_tlv_type = Structure(
+    (t.le16, 'tlv_type'),
+    packed=True
+)
+
 # /* commands */
 (
     BTRFS_SEND_C_UNSPEC,
@@ -74,8 +89,15 @@ btrfs_tlv_header = Structure(
 
     BTRFS_SEND_C_END,
     BTRFS_SEND_C_UPDATE_EXTENT,
+
+    # /* Version 2 */
+    BTRFS_SEND_C_FALLOCATE,
+    BTRFS_SEND_C_FILEATTR,
+    BTRFS_SEND_C_ENCODED_WRITE,
     __BTRFS_SEND_C_MAX,
-) = range(24)
+) = range(27)
+BTRFS_SEND_C_MAX_V1 = BTRFS_SEND_C_UPDATE_EXTENT
+BTRFS_SEND_C_MAX_V2 = BTRFS_SEND_C_ENCODED_WRITE
 BTRFS_SEND_C_MAX = (__BTRFS_SEND_C_MAX - 1)
 
 # /* attributes in send stream */
@@ -104,6 +126,7 @@ BTRFS_SEND_C_MAX = (__BTRFS_SEND_C_MAX - 1)
     BTRFS_SEND_A_PATH_LINK,
 
     BTRFS_SEND_A_FILE_OFFSET,
+    # /* In version 2, DATA must be the last attribute, and has no length */
     BTRFS_SEND_A_DATA,
 
     BTRFS_SEND_A_CLONE_UUID,
@@ -112,8 +135,19 @@ BTRFS_SEND_C_MAX = (__BTRFS_SEND_C_MAX - 1)
     BTRFS_SEND_A_CLONE_OFFSET,
     BTRFS_SEND_A_CLONE_LEN,
 
+    # /* Version 2 */
+    BTRFS_SEND_A_FALLOCATE_MODE,
+    BTRFS_SEND_A_FILEATTR,
+    BTRFS_SEND_A_UNENCODED_FILE_LEN,
+    BTRFS_SEND_A_UNENCODED_LEN,
+    BTRFS_SEND_A_UNENCODED_OFFSET,
+    BTRFS_SEND_A_COMPRESSION,
+    BTRFS_SEND_A_ENCRYPTION,
+
     __BTRFS_SEND_A_MAX,
-) = range(26)
+) = range(33)
+BTRFS_SEND_A_MAX_V1 = BTRFS_SEND_A_CLONE_LEN
+BTRFS_SEND_A_MAX_V2 = BTRFS_SEND_A_ENCRYPTION
 BTRFS_SEND_A_MAX = (__BTRFS_SEND_A_MAX - 1)
 
 
@@ -170,16 +204,80 @@ def TLV_GET_U64(attrs, attrNum):
     return TLV_GET(attrs, attrNum, t.u64)
 
 
+# btrfs uses a zero seed and no final inversion
+_crcSeed = 0 ^ 0xffffffff
+
+
+def _crcResult(crc):
+    """ Return btrfs crc32c from a running crc32c value. """
+    return (crc & 0xffffffff) ^ 0xffffffff
+
+
+def _crc(*pieces):
+    """ Return btrfs crc32c of the (read-only buffer) pieces. """
+    crc = _crcSeed
+    for piece in pieces:
+        crc = crc32c(piece, crc)
+    return _crcResult(crc)
+
+
+_zeroCRC = struct.pack("=" + t.le32, 0)
+
+# Offset of the crc field in btrfs_cmd_header
+_crcOffset = struct.calcsize("=" + t.le32 + t.le16)
+
+
+def _commandCRC(data, offset, length):
+    """ Return crc of the command at offset in data, calculated with a zero crc field. """
+    # Python 2 buffer objects give crcmod zero-copy access
+    return _crc(
+        buffer(data, offset, _crcOffset),
+        _zeroCRC,
+        buffer(data, offset + btrfs_cmd_header.size, length),
+    )
+
+
 def replaceIDs(data, receivedUUID, receivedGen, parentUUID, parentGen):
-    """ Parse and replace UUID and transid info in data stream. """
-    if len(data) < 20:
-        return data
+    """ Parse and replace UUID and transid info in the start of a data stream.
+
+    Returns a bytearray with the replaced values.
+    """
+    data = bytearray(data)  # Make data writable
+    parser = StreamParser(receivedUUID, receivedGen, parentUUID, parentGen)
+    for _ in parser.feed(data):
+        pass
+    return data
 
+
+def _readAttributes(attrData, version):
+    """ Return {type: Buffer} of the attributes in a command's data. """
+    attrs = {}
+
+    while attrData.len > 0:
+        if version >= 2:
+            attrType = btrfs_tlv_type.read(attrData.buf, attrData.offset).tlv_type
+            if attrType == BTRFS_SEND_A_DATA:
+                # The rest of the command is data
+                attrData.skip(btrfs_tlv_type.size)
+                attrs[attrType] = attrData.readBuffer(attrData.len)
+                break
+
+        attrHeader = attrData.read(btrfs_tlv_header)
+        attrs[attrHeader.tlv_type] = attrData.readBuffer(attrHeader.tlv_len)
+
+    return attrs
+
+
+def _replaceIDs(data, receivedUUID, receivedGen, parentUUID, parentGen):
+    """ Parse and replace UUID and transid info in the stream header and first command.
+
+    data must be a writable bytearray, starting with the stream header,
+    and containing the complete first command.
+    """
     logger.debug(
         "Setting received %s/%d and parent %s/%d",
         receivedUUID, receivedGen or 0, parentUUID, parentGen or 0.
         )
-    data = bytearray(data)  # Make data writable
 
     buf = ioctl.Buffer(data)
     header = buf.read(btrfs_stream_header)
@@ -192,47 +290,15 @@ def replaceIDs(data, receivedUUID, receivedGen, parentUUID, parentGen):
     if header.version > BTRFS_SEND_STREAM_VERSION:
         logger.warn("Unknown stream version: %d", header.version)
 
-    cmdHeaderView = buf.peekView(btrfs_cmd_header.size)
+    cmdOffset = buf.offset
     cmdHeader = buf.read(btrfs_cmd_header)
 
     logger.debug("Command: %d", cmdHeader.cmd)
 
-    # Read the attributes
-
-    attrs = {}
-    attrDataView = buf.peekView(cmdHeader.len)
-    attrData = buf.readBuffer(cmdHeader.len)
-
-    while attrData.len > 0:
-        attrHeader = attrData.read(btrfs_tlv_header)
-        attrs[attrHeader.tlv_type] = attrData.readBuffer(attrHeader.tlv_len)
+    attrs = _readAttributes(buf.readBuffer(cmdHeader.len), header.version)
 
     def calcCRC():
-        header = cmdHeader._asdict()
-        header['crc'] = 0
-
-        # This works, but is slow
-        # crc = crc32c.CRC_INIT ^ crc32c._MASK
-        # crc = crc32c.crc_update(crc, btrfs_cmd_header.write(header))
-        # crc = crc32c.crc_update(crc, attrDataView)
-        # crc = crc32c.crc_finalize(crc)
-        # crc = crc ^ crc32c._MASK
-
-        # This works, and can be fast, when it used compiled extension
-        crc = 0 ^ 0xffffffff
-        crc = crc32c(btrfs_cmd_header.write(header).tostring(), crc)
-        crc = crc32c(attrDataView.tobytes(), crc)
-        crc &= 0xffffffff
-        crc = crc ^ 0xffffffff
-
-        # This does *not* work
-        # crc = 0 ^ 0xffffffff
-        # crc = binascii.crc32(btrfs_cmd_header.write(header), crc)
-        # crc = binascii.crc32(attrDataView, crc)
-        # crc &= 0xffffffff
-        # crc ^= 0xffffffff
-
-        return crc
+        return _commandCRC(data, cmdOffset, cmdHeader.len)
 
     crc = calcCRC()
     if cmdHeader.crc != crc:
@@ -256,10 +322,7 @@ def replaceIDs(data, receivedUUID, receivedGen, parentUUID, parentGen):
         crc = calcCRC()
         if cmdHeader.crc != crc:
             logger.debug("Correcting CRC from %d to %d", cmdHeader.crc, crc)
-            header = cmdHeader._asdict()
-            header['crc'] = crc
-            cmdHeaderView[:] = btrfs_cmd_header.write(header).tostring()
-
+            struct.pack_into("=" + t.le32, data, cmdOffset + _crcOffset, crc)
     if cmdHeader.cmd == BTRFS_SEND_C_SUBVOL:
         path = TLV_GET_STRING(s, BTRFS_SEND_A_PATH, )
         uuid = TLV_GET_UUID(s, BTRFS_SEND_A_UUID, )
@@ -332,3 +395,305 @@ def replaceIDs(data, receivedUUID, receivedGen, parentUUID, parentGen):
     correctCRC()
 
     return data
+
+
+class StreamParser(object):
+
+    """ Incremental parser for a btrfs send stream.
+
+    Tracks command boundaries across arbitrary chunk splits,
+    and replaces the UUID and transid info in the first (SUBVOL or SNAPSHOT) command.
+
+    Data after the first command isn't copied or changed.
+
+    If verify is set, the crc of every command is checked,
+    and a mismatch raises ParseException.
+    """
+
+    def __init__(
+        self, receivedUUID=None, receivedGen=None, parentUUID=None, parentGen=None,
+        verify=False, maxVersion=None,
+    ):
+        """ Initialize with values to replace in the stream, or None to keep them. """
+        self.ids = (receivedUUID, receivedGen, parentUUID, parentGen)
+        self.patch = any(value is not None for value in self.ids)
+        self.verify = verify
+
+        # Stream version, from the stream header, and the highest the receiver accepts
+        self.version = None
+        self.maxVersion = maxVersion
+
+        # Running crc of the current command, and its stored crc
+        self._crcValue = None
+        self._expectedCRC = None
+
+        # Copy of the stream header and first command, until it's complete
+        self._head = bytearray()
+        self._headCopy = None
+        self._headSize = btrfs_stream_header.size + btrfs_cmd_header.size
+
+        # Partial command header split across chunks
+        self._cmdHeader = bytearray()
+        # Bytes left in the current command
+        self._remaining = 0
+
+        self.commands = 0
+        self.ended = False
+
+    def feed(self, data):
+        """ Parse the next chunk of the stream, and yield memoryview slices to pass on.
+
+        If data is a bytearray containing the entire first command, it's patched in place.
+        """
+        (head, offset) = self._feed(data)
+
+        if head is not None:
+            yield memoryview(head)
+
+        if offset < len(data):
+            yield memoryview(data)[offset:]
+
+    def parse(self, data):
+        """ Parse the next chunk of the stream, and return it as a single buffer.
+
+        This only copies data if the first command was split across chunks.
+        """
+        (head, offset) = self._feed(data)
+
+        if head is not None:
+            return bytes(head) + data[offset:]
+
+        return data[offset:] if offset else data
+
+    def check(self, data):
+        """ Parse the next chunk of the stream, without passing it on. """
+        self._feed(data)
+
+    def _feed(self, data):
+        """ Parse data, and return (copied head or None, offset of the rest of data). """
+        head = None
+        offset = 0
+
+        if self._head is not None:
+            if not self._head and isinstance(data, bytearray) and self._fits(data):
+                self._endHead(data)
+                self._scan(data, self._headSize)
+                return (None, 0)
+
+            offset = self._fillHead(data)
+            if self._head is not None:
+                return (None, offset)  # Need more data
+
+            # This was a copy of the start of the stream
+            (head, self._headCopy) = (self._headCopy, None)
+
+        self._scan(data, offset)
+
+        return (head, offset)
+
+    def close(self):
+        """ Raise ParseException if the stream was truncated. """
+        if self._head is not None or self._remaining or self._cmdHeader:
+            raise ParseException("Send stream ended in the middle of a command")
+        if not self.ended:
+            logger.warn("Send stream ended without an END command")
+
+    def _fits(self, data):
+        """ True if data contains the stream header and all of the first command (the head). """
+        if len(data) < self._headSize:
+            return False
+        cmdHeader = btrfs_cmd_header.read(data, btrfs_stream_header.size)
+        if len(data) < self._headSize + cmdHeader.len:
+            return False
+        self._headSize += cmdHeader.len
+        return True
+
+    def _fillHead(self, data):
+        """ Copy the start of data into the head, and return bytes used. """
+        used = 0
+
+        while self._head is not None and used < len(data):
+            size = min(self._headSize - len(self._head), len(data) - used)
+            self._head += data[used:used + size]
+            used += size
+
+            if len(self._head) < self._headSize:
+                break
+
+            if len(self._head) == btrfs_stream_header.size + btrfs_cmd_header.size:
+                cmdHeader = btrfs_cmd_header.read(self._head, btrfs_stream_header.size)
+                self._headSize += cmdHeader.len
+                if cmdHeader.len > 0:
+                    continue
+
+            head = self._head
+            self._endHead(head)
+            self._headCopy = head
+
+        return used
+
+    def _endHead(self, data):
+        """ Patch the complete stream header and first command. """
+        self._head = None
+
+        header = btrfs_stream_header.read(data)
+        if header.magic != BTRFS_SEND_STREAM_MAGIC:
+            raise ParseException("Didn't find '%s'" % (BTRFS_SEND_STREAM_MAGIC))
+
+        self.version = header.version
+        if self.maxVersion is not None and self.version > self.maxVersion:
+            raise ParseException(
+                "Send stream version %d is newer than the receiver's version %d"
+                % (self.version, self.maxVersion)
+            )
+
+        cmdHeader = btrfs_cmd_header.read(data, btrfs_stream_header.size)
+        self._command(cmdHeader)
+
+        if self.verify:
+            self._checkCRC(
+                _commandCRC(data, btrfs_stream_header.size, cmdHeader.len),
+                cmdHeader.crc,
+            )
+
+        if self.patch:
+            _replaceIDs(data, *self.ids)
+
+    def _command(self, cmdHeader):
+        """ Count a command, and note the end of the stream. """
+        self.commands += 1
+        if cmdHeader.cmd == BTRFS_SEND_C_END:
+            self.ended = True
+
+    def _checkCRC(self, crc, expected):
+        """ Raise ParseException if the last command's crc doesn't match. """
+        if crc != expected:
+            raise ParseException(
+                "Bad crc in send stream command #%d (%d instead of %d)"
+                % (self.commands, crc, expected)
+            )
+
+    def _scan(self, data, offset):
+        """ Follow command boundaries from offset to the end of data. """
+        size = len(data)
+        headerSize = btrfs_cmd_header.size
+
+        while offset < size:
+            if self._remaining:
+                used = min(self._remaining, size - offset)
+                self._remaining -= used
+                if self.verify:
+                    self._crcValue = crc32c(buffer(data, offset, used), self._crcValue)
+                    if not self._remaining:
+                        self._checkCRC(_crcResult(self._crcValue), self._expectedCRC)
+                offset += used
+                continue
+
+            if not self._cmdHeader and size - offset >= headerSize:
+                header = buffer(data, offset, headerSize)
+                offset += headerSize
+            else:
+                used = min(headerSize - len(self._cmdHeader), size - offset)
+                self._cmdHeader += data[offset:offset + used]
+                offset += used
+                if len(self._cmdHeader) < headerSize:
+                    break
+                (header, self._cmdHeader) = (self._cmdHeader, bytearray())
+
+            cmdHeader = btrfs_cmd_header.read(header)
+
+            if self.ended:
+                raise ParseException("Data after END command in send stream")
+
+            self._command(cmdHeader)
+            self._remaining = cmdHeader.len
+
+            if self.verify:
+                self._crcValue = crc32c(_zeroCRC, crc32c(buffer(header, 0, _crcOffset), _crcSeed))
+                self._expectedCRC = cmdHeader.crc
+                if not self._remaining:
+                    self._checkCRC(_crcResult(self._crcValue), self._expectedCRC)
+
+
+class Verifier(threading.Thread):
+
+    """ Context Manager to check the crc of every command in a send stream.
+
+    Chunks written to the verifier are checked in a worker thread,
+    so checking overlaps the transfer.  Errors are raised by the next write,
+    or when the context exits.
+    """
+
+    def __init__(self, name="stream"):
+        """ Initialize. """
+        super(Verifier, self).__init__(name="verify %s" % (name,))
+        self.daemon = True
+
+        self.parser = StreamParser(verify=True)
+        self.bytesVerified = 0
+        self._queued = 0
+        self.error = None
+        self.skipped = None
+
+        # Hold at most one chunk beyond the one being checked
+        self._queue = Queue.Queue(1)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exceptionType, exception, trace):
+        self._queue.put(None)
+        self.join()
+
+        if exception is None and self.error is not None:
+            raise self.error
+
+        if self.skipped is None:
+            logger.debug("Verified %d commands", self.parser.commands)
+
+        return False  # Don't supress exception
+
+    def write(self, data):
+        """ Queue the next chunk of the stream to be checked. """
+        if self.error is not None:
+            raise self.error
+
+        if self.skipped is not None:
+            return
+
+        if self._queued == 0 and isinstance(data, bytearray):
+            # Writers may patch the first chunk in place while we read it
+            data = bytes(data)
+
+        self._queued += len(data)
+        self._queue.put(data)
+
+    def skip(self, reason):
+        """ Stop checking, because some of the stream won't be seen. """
+        if self.skipped is None:
+            logger.warn("Not verifying send stream: %s", reason)
+            self.skipped = reason
+
+    def run(self):
+        """ Check queued chunks until the end of the stream. """
+        while True:
+            data = self._queue.get()
+
+            if data is None:
+                break
+
+            if self.error is not None or self.skipped is not None:
+                continue
+
+            try:
+                self.parser.check(data)
+                self.bytesVerified += len(data)
+            except Exception as error:
+                self.error = error
+
+        if self.error is None and self.skipped is None:
+            try:
+                self.parser.close()
+            except Exception as error:
+                self.error = error
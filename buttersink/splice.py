@@ -0,0 +1,95 @@
+""" Move data between file descriptors without copying it through Python.
+
+Uses the linux splice system call, where one side of each move is a pipe.
+
+Copyright (c) 2014-2016 Ames Cornish.  All rights reserved.  Licensed under GPLv3.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+# logger.setLevel('DEBUG')
+
+SPLICE_F_MOVE = 1
+F_SETPIPE_SZ = 1031
+F_GETPIPE_SZ = 1032
+
+# Pipes hold at least 16 pages
+theDefaultPipeSize = 1 << 16
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _splice = _libc.splice
+except (OSError, AttributeError) as error:
+    logger.debug("splice is not available (%s)", error)
+    _splice = None
+else:
+    _splice.argtypes = [
+        ctypes.c_int, ctypes.c_void_p,  # fd_in, off_in
+        ctypes.c_int, ctypes.c_void_p,  # fd_out, off_out
+        ctypes.c_size_t, ctypes.c_uint,  # len, flags
+    ]
+    _splice.restype = ctypes.c_ssize_t
+
+available = _splice is not None
+
+
+def splice(fdIn, fdOut, size):
+    """ Move up to size bytes from fdIn to fdOut, and return the count moved.
+
+    Returns 0 at the end of fdIn.
+    """
+    while True:
+        moved = _splice(fdIn, None, fdOut, None, size, SPLICE_F_MOVE)
+        if moved >= 0:
+            return moved
+
+        code = ctypes.get_errno()
+        if code != errno.EINTR:
+            raise IOError(code, os.strerror(code))
+
+
+def fill(fdIn, fdOut, size):
+    """ Move size bytes from fdIn to fdOut, or fewer at the end of fdIn.  Returns the count. """
+    total = 0
+
+    while total < size:
+        moved = splice(fdIn, fdOut, size - total)
+        if moved == 0:
+            break
+        total += moved
+
+    return total
+
+
+def move(fdIn, fdOut, size):
+    """ Move exactly size bytes from fdIn to fdOut. """
+    if fill(fdIn, fdOut, size) != size:
+        raise IOError(errno.EPIPE, "Unexpected end of spliced data")
+
+
+def pipe(size):
+    """ Return (read fd, write fd, capacity) for a new pipe, holding size bytes if possible.
+
+    Filling a pipe past its capacity blocks until it's drained,
+    and the system may not allow one as large as size.
+    """
+    (readFD, writeFD) = os.pipe()
+
+    try:
+        fcntl.fcntl(writeFD, F_SETPIPE_SZ, size)
+    except IOError as error:
+        logger.debug("Can't resize pipe (%s)", error)
+
+    try:
+        capacity = fcntl.fcntl(writeFD, F_GETPIPE_SZ)
+    except IOError as error:
+        logger.debug("Can't get pipe size (%s)", error)
+        capacity = theDefaultPipeSize
+
+    return (readFD, writeFD, min(size, capacity))
@@ -0,0 +1 @@
+version = "dev"
@@ -34,6 +34,9 @@ setup(
 
     install_requires=['boto', 'crcmod', 'psutil'],
 
+    # Hardware crc32c for --verify
+    extras_require={'crc32c': ['crc32c'], 'tcp': ['cryptography'], 'zstd': ['zstandard']},
+
     # These will be in the package subdirectory, accessible by package code
     # package_data={
     #     '': ['version.txt'],